@@ -3,11 +3,13 @@
 Admin interface with full CRUD operations
 """
 
-from flask import Blueprint, render_template_string, request, redirect, url_for, flash, jsonify
+from flask import Blueprint, request, redirect, url_for, flash, jsonify
+from markupsafe import escape
 from auth_routes import login_required, admin_required, get_current_user
 from database import db
 from database.models import User, Role, Store, VisitorCounter, Alert, VisitorData, AuditLog
-from utils.auth import hash_password
+from utils.auth import hash_password, refresh_revocations
+from utils.templates import register_template, render_inline
 from datetime import datetime, timedelta
 import logging
 
@@ -194,6 +196,7 @@ ADMIN_TEMPLATE = """
 </body>
 </html>
 """
+register_template('admin', ADMIN_TEMPLATE)
 
 USERS_TAB = """
 <div class="d-flex justify-content-between align-items-center mb-4">
@@ -309,6 +312,7 @@ USERS_TAB = """
     </div>
 </div>
 """
+register_template('admin_users_tab', USERS_TAB)
 
 @admin_bp.route('/')
 @admin_required
@@ -332,7 +336,7 @@ def index():
     if tab == 'users':
         users = User.query.all()
         roles = Role.query.all()
-        tab_content = render_template_string(USERS_TAB, users=users, roles=roles, current_user=current_user)
+        tab_content = render_inline('admin_users_tab', users=users, roles=roles, current_user=current_user)
     elif tab == 'stores':
         tab_content = render_stores_tab()
     elif tab == 'counters':
@@ -342,13 +346,13 @@ def index():
     elif tab == 'audit':
         tab_content = render_audit_tab()
     
-    return render_template_string(ADMIN_TEMPLATE, 
-                                active_tab=tab,
-                                current_user=current_user,
-                                stats=stats,
-                                recent_alerts=recent_alerts,
-                                recent_logs=recent_logs,
-                                tab_content=tab_content)
+    return render_inline('admin',
+                         active_tab=tab,
+                         current_user=current_user,
+                         stats=stats,
+                         recent_alerts=recent_alerts,
+                         recent_logs=recent_logs,
+                         tab_content=tab_content)
 
 @admin_bp.route('/user/create', methods=['POST'])
 @admin_required
@@ -414,6 +418,7 @@ def toggle_user(user_id):
         
         user.active = not user.active
         db.session.commit()
+        refresh_revocations(force=True)
         
         # Log action
         from utils.auth import log_user_action
@@ -456,11 +461,11 @@ def render_stores_tab():
                     <tbody>
                         {''.join([f'''
                         <tr>
-                            <td>{store.store_code}</td>
-                            <td>{store.name}</td>
-                            <td>{store.city}</td>
-                            <td>{store.region}</td>
-                            <td>{store.manager_name or "Не указан"}</td>
+                            <td>{escape(store.store_code)}</td>
+                            <td>{escape(store.name)}</td>
+                            <td>{escape(store.city)}</td>
+                            <td>{escape(store.region)}</td>
+                            <td>{escape(store.manager_name or "Не указан")}</td>
                             <td>
                                 <span class="badge bg-{'success' if store.active else 'secondary'}">
                                     {'Активен' if store.active else 'Неактивен'}
@@ -508,11 +513,11 @@ def render_counters_tab():
                     <tbody>
                         {''.join([f'''
                         <tr>
-                            <td><code>{counter.device_id}</code></td>
-                            <td>{counter.name}</td>
-                            <td>{counter.store.name}</td>
-                            <td>{counter.counter_type}</td>
-                            <td>{counter.assigned_user.username if counter.assigned_user else "Не назначен"}</td>
+                            <td><code>{escape(counter.device_id)}</code></td>
+                            <td>{escape(counter.name)}</td>
+                            <td>{escape(counter.store.name)}</td>
+                            <td>{escape(counter.counter_type)}</td>
+                            <td>{escape(counter.assigned_user.username if counter.assigned_user else "Не назначен")}</td>
                             <td>
                                 <span class="badge bg-{'success' if counter.active else 'secondary'}">
                                     {'Активен' if counter.active else 'Неактивен'}
@@ -567,15 +572,15 @@ def render_alerts_tab():
                         {''.join([f'''
                         <tr class="{'table-warning' if not alert.is_read else ''}">
                             <td>{alert.created_at.strftime('%d.%m.%Y %H:%M')}</td>
-                            <td>{alert.alert_type}</td>
+                            <td>{escape(alert.alert_type)}</td>
                             <td>
                                 <span class="badge bg-{'danger' if alert.severity == 'critical' else 'warning' if alert.severity == 'high' else 'info' if alert.severity == 'medium' else 'secondary'}">
-                                    {alert.severity}
+                                    {escape(alert.severity)}
                                 </span>
                             </td>
-                            <td>{alert.message}</td>
-                            <td>{alert.counter.name}</td>
-                            <td>{alert.counter.store.name}</td>
+                            <td>{escape(alert.message)}</td>
+                            <td>{escape(alert.counter.name)}</td>
+                            <td>{escape(alert.counter.store.name)}</td>
                             <td>
                                 <span class="badge bg-{'success' if alert.is_resolved else 'warning' if alert.is_read else 'danger'}">
                                     {'Решен' if alert.is_resolved else 'Прочитан' if alert.is_read else 'Новый'}
@@ -618,17 +623,17 @@ def render_audit_tab():
                         {''.join([f'''
                         <tr>
                             <td>{log.timestamp.strftime('%d.%m.%Y %H:%M:%S')}</td>
-                            <td>{log.user.username if log.user else 'Система'}</td>
+                            <td>{escape(log.user.username if log.user else 'Система')}</td>
                             <td>
                                 <span class="badge bg-primary">
-                                    {log.action}
+                                    {escape(log.action)}
                                 </span>
                             </td>
-                            <td>{log.table_name or '-'}</td>
-                            <td>{log.ip_address or '-'}</td>
+                            <td>{escape(log.table_name or '-')}</td>
+                            <td>{escape(log.ip_address or '-')}</td>
                             <td>
                                 <small class="text-muted">
-                                    {log.new_values[:100] if log.new_values else '-'}
+                                    {escape(log.new_values[:100] if log.new_values else '-')}
                                 </small>
                             </td>
                         </tr>
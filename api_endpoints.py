@@ -9,11 +9,24 @@ from flask import Blueprint, request, jsonify
 from database import db
 from database.models import VisitorCounter, VisitorData, Store, Alert
 from utils.auth import log_user_action
+from utils.http_cache import compute_etag, not_modified_response, set_cache_validators
+from utils.metrics import ONLINE_WINDOW
+from utils.pubsub import publish
+from utils.counter_state import update_counter_state
 
 logger = logging.getLogger(__name__)
 
 api_bp = Blueprint('api', __name__, url_prefix='/api')
 
+# Measurement settings sent to every device with its config
+DEVICE_SETTINGS = {
+    'measurement_interval': 100,  # milliseconds
+    'send_interval': 60000,       # milliseconds
+    'zone_threshold': 160,        # cm
+    'exit_threshold': 150,        # cm
+    'min_distance': 10           # cm
+}
+
 @api_bp.route('/visitor-count', methods=['POST'])
 def receive_visitor_count():
     """Receive visitor count data from Arduino devices"""
@@ -85,6 +98,8 @@ def receive_visitor_count():
             VisitorData.timestamp.desc()
         ).first()
         
+        was_offline = is_offline(last_entry)
+        
         # Calculate entries (difference from last count)
         if last_entry and last_entry.entries is not None:
             entries = max(0, count - last_entry.entries)
@@ -108,12 +123,15 @@ def receive_visitor_count():
         )
         
         db.session.add(visitor_data)
+        update_counter_state(visitor_data)
         
         # Check for alerts based on the data
-        create_alerts_if_needed(counter, visitor_data, data)
+        new_alerts = create_alerts_if_needed(counter, visitor_data, data)
         
         db.session.commit()
         
+        publish_ingest_events(counter, visitor_data, entries, was_offline, new_alerts)
+        
         logger.info(f"Received data from {device_id}: count={count}, entries={entries}")
         
         return jsonify({
@@ -160,6 +178,10 @@ def receive_device_status():
         if 'hardware_version' in data:
             counter.hardware_version = data['hardware_version']
         
+        was_offline = is_offline(VisitorData.query.filter_by(counter_id=counter.id).order_by(
+            VisitorData.timestamp.desc()
+        ).first())
+        
         # Create status entry
         status_data = VisitorData(
             counter_id=counter.id,
@@ -173,8 +195,16 @@ def receive_device_status():
         )
         
         db.session.add(status_data)
+        update_counter_state(status_data)
         db.session.commit()
         
+        if was_offline:
+            publish('status', {
+                'counter_id': counter.id,
+                'store_id': counter.store_id,
+                'online': True
+            }, counter_id=counter.id)
+        
         return jsonify({
             'status': 'success',
             'message': 'Status updated successfully'
@@ -200,26 +230,29 @@ def get_device_config(device_id):
                 'message': 'Device not found'
             }), 404
         
+        # Config version: the counter row, its store row and the settings
+        store = counter.store
+        etag = compute_etag(counter.id, counter.store_id, counter.updated_at, store.updated_at, DEVICE_SETTINGS)
+        last_modified = max([dt for dt in (counter.updated_at, store.updated_at) if dt], default=None)
+        cached = not_modified_response(etag, last_modified, private=False)
+        if cached is not None:
+            return cached
+        
         config = {
             'device_id': counter.device_id,
             'name': counter.name,
             'location': counter.location_description,
             'counter_type': counter.counter_type,
-            'store_name': counter.store.name,
+            'store_name': store.name,
             'active': counter.active,
-            'settings': {
-                'measurement_interval': 100,  # milliseconds
-                'send_interval': 60000,       # milliseconds
-                'zone_threshold': 160,        # cm
-                'exit_threshold': 150,        # cm
-                'min_distance': 10           # cm
-            }
+            'settings': DEVICE_SETTINGS
         }
         
-        return jsonify({
+        response = jsonify({
             'status': 'success',
             'config': config
-        }), 200
+        })
+        return set_cache_validators(response, etag, last_modified, private=False), 200
         
     except Exception as e:
         logger.error(f"Error getting device config: {e}")
@@ -232,6 +265,26 @@ def get_device_config(device_id):
 def list_devices():
     """List all registered devices"""
     try:
+        # Data version: counter/store config changes and the latest ingest
+        counters_version = db.session.query(
+            db.func.count(VisitorCounter.id),
+            db.func.max(VisitorCounter.updated_at)
+        ).one()
+        stores_version = db.session.query(db.func.max(Store.updated_at)).scalar()
+        ingest_version = db.session.query(
+            db.func.max(VisitorData.id),
+            db.func.max(VisitorData.created_at)
+        ).one()
+        
+        etag = compute_etag(tuple(counters_version), stores_version, ingest_version[0])
+        last_modified = max(
+            [dt for dt in (counters_version[1], stores_version, ingest_version[1]) if dt],
+            default=None
+        )
+        cached = not_modified_response(etag, last_modified, private=False)
+        if cached is not None:
+            return cached
+        
         counters = VisitorCounter.query.join(Store).all()
         
         devices = []
@@ -255,11 +308,12 @@ def list_devices():
             }
             devices.append(device_info)
         
-        return jsonify({
+        response = jsonify({
             'status': 'success',
             'devices': devices,
             'total': len(devices)
-        }), 200
+        })
+        return set_cache_validators(response, etag, last_modified, private=False), 200
         
     except Exception as e:
         logger.error(f"Error listing devices: {e}")
@@ -269,7 +323,8 @@ def list_devices():
         }), 500
 
 def create_alerts_if_needed(counter, visitor_data, raw_data):
-    """Create alerts based on visitor data analysis"""
+    """Create alerts based on visitor data analysis, return the new ones"""
+    created = []
     try:
         # Battery level alert
         if visitor_data.battery_level and visitor_data.battery_level < 20:
@@ -289,6 +344,7 @@ def create_alerts_if_needed(counter, visitor_data, raw_data):
                     is_resolved=False
                 )
                 db.session.add(alert)
+                created.append(alert)
         
         # Signal strength alert
         if visitor_data.signal_strength and visitor_data.signal_strength < 30:
@@ -308,6 +364,7 @@ def create_alerts_if_needed(counter, visitor_data, raw_data):
                     is_resolved=False
                 )
                 db.session.add(alert)
+                created.append(alert)
         
         # Device offline alert (if no data for more than 5 minutes)
         from datetime import timedelta
@@ -330,9 +387,54 @@ def create_alerts_if_needed(counter, visitor_data, raw_data):
                     is_resolved=False
                 )
                 db.session.add(alert)
+                created.append(alert)
         
     except Exception as e:
         logger.error(f"Error creating alerts: {e}")
+    
+    return created
+
+def is_offline(last_entry):
+    """Check whether a counter's latest entry is outside the online window"""
+    if not last_entry:
+        return True
+    last_seen = last_entry.timestamp
+    if last_seen.tzinfo is None:
+        last_seen = last_seen.replace(tzinfo=timezone.utc)
+    return datetime.now(timezone.utc) - last_seen > ONLINE_WINDOW
+
+def publish_ingest_events(counter, visitor_data, new_entries, was_offline, new_alerts):
+    """Publish live update events for a committed reading"""
+    try:
+        publish('entries', {
+            'counter_id': counter.id,
+            'store_id': counter.store_id,
+            'entries': visitor_data.entries,
+            'new_entries': new_entries,
+            'occupancy': visitor_data.current_occupancy,
+            'battery_level': visitor_data.battery_level,
+            'timestamp': visitor_data.timestamp.isoformat()
+        }, counter_id=counter.id)
+        
+        if was_offline:
+            publish('status', {
+                'counter_id': counter.id,
+                'store_id': counter.store_id,
+                'online': True
+            }, counter_id=counter.id)
+        
+        for alert in new_alerts:
+            publish('alert', {
+                'id': alert.id,
+                'counter_id': counter.id,
+                'store_id': counter.store_id,
+                'store_name': counter.store.name,
+                'severity': alert.severity,
+                'message': alert.message,
+                'created_at': alert.created_at.isoformat() if alert.created_at else None
+            }, counter_id=counter.id)
+    except Exception as e:
+        logger.error(f"Error publishing live updates: {e}")
 
 # Health check endpoint specifically for devices
 @api_bp.route('/health', methods=['GET'])
@@ -3,8 +3,11 @@
 Authentication routes and login system
 """
 
-from flask import Blueprint, request, render_template_string, redirect, url_for, session, flash, jsonify
-from utils.auth import authenticate_user, create_user_session, invalidate_session, validate_session
+from flask import Blueprint, request, redirect, url_for, session, flash, jsonify, g
+from sqlalchemy.orm import joinedload
+from utils.auth import authenticate_user, create_user_session, invalidate_session, verify_session, session_claims
+from utils.activity import record_activity
+from utils.templates import register_template, render_inline
 from database.models import User
 from database import db
 import logging
@@ -99,6 +102,7 @@ LOGIN_TEMPLATE = """
 </body>
 </html>
 """
+register_template('login', LOGIN_TEMPLATE)
 
 @auth_bp.route('/login', methods=['GET', 'POST'])
 def login():
@@ -107,14 +111,15 @@ def login():
         password = request.form.get('password', '')
         
         if not username or not password:
-            return render_template_string(LOGIN_TEMPLATE, error="Введите имя пользователя и пароль")
+            return render_inline('login', error="Введите имя пользователя и пароль")
         
         user = authenticate_user(username, password)
         if user:
-            session_token = create_user_session(user.id, request.remote_addr, request.headers.get('User-Agent'))
-            if session_token:
+            user_session = create_user_session(user.id, request.remote_addr, request.headers.get('User-Agent'))
+            if user_session:
                 session['user_id'] = user.id
-                session['session_token'] = session_token
+                session['session_token'] = user_session.session_token
+                session.update(session_claims(user_session))
                 session['username'] = user.username
                 session['role'] = user.role.name
                 session.permanent = True
@@ -122,12 +127,12 @@ def login():
                 logger.info(f"User {username} logged in successfully")
                 return redirect(url_for('dashboard'))
             else:
-                return render_template_string(LOGIN_TEMPLATE, error="Ошибка создания сессии")
+                return render_inline('login', error="Ошибка создания сессии")
         else:
             logger.warning(f"Failed login attempt for username: {username}")
-            return render_template_string(LOGIN_TEMPLATE, error="Неверное имя пользователя или пароль")
+            return render_inline('login', error="Неверное имя пользователя или пароль")
     
-    return render_template_string(LOGIN_TEMPLATE)
+    return render_inline('login')
 
 @auth_bp.route('/logout')
 def logout():
@@ -148,11 +153,13 @@ def login_required(f):
             return redirect(url_for('auth.login'))
         
         # Validate session
-        user = validate_session(session['session_token'])
-        if not user:
+        if not verify_session(session):
             session.clear()
             return redirect(url_for('auth.login'))
         
+        # Buffered in memory and written in batches by the activity worker
+        record_activity(session['user_id'], session['session_id'])
+        
         return f(*args, **kwargs)
     
     return decorated_function
@@ -173,7 +180,9 @@ def admin_required(f):
     return decorated_function
 
 def get_current_user():
-    """Get current logged in user"""
-    if 'user_id' in session:
-        return User.query.get(session['user_id'])
-    return None
\ No newline at end of file
+    """Get current logged in user with its role, loaded once per request"""
+    if 'current_user' not in g:
+        g.current_user = None
+        if 'user_id' in session:
+            g.current_user = User.query.options(joinedload(User.role)).filter_by(id=session['user_id']).first()
+    return g.current_user
\ No newline at end of file
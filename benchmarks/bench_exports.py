@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+"""
+Benchmark: peak memory and time of the XLSX export, in-memory vs streaming writer
+
+With DATABASE_URL set, also compares export throughput (rows/s) of the
+streaming XLSX path and the COPY-based CSV/gzip path on real data.
+"""
+
+import io
+import os
+import sys
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+# Add path for imports
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import xlsxwriter
+from utils.exports import (EXPORT_BATCH_SIZE, EXPORT_HEADERS, create_export_file, remove_file, write_xlsx_export,
+                           export_query, export_totals, stream_csv_gzip)
+
+ROW_COUNTS = [int(n) for n in os.environ.get("BENCH_ROWS", "10000,50000,100000").split(",")]
+EXPORT_DAYS = int(os.environ.get("BENCH_DAYS", "30"))
+
+def sample_rows(count):
+    """Yield export rows without a database, like a server-side cursor would"""
+    start = datetime(2024, 1, 1)
+    for i in range(count):
+        yield SimpleNamespace(timestamp=start + timedelta(minutes=i), store_name=f'Магазин {i % 40}',
+                              counter_name=f'Счетчик {i % 400}', entries=i % 17, exits=i % 13,
+                              current_occupancy=i % 90)
+
+def in_memory_export(count):
+    """The previous export: all rows in a list, workbook in BytesIO"""
+    rows = list(sample_rows(count))
+    output = io.BytesIO()
+    workbook = xlsxwriter.Workbook(output, {'in_memory': True})
+    worksheet = workbook.add_worksheet('Данные посетителей')
+    for col, header in enumerate(EXPORT_HEADERS):
+        worksheet.write(0, col, header)
+    for row_num, row in enumerate(rows, 1):
+        worksheet.write(row_num, 0, row.timestamp.strftime('%Y-%m-%d %H:%M:%S'))
+        worksheet.write(row_num, 1, row.store_name)
+        worksheet.write(row_num, 2, row.counter_name)
+        worksheet.write(row_num, 3, row.entries)
+        worksheet.write(row_num, 4, row.exits)
+        worksheet.write(row_num, 5, row.current_occupancy)
+    workbook.close()
+    return len(output.getvalue())
+
+def streaming_export(count):
+    """The streaming export: rows from a generator, constant_memory workbook in a temp file"""
+    path = create_export_file('.xlsx')
+    try:
+        write_xlsx_export(path, sample_rows(count), [['Всего записей', count]])
+        return os.path.getsize(path)
+    finally:
+        remove_file(path)
+
+def measure(export, count):
+    tracemalloc.start()
+    started = time.perf_counter()
+    size = export(count)
+    elapsed = time.perf_counter() - started
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return elapsed, peak / 1024 / 1024, size
+
+def database_throughput():
+    """Export the last EXPORT_DAYS of all counters through both paths"""
+    from app import create_app
+    from database import db
+    from database.models import VisitorCounter
+
+    app = create_app()
+    with app.app_context():
+        counter_ids = [row.id for row in db.session.query(VisitorCounter.id).all()]
+        start_date = datetime.now() - timedelta(days=EXPORT_DAYS)
+        rows, _ = export_totals(counter_ids, start_date)
+        if not rows:
+            print("No visitor data in the period")
+            return
+
+        def xlsx():
+            path = create_export_file('.xlsx')
+            try:
+                write_xlsx_export(path, export_query(counter_ids, start_date).yield_per(EXPORT_BATCH_SIZE), [])
+                return os.path.getsize(path)
+            finally:
+                remove_file(path)
+
+        def csv_gzip():
+            return sum(len(chunk) for chunk in stream_csv_gzip(counter_ids, start_date))
+
+        csv_path = 'csv/gzip (COPY)' if db.engine.dialect.name == 'postgresql' else 'csv/gzip (rows)'
+        print(f"\n{rows} rows, last {EXPORT_DAYS} days, {db.engine.dialect.name}")
+        print(f"{'path':<16} {'time, s':>9} {'rows/s':>10} {'file, MB':>10}")
+        for name, export in (('xlsx', xlsx), (csv_path, csv_gzip)):
+            started = time.perf_counter()
+            size = export()
+            elapsed = time.perf_counter() - started
+            print(f"{name:<16} {elapsed:>9.2f} {rows / elapsed:>10.0f} {size / 1024 / 1024:>10.1f}")
+
+def main():
+    print(f"{'rows':>8} {'writer':<10} {'time, s':>9} {'rows/s':>10} {'peak, MB':>10} {'file, MB':>10}")
+    for count in ROW_COUNTS:
+        for name, export in (('in-memory', in_memory_export), ('streaming', streaming_export)):
+            elapsed, peak_mb, size = measure(export, count)
+            print(f"{count:>8} {name:<10} {elapsed:>9.2f} {count / elapsed:>10.0f} {peak_mb:>10.1f} "
+                  f"{size / 1024 / 1024:>10.1f}")
+
+    if os.environ.get("DATABASE_URL"):
+        database_throughput()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmark: per-render cost of render_template_string vs precompiled templates
+"""
+
+import os
+import sys
+import timeit
+from datetime import datetime
+from types import SimpleNamespace
+
+# Add path for imports
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flask import Flask, render_template_string
+from auth_routes import LOGIN_TEMPLATE
+from admin_interface import ADMIN_TEMPLATE, USERS_TAB
+from email_reports import EMAIL_TEMPLATE
+from utils.templates import compile_templates, render_inline
+
+ITERATIONS = int(os.environ.get("BENCH_ITERATIONS", "200"))
+
+def sample_contexts():
+    """Build template contexts with fake objects, no database required"""
+    role = SimpleNamespace(id=1, name='admin', description='Администратор')
+    users = [
+        SimpleNamespace(id=i, username=f'user{i}', email=f'user{i}@example.com', full_name=f'Пользователь {i}',
+                        role=role, active=True, last_login=datetime(2024, 1, 1), created_at=datetime(2024, 1, 1))
+        for i in range(50)
+    ]
+    current_user = SimpleNamespace(username='admin', role=role)
+    counter = SimpleNamespace(name='Вход 1')
+    alerts = [
+        SimpleNamespace(alert_type='device_offline', message='Устройство не отвечает', severity='high',
+                        counter=counter, created_at=datetime(2024, 1, 1))
+        for i in range(10)
+    ]
+    logs = [SimpleNamespace(action='login', user=users[0], timestamp=datetime(2024, 1, 1)) for i in range(5)]
+    stats = {'users': 50, 'stores': 3, 'counters': 6, 'alerts': 10}
+    summary = {'period_start': '2024-01-01', 'period_end': '2024-01-07', 'total_visitors': 12345,
+               'total_stores': 3, 'total_counters': 6, 'avg_occupancy': 42.5}
+
+    return {
+        'login': (LOGIN_TEMPLATE, {'error': 'Неверное имя пользователя или пароль'}),
+        'admin_users_tab': (USERS_TAB, {'users': users, 'roles': [role], 'current_user': current_user}),
+        'admin': (ADMIN_TEMPLATE, {'current_user': current_user, 'active_tab': 'dashboard', 'stats': stats,
+                                   'recent_alerts': alerts[:5], 'recent_logs': logs, 'tab_content': None}),
+        'report_email': (EMAIL_TEMPLATE, {'summary': summary, 'recent_alerts': alerts,
+                                          'generation_time': '2024-01-01 00:00:00'}),
+    }
+
+def main():
+    app = Flask(__name__)
+    app.secret_key = 'bench'
+    compile_templates(app)
+
+    print(f"{'template':<18} {'string, ms':>12} {'compiled, ms':>14} {'speedup':>9}")
+    with app.test_request_context('/'):
+        for name, (source, context) in sample_contexts().items():
+            before = timeit.timeit(lambda: render_template_string(source, **context), number=ITERATIONS)
+            after = timeit.timeit(lambda: render_inline(name, **context), number=ITERATIONS)
+            before_ms = before / ITERATIONS * 1000
+            after_ms = after / ITERATIONS * 1000
+            print(f"{name:<18} {before_ms:>12.3f} {after_ms:>14.3f} {before_ms / after_ms:>8.1f}x")
+
+if __name__ == '__main__':
+    main()
@@ -2,11 +2,14 @@ import dash
 from dash import dcc, html, Input, Output, State, callback_context, ALL
 import dash_bootstrap_components as dbc
 from dash.exceptions import PreventUpdate
+import plotly.graph_objects as go
 import pandas as pd
 from datetime import datetime, timedelta
 from database import db
 from database.models import User, Role, Store, VisitorCounter, Alert, AuditLog
 from utils.auth import hash_password
+from utils.profiling import (instrument_callbacks, get_callback_stats, reset_callback_stats,
+                             stats_process_id, TIME_BUCKETS_MS)
 import logging
 
 logger = logging.getLogger(__name__)
@@ -436,6 +439,21 @@ def system_tab_content():
             ], width=6)
         ], className="mb-4"),
         
+        dbc.Row([
+            dbc.Col([
+                dbc.Card([
+                    dbc.CardHeader([
+                        "Callbacks дашборда",
+                        dbc.ButtonGroup([
+                            dbc.Button("Обновить", id="performance-refresh-button", color="primary", size="sm", outline=True),
+                            dbc.Button("Сбросить", id="performance-reset-button", color="secondary", size="sm", outline=True)
+                        ], className="float-end")
+                    ]),
+                    dbc.CardBody(id="callback-profile")
+                ])
+            ], width=12)
+        ], className="mb-4"),
+        
         dbc.Row([
             dbc.Col([
                 dbc.Card([
@@ -456,6 +474,9 @@ def system_tab_content():
 def register_callbacks(app):
     """Register admin panel callbacks"""
     
+    # Time every server-side callback registered below
+    instrument_callbacks(app)
+    
     @app.callback(
         Output('admin-tab-content', 'children'),
         Input('admin-tabs', 'value')
@@ -647,3 +668,99 @@ def register_callbacks(app):
         except Exception as e:
             logger.error(f"Error updating system stats: {e}")
             return dbc.Alert("Ошибка загрузки статистики", color="danger")
+    
+    @app.callback(
+        [Output('system-performance', 'children'),
+         Output('callback-profile', 'children')],
+        [Input('admin-tabs', 'value'),
+         Input('performance-refresh-button', 'n_clicks'),
+         Input('performance-reset-button', 'n_clicks')]
+    )
+    def update_callback_profile(active_tab, refresh_clicks, reset_clicks):
+        """Show per-callback timing histograms collected by this worker"""
+        if active_tab != 'system-tab':
+            return "", ""
+        
+        try:
+            triggered = [t['prop_id'] for t in callback_context.triggered]
+            if 'performance-reset-button.n_clicks' in triggered:
+                reset_callback_stats()
+            
+            stats = get_callback_stats()
+            summary = [
+                html.P([html.Strong("Процесс: "), f"PID {stats_process_id()}"]),
+                html.P([html.Strong("Вызовов callbacks: "), str(sum(s['calls'] for s in stats))]),
+                html.P([html.Strong("Ошибок: "), str(sum(s['errors'] for s in stats))]),
+                html.P([html.Strong("Время в callbacks: "), f"{sum(s['wall_ms'] for s in stats) / 1000:.1f} с"]),
+                html.P([html.Strong("SQL запросов: "), str(sum(s['sql_queries'] for s in stats))])
+            ]
+            if stats:
+                summary.append(html.P([html.Strong("Больше всего времени: "), stats[0]['name']]))
+            
+            if not stats:
+                return summary, dbc.Alert("Данных пока нет", color="info")
+            
+            def format_ms(value):
+                return f"≤{value}" if value is not None else f">{TIME_BUCKETS_MS[-1]}"
+            
+            # One histogram row per callback, slowest total time on top
+            bucket_labels = [f"≤{bound}" for bound in TIME_BUCKETS_MS] + [f">{TIME_BUCKETS_MS[-1]}"]
+            names = [s['name'] for s in reversed(stats)]
+            heatmap = go.Figure(go.Heatmap(
+                z=[s['histogram'] for s in reversed(stats)],
+                x=bucket_labels,
+                y=names,
+                colorscale='Reds',
+                hovertemplate="%{y}<br>%{x} мс: %{z} вызовов<extra></extra>"
+            ))
+            heatmap.update_layout(
+                template="plotly_dark",
+                paper_bgcolor='rgba(0,0,0,0)',
+                plot_bgcolor='rgba(0,0,0,0)',
+                xaxis_title="Время выполнения, мс",
+                height=max(250, 40 * len(names) + 120),
+                margin=dict(l=10, r=10, t=10, b=40)
+            )
+            
+            rows = [
+                html.Tr([
+                    html.Td(s['name']),
+                    html.Td(s['calls']),
+                    html.Td(s['errors']),
+                    html.Td(f"{s['avg_ms']:.0f}"),
+                    html.Td(format_ms(s['p95_ms'])),
+                    html.Td(f"{s['max_ms']:.0f}"),
+                    html.Td(f"{s['avg_sql_queries']:.1f}"),
+                    html.Td(f"{s['avg_sql_ms']:.0f}"),
+                    html.Td(f"{s['avg_rows']:.0f}"),
+                    html.Td(f"{s['avg_output_bytes'] / 1024:.1f}")
+                ])
+                for s in stats
+            ]
+            table = dbc.Table([
+                html.Thead([
+                    html.Tr([
+                        html.Th("Callback"),
+                        html.Th("Вызовы"),
+                        html.Th("Ошибки"),
+                        html.Th("Среднее, мс"),
+                        html.Th("p95, мс"),
+                        html.Th("Макс, мс"),
+                        html.Th("SQL запросов"),
+                        html.Th("SQL, мс"),
+                        html.Th("Строк"),
+                        html.Th("Ответ, КБ")
+                    ])
+                ]),
+                html.Tbody(rows)
+            ], striped=True, bordered=True, hover=True, size="sm", responsive=True)
+            
+            return summary, [
+                dcc.Graph(figure=heatmap, config={'displayModeBar': False}),
+                html.Small("SQL, строки и размер ответа — средние за вызов", className="text-muted"),
+                table
+            ]
+            
+        except Exception as e:
+            logger.error(f"Error updating callback profile: {e}")
+            return dbc.Alert("Ошибка загрузки статистики", color="danger"), ""
@@ -1,17 +1,231 @@
+import os
+import re
+import json
+import tempfile
+from contextlib import contextmanager
 import dash
-from dash import dcc, html, Input, Output, State, callback_context
+import diskcache
+from flask import current_app
+from itsdangerous import URLSafeSerializer, BadSignature
+from dash import dcc, html, dash_table, Input, Output, State, Patch, DiskcacheManager, callback_context
 import dash_bootstrap_components as dbc
 import plotly.express as px
 import plotly.graph_objects as go
 from plotly.subplots import make_subplots
 import pandas as pd
-from datetime import datetime, timedelta
+from datetime import date, datetime, timedelta
 from database import db
-from database.models import VisitorData, VisitorCounter, Store, Alert
+from database.models import VisitorData, VisitorCounter, Store, Alert, CounterState
+from auth_routes import get_current_user
+from utils.auth import get_user_accessible_counters, get_user_accessible_stores
+from utils.downsample import lttb_indices
+from utils.precompute import scope_key
+from utils.profiling import instrument_callbacks
 import logging
 
 logger = logging.getLogger(__name__)
 
+# Background callbacks (export, long-range trend) run in worker processes;
+# their results are memoized on disk by inputs and data version
+DASH_CACHE_DIR = os.environ.get("DASH_CACHE_DIR", os.path.join(tempfile.gettempdir(), "dashboard_dash_cache"))
+DASH_CACHE_EXPIRE = int(os.environ.get("DASH_CACHE_EXPIRE", "3600"))
+
+# Rows read per batch by the export, progress is reported after each batch
+EXPORT_CHUNK_SIZE = 5000
+
+# Minimum seconds between live refreshes, so busy scopes coalesce updates
+LIVE_REFRESH_MIN_INTERVAL = 10
+
+# Opens one EventSource per page and bumps live-version when an event for the
+# selected store (or the whole scope) arrived since the last refresh
+LIVE_VERSION_JS = """
+function(pollTick, fallbackTick, storeId, version) {
+    const live = window.dashboardLive = window.dashboardLive || {pending: {}, lastRefresh: 0};
+    if (!live.source && window.EventSource) {
+        live.source = new EventSource('/api/stream');
+        ['metrics', 'entries', 'status', 'alert'].forEach(function(type) {
+            live.source.addEventListener(type, function(e) {
+                const data = JSON.parse(e.data);
+                live.pending[data.store_id === undefined ? 'all' : data.store_id] = true;
+            });
+        });
+    }
+
+    const triggered = dash_clientside.callback_context.triggered.map(t => t.prop_id);
+    const fallback = triggered.includes('interval-component.n_intervals');
+    const changed = storeId ? (live.pending[storeId] || live.pending.all) : Object.keys(live.pending).length > 0;
+    const now = Date.now();
+    if (!fallback && (!changed || now - live.lastRefresh < __MIN_REFRESH_MS__)) {
+        return dash_clientside.no_update;
+    }
+
+    live.pending = {};
+    live.lastRefresh = now;
+    return (version || 0) + 1;
+}
+"""
+
+# Shared by the clientside callbacks below: pick dataset rows for a
+# selection and sum them into buckets (occupancy is averaged per sample).
+# Dataset hours are offsets from midnight of dataset.base
+DATASET_HELPERS_JS = """
+    function hourOffset(dataset, day) {
+        return (Date.parse(day + 'T00:00:00Z') - Date.parse(dataset.base + 'T00:00:00Z')) / 3600000;
+    }
+
+    function hourLabel(dataset, offset) {
+        return new Date(Date.parse(dataset.base + 'T00:00:00Z') + offset * 3600000).toISOString().slice(0, 19);
+    }
+
+    function selectRows(dataset, storeId, counterId, fromDay, toDay) {
+        const from = fromDay ? hourOffset(dataset, fromDay) : -Infinity;
+        const to = toDay ? hourOffset(dataset, toDay) + 24 : Infinity;
+        const rows = [];
+        for (let i = 0; i < dataset.hour.length; i++) {
+            const counter = dataset.counter[i];
+            if (counterId && counter !== counterId) continue;
+            if (storeId && dataset.stores[counter] !== storeId) continue;
+            if (dataset.hour[i] < from || dataset.hour[i] >= to) continue;
+            rows.push(i);
+        }
+        return rows;
+    }
+
+    function aggregate(dataset, rows, keyOf) {
+        const buckets = new Map();
+        rows.forEach(function(i) {
+            const key = keyOf(hourLabel(dataset, dataset.hour[i]));
+            const bucket = buckets.get(key) || {entries: 0, exits: 0, occupancy: 0, samples: 0};
+            bucket.entries += dataset.entries[i];
+            bucket.exits += dataset.exits[i];
+            bucket.occupancy += dataset.occupancy[i];
+            bucket.samples += dataset.samples[i];
+            buckets.set(key, bucket);
+        });
+        const keys = Array.from(buckets.keys()).sort((a, b) => a < b ? -1 : (a > b ? 1 : 0));
+        return {
+            hours: keys,
+            entries: keys.map(k => buckets.get(k).entries),
+            exits: keys.map(k => buckets.get(k).exits),
+            occupancy: keys.map(k => Math.round(buckets.get(k).occupancy / buckets.get(k).samples * 10) / 10)
+        };
+    }
+
+    function fillFigure(template, series) {
+        const fig = JSON.parse(JSON.stringify(template));
+        series.forEach(function(s, trace) {
+            fig.data[trace].x = s[0];
+            fig.data[trace].y = s[1];
+        });
+        return fig;
+    }
+"""
+
+# Asks the server for a trend only when the range starts before the dataset
+# window; zooming such a chart asks again for the visible part only
+TREND_REQUEST_JS = """
+function(storeId, counterId, startDate, endDate, relayout, meta, current) {
+    if (!meta) {
+        return dash_clientside.no_update;
+    }
+    const start = startDate ? startDate.slice(0, 10) : null;
+    if (start && start >= meta.start) {
+        return current ? null : dash_clientside.no_update;
+    }
+
+    let zoom = null;
+    const triggered = dash_clientside.callback_context.triggered.map(t => t.prop_id);
+    if (triggered.includes('visitor-trend-chart.relayoutData') && relayout) {
+        const range = relayout['xaxis.range'] || relayout['xaxis2.range'] ||
+            [relayout['xaxis.range[0]'] || relayout['xaxis2.range[0]'],
+             relayout['xaxis.range[1]'] || relayout['xaxis2.range[1]']];
+        if (range[0] && range[1]) {
+            zoom = [range[0], range[1]];
+        } else if (!relayout['xaxis.autorange'] && !relayout['xaxis2.autorange']) {
+            return dash_clientside.no_update;
+        }
+    }
+
+    const graph = document.getElementById('visitor-trend-chart');
+    const request = {store_id: storeId || null, counter_id: counterId || null,
+                     start: start, end: endDate ? endDate.slice(0, 10) : null,
+                     zoom: zoom, width: graph ? graph.offsetWidth : null};
+    return JSON.stringify(request) === JSON.stringify(current) ? dash_clientside.no_update : request;
+}
+"""
+
+TREND_FIGURE_JS = """
+function(dataset, longTrend, storeId, counterId, startDate, endDate, meta, templates) {
+    __HELPERS__
+    const start = startDate ? startDate.slice(0, 10) : null;
+    const end = endDate ? endDate.slice(0, 10) : null;
+    let trend;
+    if (dataset && meta && start && start >= meta.start) {
+        trend = aggregate(dataset, selectRows(dataset, storeId, counterId, start, end), hour => hour);
+    } else if (longTrend && longTrend.request.start === start && longTrend.request.end === end &&
+               longTrend.request.store_id === (storeId || null) && longTrend.request.counter_id === (counterId || null)) {
+        // Already downsampled on the server, one [x, y] pair per trace
+        return longTrend.points ? fillFigure(templates.trend, longTrend.traces) : templates.trend_empty;
+    } else {
+        return dash_clientside.no_update;
+    }
+    if (!trend.hours.length) {
+        return templates.trend_empty;
+    }
+    return fillFigure(templates.trend, [
+        [trend.hours, trend.entries], [trend.hours, trend.exits], [trend.hours, trend.occupancy]
+    ]);
+}
+"""
+
+HOURLY_FIGURE_JS = """
+function(dataset, snapshot, storeId, counterId, templates) {
+    __HELPERS__
+    if (!dataset || !snapshot) {
+        return dash_clientside.no_update;
+    }
+    const rows = selectRows(dataset, storeId, counterId, snapshot.today, snapshot.today);
+    const hourly = aggregate(dataset, rows, hour => Number(hour.slice(11, 13)));
+    if (!hourly.hours.length) {
+        return templates.hourly_empty;
+    }
+    return fillFigure(templates.hourly, [[hourly.hours, hourly.occupancy]]);
+}
+"""
+
+METRICS_JS = """
+function(dataset, snapshot, storeId) {
+    __HELPERS__
+    if (!dataset || !snapshot) {
+        return ['0', '0', '0', '0'];
+    }
+    const today = aggregate(dataset, selectRows(dataset, storeId, null, snapshot.today, snapshot.today), hour => 0);
+    const counters = snapshot.counters.filter(c => c.is_online && (!storeId || c.store_id === storeId));
+    const alerts = storeId ? (snapshot.alert_counts[storeId] || 0) :
+        Object.values(snapshot.alert_counts).reduce((a, b) => a + b, 0);
+    const format = n => Number(n).toLocaleString('en-US');
+    return [
+        format(today.entries.length ? today.entries[0] : 0),
+        format(counters.reduce((sum, c) => sum + (c.current_occupancy || 0), 0)),
+        String(alerts),
+        String(counters.length)
+    ];
+}
+"""
+
+COUNTER_OPTIONS_JS = """
+function(storeId, snapshot, currentCounter) {
+    if (!storeId || !snapshot) {
+        return [[], null];
+    }
+    const options = snapshot.counters.filter(c => c.store_id === storeId).map(c => ({label: c.name, value: c.id}));
+    const triggered = dash_clientside.callback_context.triggered.map(t => t.prop_id);
+    const keep = !triggered.includes('store-filter.value') && options.some(o => o.value === currentCounter);
+    return [options, keep ? currentCounter : null];
+}
+"""
+
+
 def layout():
     """Main dashboard layout"""
     return html.Div([
@@ -119,10 +333,21 @@ def layout():
                             "Экспорт",
                             id="export-button",
                             color="secondary",
-                            outline=True
+                            outline=True,
+                            className="me-2"
+                        ),
+                        dbc.Button(
+                            html.I(className="fas fa-times"),
+                            id="cancel-export-button",
+                            color="danger",
+                            outline=True,
+                            disabled=True,
+                            title="Отменить экспорт"
                         )
                     ], width=2, className="d-flex align-items-end")
-                ])
+                ]),
+                dbc.Progress(id="export-progress", value=0, max=1, striped=True, animated=True,
+                             className="mt-2", style={"visibility": "hidden"})
             ])
         ], className="mb-4"),
         
@@ -131,7 +356,8 @@ def layout():
             dbc.Col([
                 dbc.Card([
                     dbc.CardHeader([
-                        html.H5("Динамика посещений", className="mb-0")
+                        html.H5("Динамика посещений", className="mb-0 d-inline"),
+                        html.Small(id="trend-status", className="text-muted ms-2")
                     ]),
                     dbc.CardBody([
                         dcc.Graph(id="visitor-trend-chart", style={"height": "400px"})
@@ -159,7 +385,33 @@ def layout():
                         html.H5("Текущие данные по счетчикам", className="mb-0")
                     ]),
                     dbc.CardBody([
-                        html.Div(id="counters-table")
+                        dash_table.DataTable(
+                            id="counters-table",
+                            columns=COUNTER_COLUMNS,
+                            # Paging, sorting and filtering run on the server, one page at a time
+                            page_action='custom',
+                            page_current=0,
+                            page_size=COUNTERS_PAGE_SIZE,
+                            sort_action='custom',
+                            sort_mode='single',
+                            sort_by=[],
+                            filter_action='custom',
+                            filter_query='',
+                            style_table={'overflowX': 'auto'},
+                            style_header={'backgroundColor': '#343a40', 'color': 'white', 'fontWeight': 'bold'},
+                            style_filter={'backgroundColor': '#2b3035', 'color': 'white'},
+                            style_cell={'backgroundColor': '#212529', 'color': 'white', 'textAlign': 'left',
+                                        'border': '1px solid #495057', 'padding': '4px 8px'},
+                            style_data_conditional=[
+                                {'if': {'filter_query': f'{{status}} = "{STATUS_ONLINE}"', 'column_id': 'status'},
+                                 'color': '#28a745'},
+                                {'if': {'filter_query': f'{{status}} = "{STATUS_OFFLINE}"', 'column_id': 'status'},
+                                 'color': '#dc3545'},
+                                {'if': {'filter_query': '{battery_level} < 30', 'column_id': 'battery_level'},
+                                 'color': '#ffc107'}
+                            ]
+                        ),
+                        dcc.Store(id='counters-cursors')
                     ])
                 ])
             ], width=8),
@@ -176,10 +428,29 @@ def layout():
             ], width=4),
         ]),
         
-        # Auto-refresh interval
+        # Live updates: a browser-side EventSource bumps live-version when data
+        # in scope changes; interval-component is only a slow safety net
+        dcc.Store(id='live-version', data=0),
+        # Latest counter readings and alerts, computed once per tick
+        dcc.Store(id='dashboard-snapshot'),
+        # Hourly per-counter buckets of the whole scope, filtered in the browser;
+        # dataset-meta tracks its window and last hour for incremental ticks
+        dcc.Store(id='scope-dataset'),
+        dcc.Store(id='dataset-meta'),
+        # Signed counter ids of the user's scope, for background callbacks
+        dcc.Store(id='dashboard-scope'),
+        # Server-side trend for ranges older than the dataset window
+        dcc.Store(id='trend-request'),
+        dcc.Store(id='long-trend'),
+        dcc.Store(id='chart-templates', data=chart_templates()),
+        dcc.Interval(
+            id='live-poll',
+            interval=2*1000,  # Checked in the browser, no server round trip
+            n_intervals=0
+        ),
         dcc.Interval(
             id='interval-component',
-            interval=30*1000,  # Update every 30 seconds
+            interval=5*60*1000,  # Fallback full refresh every 5 minutes
             n_intervals=0
         ),
         
@@ -187,21 +458,587 @@ def layout():
         dcc.Download(id="download-data")
     ])
 
+SEVERITY_COLORS = {
+    'low': 'info',
+    'medium': 'warning',
+    'high': 'danger',
+    'critical': 'danger'
+}
+
+# Days of hourly per-counter buckets shipped to the browser once; filtering
+# inside this window happens clientside, earlier dates go to the server
+DATASET_DAYS = 31
+
+# Unresolved alerts kept in the snapshot for clientside store filtering
+SNAPSHOT_ALERTS_LIMIT = 200
+
+# Hours before the newest bucket that live ticks re-read, so late readings land
+DATASET_LOOKBACK_HOURS = 2
+
+DATASET_COLUMNS = ['entries', 'exits', 'occupancy', 'samples']
+
+# Counters status table: rows per page and columns
+COUNTERS_PAGE_SIZE = 25
+COUNTER_COLUMNS = [
+    {'name': 'Счетчик', 'id': 'name'},
+    {'name': 'Магазин', 'id': 'store_name'},
+    {'name': 'Заполненность', 'id': 'current_occupancy', 'type': 'numeric'},
+    {'name': 'Последние данные', 'id': 'last_seen'},
+    {'name': 'Статус', 'id': 'status'},
+    {'name': 'Батарея, %', 'id': 'battery_level', 'type': 'numeric'}
+]
+STATUS_ONLINE = "Онлайн"
+STATUS_OFFLINE = "Офлайн"
+STATUS_NO_DATA = "Нет данных"
+
+# Points per trace for server-side trends: the chart width in pixels, clamped
+TREND_DEFAULT_POINTS = 1000
+TREND_MIN_POINTS = 100
+TREND_MAX_POINTS = 3000
+
+def _filter_scope(query, store_id, counter_id=None):
+    """Limit a VisitorData query joined with VisitorCounter to the selected store/counter"""
+    if store_id:
+        query = query.filter(VisitorCounter.store_id == store_id)
+    if counter_id:
+        query = query.filter(VisitorData.counter_id == counter_id)
+    return query
+
+def dataset_start():
+    """First day of the clientside dataset window"""
+    return (datetime.now().date() - timedelta(days=DATASET_DAYS)).isoformat()
+
+def scope_counter_ids():
+    """Ids of the counters visible to the logged in user"""
+    return sorted(counter.id for counter in get_user_accessible_counters(get_current_user()))
+
+def _scope_serializer():
+    return URLSafeSerializer(current_app.secret_key, salt='dashboard-scope')
+
+def scope_token(counter_ids):
+    """Signed scope for background callbacks, which run without the user's session"""
+    return _scope_serializer().dumps(counter_ids)
+
+def scope_from_token(token):
+    """Counter ids of a signed scope; empty when missing or tampered with"""
+    if not token:
+        return []
+    try:
+        return _scope_serializer().loads(token)
+    except BadSignature:
+        return []
+
+def query_hourly_buckets(since=None, until=None, store_id=None, counter_id=None, by_counter=True, counter_ids=None):
+    """Hourly entries/exits sums and occupancy sum/sample count, per counter or for the whole selection
+
+    Aggregated in SQL; rows carry day and hour, plus counter and store when by_counter.
+    """
+    keys = [db.func.date(VisitorData.timestamp).label('day'),
+            db.func.extract('hour', VisitorData.timestamp).label('hour')]
+    if by_counter:
+        keys += [VisitorData.counter_id.label('counter'), VisitorCounter.store_id.label('store')]
+    query = _filter_scope(
+        db.session.query(
+            *keys,
+            db.func.sum(VisitorData.entries).label('entries'),
+            db.func.sum(VisitorData.exits).label('exits'),
+            db.func.sum(VisitorData.current_occupancy).label('occupancy'),
+            db.func.count(VisitorData.current_occupancy).label('samples')
+        ).join(VisitorCounter),
+        store_id, counter_id
+    )
+    if counter_ids is not None:
+        query = query.filter(VisitorData.counter_id.in_(counter_ids))
+    if since:
+        query = query.filter(VisitorData.timestamp >= since)
+    if until:
+        query = query.filter(VisitorData.timestamp < until)
+    return query.group_by(*keys).order_by(*keys).all()
+
+def _hour_offset(row, base):
+    """Hours from midnight of the base day to the bucket of a row"""
+    return (date.fromisoformat(str(row.day)) - base).days * 24 + int(row.hour)
+
+def _bucket_values(row):
+    return [int(getattr(row, column) or 0) for column in DATASET_COLUMNS]
+
+def build_dataset(counter_ids):
+    """Columnar hourly per-counter buckets of the user's counters, plus its meta record
+
+    Hours are integer offsets from midnight of the first day (dataset['base']).
+    """
+    start = dataset_start()
+    base = date.fromisoformat(start)
+    dataset = {'base': start, 'hour': [], 'counter': [], 'stores': {}}
+    for column in DATASET_COLUMNS:
+        dataset[column] = []
+    
+    for row in query_hourly_buckets(since=datetime.fromisoformat(start), counter_ids=counter_ids):
+        dataset['hour'].append(_hour_offset(row, base))
+        dataset['counter'].append(row.counter)
+        dataset['stores'][str(row.counter)] = row.store
+        for column, value in zip(DATASET_COLUMNS, _bucket_values(row)):
+            dataset[column].append(value)
+    
+    count = len(dataset['hour'])
+    meta = {'start': start, 'scope': scope_key(counter_ids), 'count': count, 'last_hour': None, 'tail': {}}
+    if count:
+        meta['last_hour'] = dataset['hour'][-1]
+        meta['tail'] = _dataset_tail(dataset['hour'][-1], {
+            f"{dataset['hour'][i]}|{dataset['counter'][i]}": [i] + [dataset[column][i] for column in DATASET_COLUMNS]
+            for i in range(count)
+        })
+    return dataset, meta
+
+def _dataset_tail(last_hour, rows):
+    """Keep only the rows live ticks may still rewrite"""
+    since = last_hour - DATASET_LOOKBACK_HOURS
+    return {key: row for key, row in rows.items() if int(key.split('|')[0]) >= since}
+
+def patch_dataset(meta, counter_ids):
+    """Patch for the clientside dataset with the buckets of the last few hours
+
+    Recent rows (tracked in meta['tail'] by "hour|counter" with their index
+    and values) are rewritten in place when they changed, newer rows are
+    appended. Returns (patch, new_meta), or (no_update, meta).
+    """
+    base = date.fromisoformat(meta['start'])
+    since = 0
+    if meta['last_hour'] is not None:
+        since = max(meta['last_hour'] - DATASET_LOOKBACK_HOURS, 0)
+    buckets = query_hourly_buckets(since=datetime.fromisoformat(meta['start']) + timedelta(hours=since),
+                                   counter_ids=counter_ids)
+    patch = Patch()
+    changed = False
+    count = meta['count']
+    last_hour = meta['last_hour']
+    tail = dict(meta['tail'])
+    
+    for row in buckets:
+        hour = _hour_offset(row, base)
+        key = f"{hour}|{row.counter}"
+        values = _bucket_values(row)
+        
+        if key in tail:
+            index = tail[key][0]
+            for column, value, old in zip(DATASET_COLUMNS, values, tail[key][1:]):
+                if value != old:
+                    patch[column][index] = value
+                    changed = True
+            tail[key] = [index] + values
+            continue
+        
+        patch['hour'].append(hour)
+        patch['counter'].append(row.counter)
+        for column, value in zip(DATASET_COLUMNS, values):
+            patch[column].append(value)
+        patch['stores'][str(row.counter)] = row.store
+        tail[key] = [count] + values
+        last_hour = hour if last_hour is None else max(last_hour, hour)
+        count += 1
+        changed = True
+    
+    if not changed:
+        return dash.no_update, meta
+    return patch, {'start': meta['start'], 'scope': meta['scope'], 'count': count, 'last_hour': last_hour,
+                   'tail': _dataset_tail(last_hour, tail)}
+
+def build_snapshot(counter_ids):
+    """Latest reading per counter and unresolved alerts of the user's counters, in one pass"""
+    now = datetime.now()
+    online_since = now - timedelta(minutes=30)
+    
+    # Latest state per active counter
+    counter_rows = db.session.query(
+        VisitorCounter.id,
+        VisitorCounter.name,
+        VisitorCounter.store_id,
+        CounterState.last_seen,
+        CounterState.current_occupancy
+    ).outerjoin(
+        CounterState, CounterState.counter_id == VisitorCounter.id
+    ).filter(
+        VisitorCounter.active == True,
+        VisitorCounter.id.in_(counter_ids)
+    ).order_by(VisitorCounter.id).all()
+    
+    counters = [{
+        'id': row.id,
+        'name': row.name,
+        'store_id': row.store_id,
+        'current_occupancy': row.current_occupancy,
+        'is_online': bool(row.last_seen and row.last_seen >= online_since)
+    } for row in counter_rows]
+    
+    # Unresolved alerts: count per store and the latest ones
+    alert_counts = db.session.query(
+        VisitorCounter.store_id,
+        db.func.count(Alert.id)
+    ).join(Alert, Alert.counter_id == VisitorCounter.id).filter(
+        Alert.is_resolved == False,
+        Alert.counter_id.in_(counter_ids)
+    ).group_by(VisitorCounter.store_id).all()
+    
+    alert_rows = db.session.query(
+        Alert.severity,
+        Alert.message,
+        Alert.created_at,
+        VisitorCounter.store_id,
+        Store.name.label('store_name')
+    ).join(
+        VisitorCounter, VisitorCounter.id == Alert.counter_id
+    ).join(
+        Store, Store.id == VisitorCounter.store_id
+    ).filter(
+        Alert.is_resolved == False,
+        Alert.counter_id.in_(counter_ids)
+    ).order_by(Alert.created_at.desc()).limit(SNAPSHOT_ALERTS_LIMIT).all()
+    
+    return {
+        'today': now.date().isoformat(),
+        'counters': counters,
+        'alert_counts': {str(store_id): count for store_id, count in alert_counts},
+        'alerts': [{
+            'severity': row.severity,
+            'message': row.message,
+            'created_at': row.created_at.strftime("%d.%m %H:%M"),
+            'store_id': row.store_id,
+            'store_name': row.store_name
+        } for row in alert_rows]
+    }
+
+def build_long_trend(request, counter_ids):
+    """Hourly trend for a date range that starts before the clientside dataset window
+
+    Each trace is downsampled with LTTB to the chart's pixel width. A zoom
+    range in the request narrows the query, so drilling down re-reads the
+    visible part at full hourly resolution.
+    """
+    since = pd.Timestamp(request['start']) if request['start'] else None
+    until = pd.Timestamp(request['end']) + pd.Timedelta(days=1) if request['end'] else None
+    if request.get('zoom'):
+        zoom_start, zoom_end = (pd.Timestamp(value) for value in request['zoom'])
+        since = max(since, zoom_start) if since is not None else zoom_start
+        until = min(until, zoom_end) if until is not None else zoom_end
+    
+    buckets = query_hourly_buckets(
+        since=since.to_pydatetime() if since is not None else None,
+        until=until.to_pydatetime() if until is not None else None,
+        store_id=request['store_id'], counter_id=request['counter_id'],
+        by_counter=False, counter_ids=counter_ids
+    )
+    
+    width = min(max(int(request.get('width') or TREND_DEFAULT_POINTS), TREND_MIN_POINTS), TREND_MAX_POINTS)
+    buckets = pd.DataFrame([[f"{row.day}T{int(row.hour):02d}:00:00"] + _bucket_values(row) for row in buckets],
+                           columns=['hour'] + DATASET_COLUMNS)
+    hours = buckets['hour'].to_numpy()
+    x = pd.to_datetime(buckets['hour']).to_numpy().astype('int64')
+    columns = [
+        buckets['entries'].to_numpy(),
+        buckets['exits'].to_numpy(),
+        (buckets['occupancy'] / buckets['samples'].clip(lower=1)).astype(float).round(1).to_numpy()
+    ]
+    
+    traces = []
+    for y in columns:
+        keep = lttb_indices(x, y, width)
+        traces.append([hours[keep].tolist(), y[keep].tolist()])
+    
+    return {'request': request, 'points': len(buckets), 'traces': traces}
+
+def empty_figure(text):
+    """Placeholder figure with a centered message"""
+    fig = go.Figure()
+    fig.add_annotation(text=text,
+                       xref="paper", yref="paper", x=0.5, y=0.5,
+                       showarrow=False, font_size=16)
+    fig.update_layout(
+        template="plotly_dark",
+        paper_bgcolor='rgba(0,0,0,0)',
+        plot_bgcolor='rgba(0,0,0,0)'
+    )
+    return fig
+
+def build_trend_figure(trend):
+    """Full visitor trend figure: entries/exits and occupancy subplots"""
+    fig = make_subplots(
+        rows=2, cols=1,
+        subplot_titles=('Входы и выходы', 'Заполненность'),
+        vertical_spacing=0.1
+    )
+    
+    # Entries and exits
+    fig.add_trace(
+        go.Scatter(x=trend['hours'], y=trend['entries'],
+                  name='Входы', line=dict(color='#28a745')),
+        row=1, col=1
+    )
+    fig.add_trace(
+        go.Scatter(x=trend['hours'], y=trend['exits'],
+                  name='Выходы', line=dict(color='#dc3545')),
+        row=1, col=1
+    )
+    
+    # Occupancy
+    fig.add_trace(
+        go.Scatter(x=trend['hours'], y=trend['occupancy'],
+                  name='Заполненность', line=dict(color='#17a2b8')),
+        row=2, col=1
+    )
+    
+    fig.update_layout(
+        height=400,
+        template="plotly_dark",
+        paper_bgcolor='rgba(0,0,0,0)',
+        plot_bgcolor='rgba(0,0,0,0)'
+    )
+    
+    return fig
+
+def build_hourly_figure(hourly):
+    """Full bar chart of average occupancy per hour of today"""
+    fig = go.Figure(data=[
+        go.Bar(x=hourly['hours'], y=hourly['occupancy'],
+               marker_color='#17a2b8')
+    ])
+    
+    fig.update_layout(
+        title="Средняя заполненность по часам",
+        xaxis_title="Час дня",
+        yaxis_title="Посетители",
+        template="plotly_dark",
+        paper_bgcolor='rgba(0,0,0,0)',
+        plot_bgcolor='rgba(0,0,0,0)'
+    )
+    
+    return fig
+
+def chart_templates():
+    """Styled empty figures the clientside callbacks fill with data"""
+    no_trend = {'hours': [], 'entries': [], 'exits': [], 'occupancy': []}
+    figures = {
+        'trend': build_trend_figure(no_trend),
+        'trend_empty': empty_figure("Нет данных для отображения"),
+        'hourly': build_hourly_figure({'hours': [], 'occupancy': []}),
+        'hourly_empty': empty_figure("Нет данных за сегодня")
+    }
+    return {name: json.loads(fig.to_json()) for name, fig in figures.items()}
+
+# DataTable filter expressions, e.g. {store_name} contains "Центр" or {battery_level} < 30
+FILTER_PART_RE = re.compile(r'^\{(?P<column>\w+)\}\s+(?P<operator>\S+)\s+(?P<value>.+)$')
+FILTER_OPERATORS = {
+    'contains': 'contains', 'datestartswith': 'contains',
+    '=': '=', 'eq': '=', 's=': '=', 'i=': '=',
+    '!=': '!=', 'ne': '!=',
+    '<': '<', 'lt': '<', '<=': '<=', 'le': '<=',
+    '>': '>', 'gt': '>', '>=': '>=', 'ge': '>='
+}
+
+def parse_filter_query(filter_query):
+    """Split a DataTable filter query into (column, operator, value) conditions"""
+    conditions = []
+    for part in (filter_query or '').split(' && '):
+        match = FILTER_PART_RE.match(part.strip())
+        if not match or match['operator'] not in FILTER_OPERATORS:
+            continue
+        value = match['value'].strip()
+        if len(value) > 1 and value[0] == value[-1] and value[0] in '"\'`':
+            value = value[1:-1]
+        conditions.append((match['column'], FILTER_OPERATORS[match['operator']], value))
+    return conditions
+
+def _compare(expr, operator, value):
+    """SQL condition for a comparison operator"""
+    return {
+        '=': expr == value, '!=': expr != value,
+        '<': expr < value, '<=': expr <= value,
+        '>': expr > value, '>=': expr >= value
+    }.get(operator)
+
+def _status_condition(operator, value, online_since):
+    """Condition on the derived status column"""
+    statuses = {
+        STATUS_ONLINE: CounterState.last_seen >= online_since,
+        STATUS_OFFLINE: CounterState.last_seen < online_since,
+        STATUS_NO_DATA: CounterState.last_seen.is_(None)
+    }
+    if operator == 'contains':
+        matched = [cond for label, cond in statuses.items() if value.lower() in label.lower()]
+    else:
+        matched = [cond for label, cond in statuses.items() if label.lower() == value.lower()]
+        if operator == '!=':
+            matched = [db.not_(cond) for cond in matched]
+            return db.and_(*matched) if matched else None
+    return db.or_(*matched) if matched else db.false()
+
+def _filter_condition(column, operator, value, online_since):
+    """SQL condition for one parsed DataTable filter, or None if it does not apply"""
+    if column == 'status':
+        return _status_condition(operator, value, online_since)
+    
+    if column in ('name', 'store_name'):
+        expr = VisitorCounter.name if column == 'name' else Store.name
+        if operator == 'contains':
+            return expr.ilike(f"%{value}%")
+        return _compare(expr, operator, value)
+    
+    if column in ('current_occupancy', 'battery_level'):
+        expr = getattr(CounterState, column)
+        try:
+            number = float(value)
+        except ValueError:
+            return None
+        return _compare(expr, '=' if operator == 'contains' else operator, number)
+    
+    if column == 'last_seen':
+        try:
+            moment = datetime.fromisoformat(value.strip())
+        except ValueError:
+            return None
+        if operator in ('contains', '='):
+            # A date matches the whole day, a date and time the whole minute
+            span = timedelta(days=1) if len(value.strip()) <= 10 else timedelta(minutes=1)
+            return db.and_(CounterState.last_seen >= moment, CounterState.last_seen < moment + span)
+        return _compare(CounterState.last_seen, operator, moment)
+    
+    return None
+
+def _sort_expression(column_id):
+    """Non-null sort key for a table column (missing state sorts first)"""
+    epoch = datetime(1970, 1, 1)
+    return {
+        'name': VisitorCounter.name,
+        'store_name': Store.name,
+        'current_occupancy': db.func.coalesce(CounterState.current_occupancy, -1),
+        'battery_level': db.func.coalesce(CounterState.battery_level, -1),
+        'last_seen': db.func.coalesce(CounterState.last_seen, epoch),
+        'status': db.func.coalesce(CounterState.last_seen, epoch)
+    }.get(column_id, VisitorCounter.name)
+
+def query_counters_page(store_id, sort_by, filter_query, page, page_size, cursor=None, counter_ids=()):
+    """One page of the counters status table from counter_states
+
+    With a cursor (sort key and id of the last row of the previous page) the
+    page is read by keyset; otherwise, e.g. when jumping to a page, by offset.
+    Returns (rows, total, next_cursor).
+    """
+    online_since = datetime.now() - timedelta(minutes=30)
+    sort = sort_by[0] if sort_by else {'column_id': 'name', 'direction': 'asc'}
+    sort_key = _sort_expression(sort['column_id'])
+    descending = sort['direction'] == 'desc'
+    
+    query = db.session.query(
+        VisitorCounter.id,
+        VisitorCounter.name,
+        Store.name.label('store_name'),
+        CounterState.last_seen,
+        CounterState.current_occupancy,
+        CounterState.battery_level,
+        sort_key.label('sort_key'),
+        db.func.count().over().label('remaining')
+    ).join(
+        Store, Store.id == VisitorCounter.store_id
+    ).outerjoin(
+        CounterState, CounterState.counter_id == VisitorCounter.id
+    ).filter(VisitorCounter.active == True, VisitorCounter.id.in_(counter_ids))
+    
+    if store_id:
+        query = query.filter(VisitorCounter.store_id == store_id)
+    for column, operator, value in parse_filter_query(filter_query):
+        condition = _filter_condition(column, operator, value, online_since)
+        if condition is not None:
+            query = query.filter(condition)
+    
+    key = db.tuple_(sort_key, VisitorCounter.id)
+    if cursor:
+        value = cursor[0]
+        if sort['column_id'] in ('last_seen', 'status'):
+            value = datetime.fromisoformat(value)
+        bound = db.tuple_(db.literal(value), db.literal(cursor[1]))
+        query = query.filter(key < bound if descending else key > bound)
+    
+    if descending:
+        query = query.order_by(sort_key.desc(), VisitorCounter.id.desc())
+    else:
+        query = query.order_by(sort_key, VisitorCounter.id)
+    if page and not cursor:
+        query = query.offset(page * page_size)
+    result = query.limit(page_size).all()
+    
+    rows = []
+    for row in result:
+        if row.last_seen is None:
+            status = STATUS_NO_DATA
+        else:
+            status = STATUS_ONLINE if row.last_seen >= online_since else STATUS_OFFLINE
+        rows.append({
+            'id': row.id,
+            'name': row.name,
+            'store_name': row.store_name,
+            'current_occupancy': row.current_occupancy,
+            'last_seen': row.last_seen.strftime("%Y-%m-%d %H:%M") if row.last_seen else "—",
+            'status': status,
+            'battery_level': row.battery_level
+        })
+    
+    # The window count is taken before OFFSET, so it is the full total there;
+    # with a cursor it covers this page and every row after it
+    remaining = result[0].remaining if result else 0
+    total = page * page_size + remaining if cursor else remaining
+    next_cursor = None
+    if result:
+        last_key = result[-1].sort_key
+        next_cursor = [last_key.isoformat() if isinstance(last_key, datetime) else last_key, result[-1].id]
+    return rows, total, next_cursor
+
+def data_version():
+    """Latest ingested row id, part of background cache keys so new data invalidates them"""
+    return db.session.query(db.func.max(VisitorData.id)).scalar() or 0
+
+def create_background_manager():
+    """Disk-backed manager for background callbacks and their memoized results"""
+    cache = diskcache.Cache(DASH_CACHE_DIR)
+    return DiskcacheManager(cache, cache_by=[data_version], expire=DASH_CACHE_EXPIRE)
+
+@contextmanager
+def background_job(server):
+    """App context for a background callback running in a forked worker process"""
+    with server.app_context():
+        # Pooled connections inherited from the parent process must not be shared
+        db.engine.dispose(close=False)
+        yield
+
 def register_callbacks(app):
     """Register all dashboard callbacks"""
     
+    # Time every server-side callback registered below
+    instrument_callbacks(app)
+    background_manager = create_background_manager()
+    
+    app.clientside_callback(
+        LIVE_VERSION_JS.replace('__MIN_REFRESH_MS__', str(LIVE_REFRESH_MIN_INTERVAL * 1000)),
+        Output('live-version', 'data'),
+        [Input('live-poll', 'n_intervals'),
+         Input('interval-component', 'n_intervals')],
+        [State('store-filter', 'value'),
+         State('live-version', 'data')]
+    )
+    
     @app.callback(
         [Output('store-filter', 'options'),
          Output('store-filter', 'value')],
-        Input('interval-component', 'n_intervals')
+        Input('interval-component', 'n_intervals'),
+        State('store-filter', 'value')
     )
-    def update_store_options(n):
+    def update_store_options(n, current_store):
         """Update store dropdown options"""
         try:
-            stores = Store.query.filter_by(active=True).all()
+            stores = get_user_accessible_stores(get_current_user())
             options = [{'label': f"{store.name} ({store.store_code})", 'value': store.id} for store in stores]
             
-            # Default to first store if none selected
+            # Keep the user's selection, default to first store if none selected
+            if current_store in [option['value'] for option in options]:
+                return options, dash.no_update
             default_value = options[0]['value'] if options else None
             
             return options, default_value
@@ -209,403 +1046,263 @@ def register_callbacks(app):
             logger.error(f"Error updating store options: {e}")
             return [], None
     
-    @app.callback(
+    app.clientside_callback(
+        COUNTER_OPTIONS_JS,
         [Output('counter-filter', 'options'),
          Output('counter-filter', 'value')],
         [Input('store-filter', 'value'),
-         Input('interval-component', 'n_intervals')]
+         Input('dashboard-snapshot', 'data')],
+        State('counter-filter', 'value')
     )
-    def update_counter_options(store_id, n):
-        """Update counter dropdown based on selected store"""
-        if not store_id:
-            return [], None
-        
+    
+    @app.callback(
+        [Output('dashboard-snapshot', 'data'),
+         Output('scope-dataset', 'data'),
+         Output('dataset-meta', 'data'),
+         Output('dashboard-scope', 'data')],
+        [Input('refresh-button', 'n_clicks'),
+         Input('live-version', 'data')],
+        State('dataset-meta', 'data')
+    )
+    def update_snapshot(n_clicks, version, meta):
+        """Query the database once per tick for all dashboard widgets"""
         try:
-            counters = VisitorCounter.query.filter_by(store_id=store_id, active=True).all()
-            options = [{'label': counter.name, 'value': counter.id} for counter in counters]
+            counter_ids = scope_counter_ids()
+            snapshot = build_snapshot(counter_ids)
             
-            return options, None
+            # Live ticks only send the dataset rows the browser lacks
+            triggered = [t['prop_id'] for t in callback_context.triggered]
+            if (triggered == ['live-version.data'] and meta and meta['start'] == dataset_start()
+                    and meta.get('scope') == scope_key(counter_ids)):
+                dataset, meta = patch_dataset(meta, counter_ids)
+            else:
+                dataset, meta = build_dataset(counter_ids)
+            
+            return snapshot, dataset, meta, scope_token(counter_ids)
         except Exception as e:
-            logger.error(f"Error updating counter options: {e}")
-            return [], None
+            logger.error(f"Error building dashboard snapshot: {e}")
+            return None, dash.no_update, dash.no_update, dash.no_update
     
-    @app.callback(
+    app.clientside_callback(
+        METRICS_JS.replace('__HELPERS__', DATASET_HELPERS_JS),
         [Output('total-visitors-today', 'children'),
          Output('current-occupancy', 'children'),
          Output('active-alerts', 'children'),
          Output('online-counters', 'children')],
-        [Input('interval-component', 'n_intervals'),
+        [Input('scope-dataset', 'data'),
+         Input('dashboard-snapshot', 'data'),
          Input('store-filter', 'value')]
     )
-    def update_metrics(n, store_id):
-        """Update top metrics cards"""
+    
+    app.clientside_callback(
+        TREND_REQUEST_JS,
+        Output('trend-request', 'data'),
+        [Input('store-filter', 'value'),
+         Input('counter-filter', 'value'),
+         Input('date-range', 'start_date'),
+         Input('date-range', 'end_date'),
+         Input('visitor-trend-chart', 'relayoutData'),
+         Input('dataset-meta', 'data')],
+        State('trend-request', 'data')
+    )
+    
+    @app.callback(
+        Output('long-trend', 'data'),
+        Input('trend-request', 'data'),
+        # The scope is an argument, so cached trends are never shared across scopes
+        State('dashboard-scope', 'data'),
+        background=True,
+        manager=background_manager,
+        progress=Output('trend-status', 'children'),
+        progress_default=""
+    )
+    def update_long_trend(set_progress, request, scope):
+        """Aggregate the trend on the server for ranges older than the dataset window"""
+        if not request:
+            return None
+        
         try:
-            today = datetime.now().date()
-            
-            # Build base query
-            query = db.session.query(VisitorData).join(VisitorCounter)
-            if store_id:
-                query = query.filter(VisitorCounter.store_id == store_id)
-            
-            # Total visitors today
-            today_data = query.filter(
-                db.func.date(VisitorData.timestamp) == today
-            ).all()
-            
-            total_entries = sum(d.entries for d in today_data)
-            current_occupancy = sum(d.current_occupancy for d in today_data[-50:]) if today_data else 0  # Last 50 records
-            
-            # Active alerts
-            alert_query = Alert.query.join(VisitorCounter).filter(Alert.is_resolved == False)
-            if store_id:
-                alert_query = alert_query.filter(VisitorCounter.store_id == store_id)
-            active_alerts_count = alert_query.count()
-            
-            # Online counters (received data in last 30 minutes)
-            thirty_min_ago = datetime.now() - timedelta(minutes=30)
-            counter_query = VisitorCounter.query.filter(VisitorCounter.active == True)
-            if store_id:
-                counter_query = counter_query.filter(VisitorCounter.store_id == store_id)
-            
-            online_counters = counter_query.join(VisitorData).filter(
-                VisitorData.timestamp >= thirty_min_ago
-            ).distinct().count()
-            
-            return (
-                f"{total_entries:,}",
-                f"{current_occupancy:,}",
-                str(active_alerts_count),
-                str(online_counters)
-            )
-            
+            set_progress("Загрузка данных за период...")
+            with background_job(app.server):
+                return build_long_trend(request, scope_from_token(scope))
         except Exception as e:
-            logger.error(f"Error updating metrics: {e}")
-            return "0", "0", "0", "0"
+            logger.error(f"Error updating long-range trend: {e}")
+            return None
     
-    @app.callback(
+    app.clientside_callback(
+        TREND_FIGURE_JS.replace('__HELPERS__', DATASET_HELPERS_JS),
         Output('visitor-trend-chart', 'figure'),
-        [Input('refresh-button', 'n_clicks'),
-         Input('interval-component', 'n_intervals'),
+        [Input('scope-dataset', 'data'),
+         Input('long-trend', 'data'),
          Input('store-filter', 'value'),
          Input('counter-filter', 'value'),
          Input('date-range', 'start_date'),
-         Input('date-range', 'end_date')]
+         Input('date-range', 'end_date')],
+        [State('dataset-meta', 'data'),
+         State('chart-templates', 'data')]
     )
-    def update_visitor_trend(n_clicks, n_intervals, store_id, counter_id, start_date, end_date):
-        """Update visitor trend chart"""
-        try:
-            # Build query
-            query = db.session.query(VisitorData).join(VisitorCounter)
-            
-            if store_id:
-                query = query.filter(VisitorCounter.store_id == store_id)
-            if counter_id:
-                query = query.filter(VisitorData.counter_id == counter_id)
-            if start_date:
-                query = query.filter(VisitorData.timestamp >= start_date)
-            if end_date:
-                query = query.filter(VisitorData.timestamp <= end_date)
-            
-            data = query.order_by(VisitorData.timestamp).all()
-            
-            if not data:
-                fig = go.Figure()
-                fig.add_annotation(text="Нет данных для отображения", 
-                                 xref="paper", yref="paper", x=0.5, y=0.5, 
-                                 showarrow=False, font_size=16)
-                fig.update_layout(
-                    template="plotly_dark",
-                    paper_bgcolor='rgba(0,0,0,0)',
-                    plot_bgcolor='rgba(0,0,0,0)'
-                )
-                return fig
-            
-            # Create DataFrame
-            df = pd.DataFrame([{
-                'timestamp': d.timestamp,
-                'entries': d.entries,
-                'exits': d.exits,
-                'occupancy': d.current_occupancy
-            } for d in data])
-            
-            # Group by hour for better visualization
-            df['hour'] = df['timestamp'].dt.floor('H')
-            hourly_data = df.groupby('hour').agg({
-                'entries': 'sum',
-                'exits': 'sum',
-                'occupancy': 'mean'
-            }).reset_index()
-            
-            # Create figure
-            fig = make_subplots(
-                rows=2, cols=1,
-                subplot_titles=('Входы и выходы', 'Заполненность'),
-                vertical_spacing=0.1
-            )
-            
-            # Entries and exits
-            fig.add_trace(
-                go.Scatter(x=hourly_data['hour'], y=hourly_data['entries'], 
-                          name='Входы', line=dict(color='#28a745')),
-                row=1, col=1
-            )
-            fig.add_trace(
-                go.Scatter(x=hourly_data['hour'], y=hourly_data['exits'], 
-                          name='Выходы', line=dict(color='#dc3545')),
-                row=1, col=1
-            )
-            
-            # Occupancy
-            fig.add_trace(
-                go.Scatter(x=hourly_data['hour'], y=hourly_data['occupancy'], 
-                          name='Заполненность', line=dict(color='#17a2b8')),
-                row=2, col=1
-            )
-            
-            fig.update_layout(
-                height=400,
-                template="plotly_dark",
-                paper_bgcolor='rgba(0,0,0,0)',
-                plot_bgcolor='rgba(0,0,0,0)'
-            )
-            
-            return fig
-            
-        except Exception as e:
-            logger.error(f"Error updating visitor trend chart: {e}")
-            return go.Figure()
     
-    @app.callback(
+    app.clientside_callback(
+        HOURLY_FIGURE_JS.replace('__HELPERS__', DATASET_HELPERS_JS),
         Output('hourly-occupancy-chart', 'figure'),
-        [Input('refresh-button', 'n_clicks'),
-         Input('interval-component', 'n_intervals'),
+        [Input('scope-dataset', 'data'),
+         Input('dashboard-snapshot', 'data'),
          Input('store-filter', 'value'),
-         Input('counter-filter', 'value')]
+         Input('counter-filter', 'value')],
+        State('chart-templates', 'data')
     )
-    def update_hourly_occupancy(n_clicks, n_intervals, store_id, counter_id):
-        """Update hourly occupancy chart"""
-        try:
-            today = datetime.now().date()
-            
-            # Build query for today's data
-            query = db.session.query(VisitorData).join(VisitorCounter).filter(
-                db.func.date(VisitorData.timestamp) == today
-            )
-            
-            if store_id:
-                query = query.filter(VisitorCounter.store_id == store_id)
-            if counter_id:
-                query = query.filter(VisitorData.counter_id == counter_id)
-            
-            data = query.all()
-            
-            if not data:
-                fig = go.Figure()
-                fig.add_annotation(text="Нет данных за сегодня", 
-                                 xref="paper", yref="paper", x=0.5, y=0.5, 
-                                 showarrow=False, font_size=16)
-                fig.update_layout(
-                    template="plotly_dark",
-                    paper_bgcolor='rgba(0,0,0,0)',
-                    plot_bgcolor='rgba(0,0,0,0)'
-                )
-                return fig
-            
-            # Create DataFrame and group by hour
-            df = pd.DataFrame([{
-                'hour': d.timestamp.hour,
-                'occupancy': d.current_occupancy
-            } for d in data])
-            
-            hourly_avg = df.groupby('hour')['occupancy'].mean().reset_index()
-            
-            # Create bar chart
-            fig = go.Figure(data=[
-                go.Bar(x=hourly_avg['hour'], y=hourly_avg['occupancy'],
-                       marker_color='#17a2b8')
-            ])
-            
-            fig.update_layout(
-                title="Средняя заполненность по часам",
-                xaxis_title="Час дня",
-                yaxis_title="Посетители",
-                template="plotly_dark",
-                paper_bgcolor='rgba(0,0,0,0)',
-                plot_bgcolor='rgba(0,0,0,0)'
-            )
-            
-            return fig
-            
-        except Exception as e:
-            logger.error(f"Error updating hourly occupancy chart: {e}")
-            return go.Figure()
-    
+
     @app.callback(
-        Output('counters-table', 'children'),
-        [Input('interval-component', 'n_intervals'),
-         Input('store-filter', 'value')]
+        [Output('counters-table', 'data'),
+         Output('counters-table', 'page_count'),
+         Output('counters-table', 'page_current'),
+         Output('counters-cursors', 'data')],
+        [Input('counters-table', 'page_current'),
+         Input('counters-table', 'page_size'),
+         Input('counters-table', 'sort_by'),
+         Input('counters-table', 'filter_query'),
+         Input('store-filter', 'value'),
+         Input('live-version', 'data')],
+        State('counters-cursors', 'data')
     )
-    def update_counters_table(n, store_id):
-        """Update counters status table"""
+    def update_counters_table(page_current, page_size, sort_by, filter_query, store_id, version, cursors):
+        """Load one page of the counters status table"""
         try:
-            # Get counters with latest data
-            query = db.session.query(VisitorCounter).filter(VisitorCounter.active == True)
-            if store_id:
-                query = query.filter(VisitorCounter.store_id == store_id)
-            
-            counters = query.all()
+            # Cursors are only valid for the sort/filter they were read with
+            selection = json.dumps([sort_by, filter_query, store_id, page_size])
+            if not cursors or cursors['selection'] != selection:
+                cursors = {'selection': selection, 'pages': {}}
+                page_current = 0
+            page = page_current or 0
             
-            if not counters:
-                return dbc.Alert("Нет активных счетчиков", color="info")
-            
-            rows = []
-            for counter in counters:
-                # Get latest data
-                latest_data = VisitorData.query.filter_by(counter_id=counter.id).order_by(
-                    VisitorData.timestamp.desc()
-                ).first()
-                
-                if latest_data:
-                    time_diff = datetime.now() - latest_data.timestamp.replace(tzinfo=None)
-                    status = "Онлайн" if time_diff.total_seconds() < 1800 else "Офлайн"  # 30 minutes
-                    status_color = "success" if status == "Онлайн" else "danger"
-                    
-                    rows.append(
-                        html.Tr([
-                            html.Td(counter.name),
-                            html.Td(counter.store.name),
-                            html.Td(latest_data.current_occupancy),
-                            html.Td(latest_data.timestamp.strftime("%H:%M")),
-                            html.Td([
-                                dbc.Badge(status, color=status_color, className="me-1"),
-                                dbc.Badge(f"{latest_data.battery_level}%" if latest_data.battery_level else "N/A", 
-                                         color="warning" if latest_data.battery_level and latest_data.battery_level < 30 else "secondary")
-                            ])
-                        ])
-                    )
-                else:
-                    rows.append(
-                        html.Tr([
-                            html.Td(counter.name),
-                            html.Td(counter.store.name),
-                            html.Td("—"),
-                            html.Td("—"),
-                            html.Td(dbc.Badge("Нет данных", color="secondary"))
-                        ])
-                    )
-            
-            table = dbc.Table([
-                html.Thead([
-                    html.Tr([
-                        html.Th("Счетчик"),
-                        html.Th("Магазин"),
-                        html.Th("Заполненность"),
-                        html.Th("Последние данные"),
-                        html.Th("Статус")
-                    ])
-                ]),
-                html.Tbody(rows)
-            ], striped=True, bordered=True, hover=True, size="sm")
-            
-            return table
+            rows, total, next_cursor = query_counters_page(
+                store_id, sort_by, filter_query, page, page_size,
+                cursor=cursors['pages'].get(str(page)), counter_ids=scope_counter_ids()
+            )
+            if next_cursor:
+                cursors['pages'][str(page + 1)] = next_cursor
             
+            page_count = max(1, -(-total // page_size))
+            return rows, page_count, page, cursors
         except Exception as e:
             logger.error(f"Error updating counters table: {e}")
-            return dbc.Alert("Ошибка загрузки данных", color="danger")
+            return [], 1, 0, None
     
     @app.callback(
         Output('alerts-list', 'children'),
-        [Input('interval-component', 'n_intervals'),
+        [Input('dashboard-snapshot', 'data'),
          Input('store-filter', 'value')]
     )
-    def update_alerts_list(n, store_id):
+    def update_alerts_list(snapshot, store_id):
         """Update alerts list"""
-        try:
-            query = Alert.query.join(VisitorCounter).filter(Alert.is_resolved == False)
-            if store_id:
-                query = query.filter(VisitorCounter.store_id == store_id)
-            
-            alerts = query.order_by(Alert.created_at.desc()).limit(10).all()
-            
-            if not alerts:
-                return dbc.Alert("Нет активных алертов", color="success")
-            
-            alert_items = []
-            for alert in alerts:
-                severity_colors = {
-                    'low': 'info',
-                    'medium': 'warning', 
-                    'high': 'danger',
-                    'critical': 'danger'
-                }
-                
-                alert_items.append(
-                    dbc.ListGroupItem([
-                        html.Div([
-                            dbc.Badge(alert.severity.upper(), 
-                                    color=severity_colors.get(alert.severity, 'secondary'),
-                                    className="me-2"),
-                            html.Strong(alert.message),
-                        ], className="d-flex justify-content-between align-items-start"),
-                        html.Small([
-                            html.I(className="fas fa-clock me-1"),
-                            alert.created_at.strftime("%d.%m %H:%M"),
-                            " | ",
-                            html.I(className="fas fa-map-marker-alt me-1"),
-                            alert.counter.store.name
-                        ], className="text-muted")
-                    ])
-                )
-            
-            return dbc.ListGroup(alert_items, flush=True)
-            
-        except Exception as e:
-            logger.error(f"Error updating alerts list: {e}")
+        if snapshot is None:
             return dbc.Alert("Ошибка загрузки алертов", color="danger")
-    
+        
+        alerts = [a for a in snapshot['alerts'] if not store_id or a['store_id'] == store_id][:10]
+        if not alerts:
+            return dbc.Alert("Нет активных алертов", color="success")
+        
+        alert_items = []
+        for alert in alerts:
+            alert_items.append(
+                dbc.ListGroupItem([
+                    html.Div([
+                        dbc.Badge(alert['severity'].upper(),
+                                color=SEVERITY_COLORS.get(alert['severity'], 'secondary'),
+                                className="me-2"),
+                        html.Strong(alert['message']),
+                    ], className="d-flex justify-content-between align-items-start"),
+                    html.Small([
+                        html.I(className="fas fa-clock me-1"),
+                        alert['created_at'],
+                        " | ",
+                        html.I(className="fas fa-map-marker-alt me-1"),
+                        alert['store_name']
+                    ], className="text-muted")
+                ])
+            )
+        
+        return dbc.ListGroup(alert_items, flush=True)
+
     @app.callback(
         Output("download-data", "data"),
         Input("export-button", "n_clicks"),
         [State('store-filter', 'value'),
          State('counter-filter', 'value'),
          State('date-range', 'start_date'),
-         State('date-range', 'end_date')],
+         State('date-range', 'end_date'),
+         State('dashboard-scope', 'data')],
+        background=True,
+        manager=background_manager,
+        running=[
+            (Output('export-button', 'disabled'), True, False),
+            (Output('cancel-export-button', 'disabled'), False, True),
+            (Output('export-progress', 'style'), {"visibility": "visible"}, {"visibility": "hidden"})
+        ],
+        cancel=[Input('cancel-export-button', 'n_clicks'),
+                Input('store-filter', 'value'),
+                Input('counter-filter', 'value'),
+                Input('date-range', 'start_date'),
+                Input('date-range', 'end_date')],
+        progress=[Output('export-progress', 'value'),
+                  Output('export-progress', 'max')],
+        # Same filters and data version reuse the cached file, whatever the click count
+        cache_args_to_ignore=[0],
         prevent_initial_call=True
     )
-    def export_data(n_clicks, store_id, counter_id, start_date, end_date):
+    def export_data(set_progress, n_clicks, store_id, counter_id, start_date, end_date, scope):
         """Export filtered data to Excel"""
         if not n_clicks:
             return dash.no_update
         
         try:
-            # Build query
-            query = db.session.query(VisitorData).join(VisitorCounter).join(Store)
-            
-            if store_id:
-                query = query.filter(VisitorCounter.store_id == store_id)
-            if counter_id:
-                query = query.filter(VisitorData.counter_id == counter_id)
-            if start_date:
-                query = query.filter(VisitorData.timestamp >= start_date)
-            if end_date:
-                query = query.filter(VisitorData.timestamp <= end_date)
-            
-            data = query.order_by(VisitorData.timestamp).all()
+            with background_job(app.server):
+                # Build query
+                query = _filter_scope(
+                    db.session.query(
+                        VisitorData.timestamp,
+                        Store.name.label('store_name'),
+                        VisitorCounter.name.label('counter_name'),
+                        VisitorData.entries,
+                        VisitorData.exits,
+                        VisitorData.current_occupancy,
+                        VisitorData.hourly_peak,
+                        VisitorData.temperature,
+                        VisitorData.humidity,
+                        VisitorData.sensor_status,
+                        VisitorData.battery_level
+                    ).select_from(VisitorData).join(VisitorCounter).join(Store),
+                    store_id, counter_id
+                ).filter(VisitorData.counter_id.in_(scope_from_token(scope)))
+                if start_date:
+                    query = query.filter(VisitorData.timestamp >= start_date)
+                if end_date:
+                    query = query.filter(VisitorData.timestamp <= end_date)
+                
+                total = query.count()
+                set_progress((0, max(total, 1)))
+                
+                records = []
+                for d in query.order_by(VisitorData.timestamp).yield_per(EXPORT_CHUNK_SIZE):
+                    records.append({
+                        'Дата и время': d.timestamp.strftime("%d.%m.%Y %H:%M"),
+                        'Магазин': d.store_name,
+                        'Счетчик': d.counter_name,
+                        'Входы': d.entries,
+                        'Выходы': d.exits,
+                        'Заполненность': d.current_occupancy,
+                        'Пиковая заполненность': d.hourly_peak,
+                        'Температура': d.temperature,
+                        'Влажность': d.humidity,
+                        'Статус датчика': d.sensor_status,
+                        'Заряд батареи': d.battery_level
+                    })
+                    if len(records) % EXPORT_CHUNK_SIZE == 0:
+                        set_progress((len(records), total))
             
             # Create DataFrame
-            df = pd.DataFrame([{
-                'Дата и время': d.timestamp.strftime("%d.%m.%Y %H:%M"),
-                'Магазин': d.counter.store.name,
-                'Счетчик': d.counter.name,
-                'Входы': d.entries,
-                'Выходы': d.exits,
-                'Заполненность': d.current_occupancy,
-                'Пиковая заполненность': d.hourly_peak,
-                'Температура': d.temperature,
-                'Влажность': d.humidity,
-                'Статус датчика': d.sensor_status,
-                'Заряд батареи': d.battery_level
-            } for d in data])
+            df = pd.DataFrame(records)
+            set_progress((total, max(total, 1)))
             
             filename = f"visitor_data_{datetime.now().strftime('%Y%m%d_%H%M%S')}.xlsx"
             
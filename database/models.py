@@ -1,6 +1,6 @@
 from datetime import datetime, timezone
 from database import db
-from sqlalchemy import Integer, String, DateTime, Boolean, Float, Text, ForeignKey, Index
+from sqlalchemy import Integer, String, Date, DateTime, Boolean, Float, Text, ForeignKey, Index
 from sqlalchemy.orm import relationship
 import bcrypt
 
@@ -110,6 +110,7 @@ class VisitorCounter(db.Model):
     assigned_user = relationship("User", back_populates="assigned_counters")
     visitor_data = relationship("VisitorData", back_populates="counter")
     alerts = relationship("Alert", back_populates="counter")
+    state = relationship("CounterState", back_populates="counter", uselist=False)
     
     def __repr__(self):
         return f'<VisitorCounter {self.name} ({self.device_id})>'
@@ -143,6 +144,31 @@ class VisitorData(db.Model):
     def __repr__(self):
         return f'<VisitorData counter_id={self.counter_id} timestamp={self.timestamp}>'
 
+class CounterState(db.Model):
+    __tablename__ = 'counter_states'
+    
+    # Latest reading per counter, upserted on ingest
+    counter_id = db.Column(Integer, ForeignKey('visitor_counters.id'), primary_key=True)
+    last_seen = db.Column(DateTime)
+    total_count = db.Column(Integer, default=0)
+    current_occupancy = db.Column(Integer, default=0)
+    battery_level = db.Column(Integer)
+    signal_strength = db.Column(Integer)
+    sensor_status = db.Column(String(20))
+    updated_at = db.Column(DateTime, default=lambda: datetime.now(timezone.utc), onupdate=lambda: datetime.now(timezone.utc))
+    
+    # Relationships
+    counter = relationship("VisitorCounter", back_populates="state")
+    
+    # Indexes for sorted, keyset-paginated listings
+    __table_args__ = (
+        Index('idx_counter_states_last_seen', 'last_seen', 'counter_id'),
+        Index('idx_counter_states_battery', 'battery_level', 'counter_id'),
+    )
+    
+    def __repr__(self):
+        return f'<CounterState counter_id={self.counter_id} last_seen={self.last_seen}>'
+
 class Alert(db.Model):
     __tablename__ = 'alerts'
     
@@ -209,3 +235,109 @@ class Session(db.Model):
     
     def __repr__(self):
         return f'<Session user_id={self.user_id} active={self.active}>'
+
+class SessionActivity(db.Model):
+    __tablename__ = 'session_activity'
+    
+    # Last request of a session, flushed in batches at ACTIVITY_RESOLUTION
+    session_id = db.Column(Integer, ForeignKey('sessions.id', ondelete='CASCADE'), primary_key=True)
+    last_seen_at = db.Column(DateTime, nullable=False)
+    
+    def __repr__(self):
+        return f'<SessionActivity session_id={self.session_id} last_seen_at={self.last_seen_at}>'
+
+class ExportJob(db.Model):
+    __tablename__ = 'export_jobs'
+    
+    id = db.Column(String(32), primary_key=True)  # random hex, used in URLs
+    user_id = db.Column(Integer, ForeignKey('users.id'), nullable=False)
+    kind = db.Column(String(20), nullable=False)  # xlsx, csv, report_email
+    cache_key = db.Column(String(64))  # scope/period/format of reusable file exports
+    params = db.Column(Text)  # JSON
+    status = db.Column(String(20), nullable=False, default='pending')  # pending, running, done, failed
+    progress = db.Column(Integer)  # percent, None while unknown
+    file_path = db.Column(String(500))
+    filename = db.Column(String(255))
+    error = db.Column(Text)
+    created_at = db.Column(DateTime, default=lambda: datetime.now(timezone.utc))
+    started_at = db.Column(DateTime)
+    finished_at = db.Column(DateTime)
+    
+    # Relationships
+    user = relationship("User")
+    
+    __table_args__ = (
+        Index('idx_export_jobs_cache_key', 'cache_key', 'status', 'created_at'),
+        Index('idx_export_jobs_created', 'created_at'),
+    )
+    
+    def __repr__(self):
+        return f'<ExportJob {self.id} {self.kind} {self.status}>'
+
+class ReportSchedule(db.Model):
+    __tablename__ = 'report_schedules'
+    
+    id = db.Column(Integer, primary_key=True)
+    name = db.Column(String(200), nullable=False)
+    recipient_email = db.Column(String(120), nullable=False)
+    frequency = db.Column(String(20), nullable=False)  # daily, weekly, monthly
+    send_time = db.Column(String(5), nullable=False)  # HH:MM in REPORT_TIMEZONE
+    jitter_seconds = db.Column(Integer, nullable=False, default=0)  # fixed offset from send_time
+    store_ids = db.Column(Text)  # JSON list, empty for all stores
+    include_alerts = db.Column(Boolean, default=True)
+    active = db.Column(Boolean, default=True)
+    next_run_at = db.Column(DateTime, nullable=False)  # UTC
+    last_run_at = db.Column(DateTime)
+    last_status = db.Column(String(20))  # queued, sent, failed
+    last_error = db.Column(Text)
+    created_by = db.Column(Integer, ForeignKey('users.id'))
+    created_at = db.Column(DateTime, default=lambda: datetime.now(timezone.utc))
+    
+    # Relationships
+    creator = relationship("User")
+    
+    __table_args__ = (
+        Index('idx_report_schedules_due', 'active', 'next_run_at'),
+    )
+    
+    def __repr__(self):
+        return f'<ReportSchedule {self.name} {self.frequency} {self.send_time}>'
+
+class EmailDelivery(db.Model):
+    __tablename__ = 'email_deliveries'
+    
+    id = db.Column(Integer, primary_key=True)
+    recipient = db.Column(String(120), nullable=False)
+    subject = db.Column(String(255))
+    message_path = db.Column(String(500), nullable=False)  # spooled message shared by one batch
+    status = db.Column(String(20), nullable=False, default='pending')  # pending, sending, sent, failed
+    attempts = db.Column(Integer, nullable=False, default=0)
+    next_attempt_at = db.Column(DateTime)  # UTC
+    last_error = db.Column(Text)
+    created_at = db.Column(DateTime, default=lambda: datetime.now(timezone.utc))
+    updated_at = db.Column(DateTime, default=lambda: datetime.now(timezone.utc))
+    sent_at = db.Column(DateTime)
+    
+    __table_args__ = (
+        Index('idx_email_deliveries_due', 'status', 'next_attempt_at'),
+        Index('idx_email_deliveries_created', 'created_at'),
+    )
+    
+    def __repr__(self):
+        return f'<EmailDelivery {self.recipient} {self.status}>'
+
+class PrerenderedReport(db.Model):
+    __tablename__ = 'prerendered_reports'
+    
+    # One row per distinct report and delivery day; inserting it claims the render
+    report_key = db.Column(String(64), primary_key=True)  # hash of period, stores and alerts option
+    run_date = db.Column(Date, primary_key=True)  # local date of the delivery run
+    status = db.Column(String(20), nullable=False, default='rendering')  # rendering, ready
+    subject = db.Column(String(255))
+    html = db.Column(Text)
+    attachment_path = db.Column(String(500))
+    filename = db.Column(String(255))
+    created_at = db.Column(DateTime, default=lambda: datetime.now(timezone.utc))
+    
+    def __repr__(self):
+        return f'<PrerenderedReport {self.report_key} {self.run_date} {self.status}>'
@@ -4,159 +4,113 @@ Email reporting system for visitor counter management
 """
 
 import os
+import json
+import time
 import logging
+import threading
 from datetime import datetime, timedelta, timezone
-from flask import Blueprint, render_template_string, request, redirect, url_for, flash, jsonify
+from flask import Blueprint, request, redirect, url_for, flash, jsonify, send_file, abort
 from database import db
-from database.models import User, Store, VisitorCounter, VisitorData, Alert
+from database.models import User, Store, VisitorCounter, VisitorData, Alert, ReportSchedule, EmailDelivery
 from auth_routes import login_required, admin_required, get_current_user
-import pandas as pd
-import io
-import smtplib
-from email.mime.multipart import MIMEMultipart
-from email.mime.text import MIMEText
-from email.mime.base import MIMEBase
-from email import encoders
-# import schedule
-import threading
-import time
+from utils.templates import register_template, render_inline
+from utils.export_jobs import register_job_handler, submit_job
+from utils.mailer import queue_email, send_deliveries
+from utils.exports import EXPORT_BATCH_SIZE, XLSX_MIMETYPE, write_xlsx_export, create_export_file, remove_file
+from utils.report_links import REPORT_LINK_TTL, use_link, store_report_file, resolve_report_token
+from utils.report_scheduler import (FREQUENCIES, REPORT_TIMEZONE, REPORT_PRERENDER_HORIZON, next_run_time,
+                                    random_jitter, local_time, run_slot, utcnow, start_report_scheduler)
+from utils.report_prerender import (claim_prerender, store_prerender, release_prerender, load_prerendered,
+                                    purge_prerendered)
 
 logger = logging.getLogger(__name__)
 
 reports_bp = Blueprint('reports', __name__, url_prefix='/reports')
 
-# Email configuration
-SMTP_SERVER = "smtp.gmail.com"
-SMTP_PORT = 587
-EMAIL_FROM = os.environ.get("EMAIL_FROM", "reports@company.com")
-EMAIL_PASSWORD = os.environ.get("EMAIL_PASSWORD", "")
+# Report period covered by each schedule frequency
+FREQUENCY_PERIODS = {'daily': 'yesterday', 'weekly': 'week', 'monthly': 'month'}
+FREQUENCY_LABELS = {'daily': 'Ежедневно', 'weekly': 'Еженедельно', 'monthly': 'Ежемесячно'}
+DELIVERY_BADGES = {'sent': 'success', 'failed': 'danger', 'pending': 'warning', 'sending': 'info'}
 
-# Report scheduling storage (in production use Redis or database)
-scheduled_reports = {}
+# Rendered reports are reused for identical requests within this window (seconds),
+# covering schedules set for the same time but spread out by their jitter
+REPORT_RENDER_TTL = int(os.environ.get("REPORT_RENDER_TTL", "900"))
+
+_render_lock = threading.Lock()
+_render_key_locks = {}  # report key -> lock held while it is rendered
+_rendered = {}  # report key -> (expires at, rendered report)
 
 def send_email_report(recipient_email, subject, html_content, excel_data=None, filename=None):
     """Send email report with optional Excel attachment"""
     try:
-        if not EMAIL_PASSWORD:
-            logger.error("EMAIL_PASSWORD not configured")
-            return False
-        
-        msg = MIMEMultipart()
-        msg['From'] = EMAIL_FROM
-        msg['To'] = recipient_email
-        msg['Subject'] = subject
-        
-        # Add HTML content
-        msg.attach(MIMEText(html_content, 'html'))
-        
-        # Add Excel attachment if provided
-        if excel_data and filename:
-            part = MIMEBase('application', 'octet-stream')
-            part.set_payload(excel_data)
-            encoders.encode_base64(part)
-            part.add_header(
-                'Content-Disposition',
-                f'attachment; filename= {filename}'
-            )
-            msg.attach(part)
-        
-        # Send email
-        server = smtplib.SMTP(SMTP_SERVER, SMTP_PORT)
-        server.starttls()
-        server.login(EMAIL_FROM, EMAIL_PASSWORD)
-        text = msg.as_string()
-        server.sendmail(EMAIL_FROM, recipient_email, text)
-        server.quit()
-        
-        logger.info(f"Email report sent to {recipient_email}")
-        return True
+        delivery_ids = queue_email([recipient_email], subject, html_content, excel_data, filename)
+        return send_deliveries(delivery_ids).get(delivery_ids[0]) == 'sent'
         
     except Exception as e:
         logger.error(f"Error sending email report: {e}")
         return False
 
 def generate_report_data(start_date, end_date, store_ids=None, counter_ids=None):
-    """Generate report data for specified period and filters"""
-    query = db.session.query(
-        VisitorData.timestamp,
-        Store.name.label('store_name'),
-        VisitorCounter.name.label('counter_name'),
-        VisitorData.entries,
-        VisitorData.exits,
-        VisitorData.current_occupancy
-    ).join(VisitorCounter).join(Store).filter(
+    """Summary of the period computed in SQL, and the detail rows as a query to stream"""
+    filters = [
         VisitorData.timestamp >= start_date,
         VisitorData.timestamp <= end_date
-    )
+    ]
     
     if store_ids:
-        query = query.filter(Store.id.in_(store_ids))
+        filters.append(VisitorCounter.store_id.in_(store_ids))
     
     if counter_ids:
-        query = query.filter(VisitorCounter.id.in_(counter_ids))
+        filters.append(VisitorData.counter_id.in_(counter_ids))
     
-    data = query.order_by(VisitorData.timestamp.desc()).all()
+    # Calculate summary statistics in one aggregate query
+    totals = db.session.query(
+        db.func.count(VisitorData.id).label('rows'),
+        db.func.coalesce(db.func.sum(VisitorData.entries), 0).label('visitors'),
+        db.func.count(db.distinct(VisitorCounter.store_id)).label('stores'),
+        db.func.count(db.distinct(VisitorData.counter_id)).label('counters'),
+        db.func.avg(VisitorData.current_occupancy).label('avg_occupancy')
+    ).select_from(VisitorData).join(VisitorCounter).filter(*filters).one()
     
-    # Calculate summary statistics
-    total_visitors = sum(row.entries for row in data)
-    total_stores = len(set(row.store_name for row in data))
-    total_counters = len(set(row.counter_name for row in data))
-    avg_occupancy = sum(row.current_occupancy for row in data) / len(data) if data else 0
+    query = db.session.query(
+        VisitorData.timestamp,
+        Store.name.label('store_name'),
+        VisitorCounter.name.label('counter_name'),
+        VisitorData.entries,
+        VisitorData.exits,
+        VisitorData.current_occupancy
+    ).select_from(VisitorData).join(VisitorCounter).join(Store).filter(*filters).order_by(VisitorData.timestamp.desc())
     
     return {
-        'data': data,
+        'data': query,
         'summary': {
-            'total_visitors': total_visitors,
-            'total_stores': total_stores,
-            'total_counters': total_counters,
-            'avg_occupancy': round(avg_occupancy, 1),
+            'total_rows': int(totals.rows),
+            'total_visitors': int(totals.visitors),
+            'total_stores': int(totals.stores),
+            'total_counters': int(totals.counters),
+            'avg_occupancy': round(float(totals.avg_occupancy or 0), 1),
             'period_start': start_date.strftime('%Y-%m-%d'),
             'period_end': end_date.strftime('%Y-%m-%d')
         }
     }
 
 def create_excel_report(report_data):
-    """Create Excel report from data"""
-    output = io.BytesIO()
-    
-    # Convert data to DataFrame
-    df = pd.DataFrame([{
-        'Дата и время': row.timestamp.strftime('%Y-%m-%d %H:%M:%S'),
-        'Магазин': row.store_name,
-        'Счетчик': row.counter_name,
-        'Вход': row.entries,
-        'Выход': row.exits,
-        'Текущая посещаемость': row.current_occupancy
-    } for row in report_data['data']])
-    
-    with pd.ExcelWriter(output, engine='openpyxl') as writer:
-        # Main data sheet
-        df.to_excel(writer, sheet_name='Данные посетителей', index=False)
-        
-        # Summary sheet
-        summary_df = pd.DataFrame([{
-            'Показатель': 'Всего посетителей',
-            'Значение': report_data['summary']['total_visitors']
-        }, {
-            'Показатель': 'Магазинов',
-            'Значение': report_data['summary']['total_stores']
-        }, {
-            'Показатель': 'Счетчиков',
-            'Значение': report_data['summary']['total_counters']
-        }, {
-            'Показатель': 'Средняя посещаемость',
-            'Значение': report_data['summary']['avg_occupancy']
-        }, {
-            'Показатель': 'Период с',
-            'Значение': report_data['summary']['period_start']
-        }, {
-            'Показатель': 'Период по',
-            'Значение': report_data['summary']['period_end']
-        }])
-        summary_df.to_excel(writer, sheet_name='Сводка', index=False)
-    
-    output.seek(0)
-    return output.getvalue()
+    """Create Excel report, streaming the detail rows from a server-side cursor"""
+    summary = report_data['summary']
+    path = create_export_file('.xlsx')
+    try:
+        write_xlsx_export(path, report_data['data'].yield_per(EXPORT_BATCH_SIZE), [
+            ['Всего посетителей', summary['total_visitors']],
+            ['Магазинов', summary['total_stores']],
+            ['Счетчиков', summary['total_counters']],
+            ['Средняя посещаемость', summary['avg_occupancy']],
+            ['Период с', summary['period_start']],
+            ['Период по', summary['period_end']]
+        ])
+        with open(path, 'rb') as f:
+            return f.read()
+    finally:
+        remove_file(path)
 
 EMAIL_TEMPLATE = """
 <!DOCTYPE html>
@@ -205,7 +159,12 @@ EMAIL_TEMPLATE = """
         </div>
         
         <h2>Детальные данные</h2>
+        {% if download_url %}
+        <p>Полный отчет с детальными данными доступен для скачивания до {{ link_expires }}:</p>
+        <p><a href="{{ download_url }}">Скачать отчет Excel ({{ attachment_size }})</a></p>
+        {% else %}
         <p>Полный отчет с детальными данными прикреплен в виде Excel файла.</p>
+        {% endif %}
         
         {% if recent_alerts %}
         <h2>Активные алерты</h2>
@@ -235,211 +194,511 @@ EMAIL_TEMPLATE = """
 </body>
 </html>
 """
+register_template('report_email', EMAIL_TEMPLATE)
 
-@reports_bp.route('/schedule')
-@admin_required
-def schedule_reports():
-    """Configure scheduled reports"""
-    users = User.query.filter_by(active=True).all()
-    stores = Store.query.filter_by(active=True).all()
+SCHEDULE_TEMPLATE = """
+<!DOCTYPE html>
+<html lang="ru">
+<head>
+    <meta charset="UTF-8">
+    <meta name="viewport" content="width=device-width, initial-scale=1.0">
+    <title>Настройка отчетов</title>
+    <link href="https://cdn.replit.com/agent/bootstrap-agent-dark-theme.min.css" rel="stylesheet">
+    <link href="https://cdnjs.cloudflare.com/ajax/libs/font-awesome/6.0.0/css/all.min.css" rel="stylesheet">
+</head>
+<body>
+    <nav class="navbar navbar-dark bg-dark">
+        <div class="container-fluid">
+            <a class="navbar-brand" href="/">
+                <i class="fas fa-tachometer-alt me-2"></i>Система управления счетчиками
+            </a>
+            <a class="nav-link" href="/admin">
+                <i class="fas fa-arrow-left me-2"></i>Назад к админ-панели
+            </a>
+        </div>
+    </nav>
     
-    template = """
-    <!DOCTYPE html>
-    <html lang="ru">
-    <head>
-        <meta charset="UTF-8">
-        <meta name="viewport" content="width=device-width, initial-scale=1.0">
-        <title>Настройка отчетов</title>
-        <link href="https://cdn.replit.com/agent/bootstrap-agent-dark-theme.min.css" rel="stylesheet">
-        <link href="https://cdnjs.cloudflare.com/ajax/libs/font-awesome/6.0.0/css/all.min.css" rel="stylesheet">
-    </head>
-    <body>
-        <nav class="navbar navbar-dark bg-dark">
-            <div class="container-fluid">
-                <a class="navbar-brand" href="/">
-                    <i class="fas fa-tachometer-alt me-2"></i>Система управления счетчиками
-                </a>
-                <a class="nav-link" href="/admin">
-                    <i class="fas fa-arrow-left me-2"></i>Назад к админ-панели
-                </a>
-            </div>
-        </nav>
+    <div class="container mt-4">
+        <h2>Настройка автоматических отчетов</h2>
         
-        <div class="container mt-4">
-            <h2>Настройка автоматических отчетов</h2>
-            
-            <div class="card">
-                <div class="card-header">
-                    <h5>Создать новый автоматический отчет</h5>
-                </div>
-                <div class="card-body">
-                    <form method="POST" action="/reports/create-schedule">
-                        <div class="row">
-                            <div class="col-md-6">
-                                <div class="mb-3">
-                                    <label class="form-label">Название отчета</label>
-                                    <input type="text" class="form-control" name="report_name" required>
-                                </div>
-                            </div>
-                            <div class="col-md-6">
-                                <div class="mb-3">
-                                    <label class="form-label">Email получателя</label>
-                                    <select class="form-select" name="recipient_email" required>
-                                        {% for user in users %}
-                                        <option value="{{ user.email }}">{{ user.username }} ({{ user.email }})</option>
-                                        {% endfor %}
-                                    </select>
-                                </div>
+        <div class="card">
+            <div class="card-header">
+                <h5>Создать новый автоматический отчет</h5>
+            </div>
+            <div class="card-body">
+                <form method="POST" action="/reports/create-schedule">
+                    <div class="row">
+                        <div class="col-md-6">
+                            <div class="mb-3">
+                                <label class="form-label">Название отчета</label>
+                                <input type="text" class="form-control" name="report_name" required>
                             </div>
                         </div>
-                        
-                        <div class="row">
-                            <div class="col-md-6">
-                                <div class="mb-3">
-                                    <label class="form-label">Частота отправки</label>
-                                    <select class="form-select" name="frequency" required>
-                                        <option value="daily">Ежедневно</option>
-                                        <option value="weekly">Еженедельно</option>
-                                        <option value="monthly">Ежемесячно</option>
-                                    </select>
-                                </div>
-                            </div>
-                            <div class="col-md-6">
-                                <div class="mb-3">
-                                    <label class="form-label">Время отправки</label>
-                                    <input type="time" class="form-control" name="send_time" value="09:00" required>
-                                </div>
+                        <div class="col-md-6">
+                            <div class="mb-3">
+                                <label class="form-label">Email получателя</label>
+                                <select class="form-select" name="recipient_email" required>
+                                    {% for user in users %}
+                                    <option value="{{ user.email }}">{{ user.username }} ({{ user.email }})</option>
+                                    {% endfor %}
+                                </select>
                             </div>
                         </div>
-                        
-                        <div class="mb-3">
-                            <label class="form-label">Магазины (оставьте пустым для всех)</label>
-                            <select class="form-select" name="store_ids" multiple>
-                                {% for store in stores %}
-                                <option value="{{ store.id }}">{{ store.name }}</option>
-                                {% endfor %}
-                            </select>
+                    </div>
+                    
+                    <div class="row">
+                        <div class="col-md-6">
+                            <div class="mb-3">
+                                <label class="form-label">Частота отправки</label>
+                                <select class="form-select" name="frequency" required>
+                                    <option value="daily">Ежедневно</option>
+                                    <option value="weekly">Еженедельно</option>
+                                    <option value="monthly">Ежемесячно</option>
+                                </select>
+                            </div>
                         </div>
-                        
-                        <div class="form-check mb-3">
-                            <input class="form-check-input" type="checkbox" name="include_alerts" checked>
-                            <label class="form-check-label">Включать активные алерты в отчет</label>
+                        <div class="col-md-6">
+                            <div class="mb-3">
+                                <label class="form-label">Время отправки ({{ timezone }})</label>
+                                <input type="time" class="form-control" name="send_time" value="09:00" required>
+                                <div class="form-text">Еженедельные отчеты отправляются по понедельникам, ежемесячные — 1-го числа. Точное время сдвигается на несколько минут, чтобы отчеты не уходили одновременно.</div>
+                            </div>
                         </div>
-                        
-                        <button type="submit" class="btn btn-primary">
-                            <i class="fas fa-plus me-2"></i>Создать расписание
-                        </button>
-                    </form>
-                </div>
+                    </div>
+                    
+                    <div class="mb-3">
+                        <label class="form-label">Магазины (оставьте пустым для всех)</label>
+                        <select class="form-select" name="store_ids" multiple>
+                            {% for store in stores %}
+                            <option value="{{ store.id }}">{{ store.name }}</option>
+                            {% endfor %}
+                        </select>
+                    </div>
+                    
+                    <div class="form-check mb-3">
+                        <input class="form-check-input" type="checkbox" name="include_alerts" checked>
+                        <label class="form-check-label">Включать активные алерты в отчет</label>
+                    </div>
+                    
+                    <button type="submit" class="btn btn-primary">
+                        <i class="fas fa-plus me-2"></i>Создать расписание
+                    </button>
+                </form>
+            </div>
+        </div>
+        
+        <div class="card mt-4">
+            <div class="card-header">
+                <h5>Автоматические отчеты</h5>
+            </div>
+            <div class="card-body">
+                {% if schedules %}
+                <table class="table table-sm">
+                    <thead>
+                        <tr>
+                            <th>Название</th>
+                            <th>Получатель</th>
+                            <th>Частота</th>
+                            <th>Следующая отправка</th>
+                            <th>Последняя отправка</th>
+                            <th></th>
+                        </tr>
+                    </thead>
+                    <tbody>
+                        {% for schedule in schedules %}
+                        <tr class="{{ '' if schedule.active else 'text-muted' }}">
+                            <td>{{ schedule.name }}</td>
+                            <td>{{ schedule.recipient_email }}</td>
+                            <td>{{ frequency_labels[schedule.frequency] }}, {{ schedule.send_time }}</td>
+                            <td>{{ local_time(schedule.next_run_at).strftime('%d.%m.%Y %H:%M') if schedule.active else 'приостановлен' }}</td>
+                            <td>
+                                {% if schedule.last_run_at %}
+                                {{ local_time(schedule.last_run_at).strftime('%d.%m.%Y %H:%M') }}
+                                <span class="badge bg-{{ 'success' if schedule.last_status == 'sent' else 'danger' if schedule.last_status == 'failed' else 'secondary' }}">{{ schedule.last_status }}</span>
+                                {% else %}—{% endif %}
+                            </td>
+                            <td class="text-end">
+                                <form method="POST" action="/reports/schedule/{{ schedule.id }}/toggle" class="d-inline">
+                                    <button type="submit" class="btn btn-sm btn-outline-secondary">{{ 'Приостановить' if schedule.active else 'Возобновить' }}</button>
+                                </form>
+                                <form method="POST" action="/reports/schedule/{{ schedule.id }}/delete" class="d-inline">
+                                    <button type="submit" class="btn btn-sm btn-outline-danger"><i class="fas fa-trash"></i></button>
+                                </form>
+                            </td>
+                        </tr>
+                        {% endfor %}
+                    </tbody>
+                </table>
+                {% else %}
+                <p class="text-muted mb-0">Автоматических отчетов пока нет</p>
+                {% endif %}
             </div>
-            
-            <div class="card mt-4">
-                <div class="card-header">
-                    <h5>Быстрая отправка отчета</h5>
-                </div>
-                <div class="card-body">
-                    <form method="POST" action="/reports/send-now">
-                        <div class="row">
-                            <div class="col-md-4">
-                                <div class="mb-3">
-                                    <label class="form-label">Email получателя</label>
-                                    <select class="form-select" name="recipient_email" required>
-                                        {% for user in users %}
-                                        <option value="{{ user.email }}">{{ user.username }} ({{ user.email }})</option>
-                                        {% endfor %}
-                                    </select>
-                                </div>
+        </div>
+        
+        <div class="card mt-4">
+            <div class="card-header">
+                <h5>Доставка писем</h5>
+            </div>
+            <div class="card-body">
+                {% if deliveries %}
+                <table class="table table-sm">
+                    <thead>
+                        <tr>
+                            <th>Создано</th>
+                            <th>Получатель</th>
+                            <th>Тема</th>
+                            <th>Статус</th>
+                            <th>Попыток</th>
+                            <th>Ошибка</th>
+                        </tr>
+                    </thead>
+                    <tbody>
+                        {% for delivery in deliveries %}
+                        <tr>
+                            <td>{{ local_time(delivery.created_at).strftime('%d.%m.%Y %H:%M') }}</td>
+                            <td>{{ delivery.recipient }}</td>
+                            <td>{{ delivery.subject }}</td>
+                            <td>
+                                <span class="badge bg-{{ delivery_badges.get(delivery.status, 'secondary') }}">{{ delivery.status }}</span>
+                                {% if delivery.status == 'pending' and delivery.next_attempt_at %}
+                                <small class="text-muted">повтор в {{ local_time(delivery.next_attempt_at).strftime('%H:%M') }}</small>
+                                {% endif %}
+                            </td>
+                            <td>{{ delivery.attempts }}</td>
+                            <td><small>{{ delivery.last_error or '' }}</small></td>
+                        </tr>
+                        {% endfor %}
+                    </tbody>
+                </table>
+                {% else %}
+                <p class="text-muted mb-0">Писем пока не было</p>
+                {% endif %}
+            </div>
+        </div>
+        
+        <div class="card mt-4">
+            <div class="card-header">
+                <h5>Быстрая отправка отчета</h5>
+            </div>
+            <div class="card-body">
+                <form method="POST" action="/reports/send-now">
+                    <div class="row">
+                        <div class="col-md-4">
+                            <div class="mb-3">
+                                <label class="form-label">Получатели</label>
+                                <select class="form-select" name="recipient_email" multiple required>
+                                    {% for user in users %}
+                                    <option value="{{ user.email }}">{{ user.username }} ({{ user.email }})</option>
+                                    {% endfor %}
+                                </select>
                             </div>
-                            <div class="col-md-4">
-                                <div class="mb-3">
-                                    <label class="form-label">Период</label>
-                                    <select class="form-select" name="period" required>
-                                        <option value="today">Сегодня</option>
-                                        <option value="yesterday">Вчера</option>
-                                        <option value="week">Последняя неделя</option>
-                                        <option value="month">Последний месяц</option>
-                                    </select>
-                                </div>
+                        </div>
+                        <div class="col-md-4">
+                            <div class="mb-3">
+                                <label class="form-label">Период</label>
+                                <select class="form-select" name="period" required>
+                                    <option value="today">Сегодня</option>
+                                    <option value="yesterday">Вчера</option>
+                                    <option value="week">Последняя неделя</option>
+                                    <option value="month">Последний месяц</option>
+                                </select>
                             </div>
-                            <div class="col-md-4">
-                                <div class="mb-3">
-                                    <label class="form-label">&nbsp;</label>
-                                    <button type="submit" class="btn btn-success w-100">
-                                        <i class="fas fa-paper-plane me-2"></i>Отправить сейчас
-                                    </button>
-                                </div>
+                        </div>
+                        <div class="col-md-4">
+                            <div class="mb-3">
+                                <label class="form-label">&nbsp;</label>
+                                <button type="submit" class="btn btn-success w-100">
+                                    <i class="fas fa-paper-plane me-2"></i>Отправить сейчас
+                                </button>
                             </div>
                         </div>
-                    </form>
-                </div>
+                    </div>
+                </form>
             </div>
         </div>
-        
-        <script src="https://cdn.jsdelivr.net/npm/bootstrap@5.3.0/dist/js/bootstrap.bundle.min.js"></script>
-    </body>
-    </html>
-    """
+    </div>
     
-    return render_template_string(template, users=users, stores=stores)
+    <script src="https://cdn.jsdelivr.net/npm/bootstrap@5.3.0/dist/js/bootstrap.bundle.min.js"></script>
+</body>
+</html>
+"""
+register_template('report_schedule', SCHEDULE_TEMPLATE)
 
-@reports_bp.route('/send-now', methods=['POST'])
+@reports_bp.route('/schedule')
 @admin_required
-def send_report_now():
-    """Send report immediately"""
+def schedule_reports():
+    """Configure scheduled reports"""
+    users = User.query.filter_by(active=True).all()
+    stores = Store.query.filter_by(active=True).all()
+    schedules = ReportSchedule.query.order_by(ReportSchedule.next_run_at).all()
+    deliveries = EmailDelivery.query.order_by(EmailDelivery.id.desc()).limit(50).all()
+    
+    return render_inline('report_schedule', users=users, stores=stores, schedules=schedules, deliveries=deliveries,
+                         frequency_labels=FREQUENCY_LABELS, delivery_badges=DELIVERY_BADGES, local_time=local_time, timezone=REPORT_TIMEZONE)
+
+@reports_bp.route('/create-schedule', methods=['POST'])
+@admin_required
+def create_schedule():
+    """Create a scheduled report"""
     try:
+        frequency = request.form.get('frequency')
+        send_time = request.form.get('send_time', '')
+        name = request.form.get('report_name', '').strip()
         recipient_email = request.form.get('recipient_email')
-        period = request.form.get('period')
+        try:
+            hour, minute = (int(part) for part in send_time.split(':'))
+            valid_time = 0 <= hour < 24 and 0 <= minute < 60
+        except ValueError:
+            valid_time = False
+        if frequency not in FREQUENCIES or not valid_time or not name or not recipient_email:
+            flash('Проверьте параметры расписания', 'error')
+            return redirect(url_for('reports.schedule_reports'))
         
-        # Calculate date range
-        now = datetime.now(timezone.utc)
-        if period == 'today':
-            start_date = now.replace(hour=0, minute=0, second=0, microsecond=0)
-            end_date = now
-        elif period == 'yesterday':
-            start_date = (now - timedelta(days=1)).replace(hour=0, minute=0, second=0, microsecond=0)
-            end_date = now.replace(hour=0, minute=0, second=0, microsecond=0)
-        elif period == 'week':
-            start_date = now - timedelta(days=7)
-            end_date = now
-        elif period == 'month':
-            start_date = now - timedelta(days=30)
-            end_date = now
-        else:
-            start_date = now - timedelta(days=7)
-            end_date = now
+        send_time = f"{hour:02d}:{minute:02d}"
+        jitter = random_jitter()
+        schedule = ReportSchedule(
+            name=name,
+            recipient_email=recipient_email,
+            frequency=frequency,
+            send_time=send_time,
+            jitter_seconds=jitter,
+            store_ids=json.dumps(sorted({int(store_id) for store_id in request.form.getlist('store_ids')})),
+            include_alerts=bool(request.form.get('include_alerts')),
+            next_run_at=next_run_time(frequency, send_time, utcnow(), jitter),
+            created_by=get_current_user().id
+        )
+        db.session.add(schedule)
+        db.session.commit()
+        flash(f'Расписание «{name}» создано', 'success')
         
-        # Generate report
-        report_data = generate_report_data(start_date, end_date)
-        excel_data = create_excel_report(report_data)
+    except Exception as e:
+        db.session.rollback()
+        logger.error(f"Error creating report schedule: {e}")
+        flash('Ошибка при создании расписания', 'error')
+    
+    return redirect(url_for('reports.schedule_reports'))
+
+@reports_bp.route('/schedule/<int:schedule_id>/toggle', methods=['POST'])
+@admin_required
+def toggle_schedule(schedule_id):
+    """Pause or resume a scheduled report"""
+    schedule = db.session.get(ReportSchedule, schedule_id)
+    if schedule:
+        schedule.active = not schedule.active
+        if schedule.active:
+            # Resume from now instead of catching up on missed runs
+            schedule.next_run_at = next_run_time(schedule.frequency, schedule.send_time, utcnow(),
+                                                 schedule.jitter_seconds)
+        db.session.commit()
+    return redirect(url_for('reports.schedule_reports'))
+
+@reports_bp.route('/schedule/<int:schedule_id>/delete', methods=['POST'])
+@admin_required
+def delete_schedule(schedule_id):
+    """Delete a scheduled report"""
+    schedule = db.session.get(ReportSchedule, schedule_id)
+    if schedule:
+        db.session.delete(schedule)
+        db.session.commit()
+        flash(f'Расписание «{schedule.name}» удалено', 'success')
+    return redirect(url_for('reports.schedule_reports'))
+
+@reports_bp.route('/download/<token>')
+def download_report(token):
+    """Stream a report file from a signed email link"""
+    resolved = resolve_report_token(token)
+    if resolved is None:
+        abort(404)
+    if resolved == 'expired':
+        return 'Срок действия ссылки истек', 410
+    
+    path, filename = resolved
+    return send_file(path, mimetype=XLSX_MIMETYPE, as_attachment=True, download_name=filename, conditional=True)
+
+@reports_bp.route('/send-now', methods=['POST'])
+@admin_required
+def send_report_now():
+    """Queue a report to be generated and sent"""
+    recipient_emails = [email.strip() for email in request.form.getlist('recipient_email') if email.strip()]
+    if not recipient_emails:
+        flash('Укажите хотя бы одного получателя', 'error')
+        return redirect(url_for('reports.schedule_reports'))
+    
+    try:
+        current_user = get_current_user()
+        job = submit_job(current_user.id, 'report_email', {
+            'recipient_emails': recipient_emails,
+            'period': request.form.get('period')
+        })
+        flash(f'Отчет поставлен в очередь на отправку (задание {job.id[:8]})', 'success')
         
-        # Get recent alerts
+    except Exception as e:
+        logger.error(f"Error queueing report: {e}")
+        flash('Ошибка при создании отчета', 'error')
+    
+    return redirect(url_for('reports.schedule_reports'))
+
+def report_period(period, now):
+    """Start and end of a report period; days, weeks and months end at the last midnight in the timezone of now"""
+    midnight = now.replace(hour=0, minute=0, second=0, microsecond=0)
+    if period == 'today':
+        start_date = midnight
+        end_date = now
+    elif period == 'yesterday':
+        start_date = midnight - timedelta(days=1)
+        end_date = midnight
+    elif period == 'month':
+        start_date = midnight - timedelta(days=30)
+        end_date = midnight
+    else:
+        # Whole days only, so a copy rendered overnight covers the same window as the morning send
+        start_date = midnight - timedelta(days=7)
+        end_date = midnight
+    return start_date, end_date
+
+def report_key(period, store_ids=None, include_alerts=True, run_at=None):
+    """Requests with the same key get identical reports; the period is taken at run_at, by default now in REPORT_TIMEZONE"""
+    start_date, end_date = report_period(period, run_at or local_time(utcnow()))
+    return (period, start_date.astimezone(timezone.utc), end_date.astimezone(timezone.utc),
+            tuple(sorted(set(store_ids or []))), bool(include_alerts))
+
+def build_report(key, set_progress=None):
+    """Query the data and render the subject, HTML body and Excel attachment of a report key"""
+    period, start_date, end_date, store_ids, include_alerts = key
+    now = datetime.now(timezone.utc)
+    
+    # Generate report
+    report_data = generate_report_data(start_date, end_date, store_ids=list(store_ids))
+    if set_progress:
+        set_progress(50)
+    excel_data = create_excel_report(report_data)
+    filename = f"visitor_report_{period}_{local_time(end_date).strftime('%Y%m%d')}.xlsx"
+    
+    # Large files are stored once and linked instead of attached to every email
+    download_url = None
+    if use_link(len(excel_data)):
+        download_url = store_report_file(excel_data, filename)
+    
+    # Get recent alerts
+    recent_alerts = []
+    if include_alerts:
         recent_alerts = Alert.query.filter_by(is_resolved=False).order_by(
             Alert.created_at.desc()
         ).limit(10).all()
+    
+    # Create email content
+    email_content = render_inline('report_email',
+                                summary=report_data['summary'],
+                                recent_alerts=recent_alerts,
+                                generation_time=now.strftime('%Y-%m-%d %H:%M:%S'),
+                                download_url=download_url,
+                                attachment_size=f"{len(excel_data) / 1024 / 1024:.1f} МБ",
+                                link_expires=(now + timedelta(seconds=REPORT_LINK_TTL)).strftime('%d.%m.%Y'))
+    
+    return {
+        'subject': f"Отчет по посещаемости - {period}",
+        'html': email_content,
+        'attachment': None if download_url else excel_data,
+        'filename': filename
+    }
+
+def render_report(period, store_ids=None, include_alerts=True, set_progress=None, run_at=None):
+    """Report for a key, rendered once within REPORT_RENDER_TTL; for a scheduled run_at, tonight's stored copy is used if any"""
+    key = report_key(period, store_ids, include_alerts, run_at)
+    with _render_lock:
+        key_lock = _render_key_locks.setdefault(key, threading.Lock())
+    
+    # Concurrent requests for the same report wait for the first render
+    with key_lock:
+        with _render_lock:
+            cached = _rendered.get(key)
+        if cached and cached[0] > time.time():
+            return cached[1]
         
-        # Create email content
-        email_content = render_template_string(EMAIL_TEMPLATE,
-                                             summary=report_data['summary'],
-                                             recent_alerts=recent_alerts,
-                                             generation_time=now.strftime('%Y-%m-%d %H:%M:%S'))
-        
-        filename = f"visitor_report_{period}_{now.strftime('%Y%m%d')}.xlsx"
-        subject = f"Отчет по посещаемости - {period}"
-        
-        success = send_email_report(recipient_email, subject, email_content, excel_data, filename)
-        
-        if success:
-            flash('Отчет успешно отправлен', 'success')
-        else:
-            flash('Ошибка при отправке отчета. Проверьте настройки email.', 'error')
+        if run_at:
+            report = load_prerendered(key, run_at.date())
+            if report:
+                return report
         
-    except Exception as e:
-        logger.error(f"Error sending report: {e}")
-        flash('Ошибка при создании отчета', 'error')
+        report = build_report(key, set_progress)
+        with _render_lock:
+            expired = [k for k, (expires, _) in _rendered.items() if expires <= time.time()]
+            for k in expired:
+                del _rendered[k]
+                _render_key_locks.pop(k, None)
+            _rendered[key] = (time.time() + REPORT_RENDER_TTL, report)
+        return report
+
+def deliver_report(recipients, period, store_ids=None, include_alerts=True, set_progress=None, run_at=None):
+    """Render a report once and email it to every recipient; returns the delivery status per recipient"""
+    report = render_report(period, store_ids, include_alerts, set_progress, run_at)
+    recipients = list(dict.fromkeys(recipients))
+    delivery_ids = queue_email(recipients, report['subject'], report['html'], report['attachment'], report['filename'])
+    statuses = send_deliveries(delivery_ids)
+    return {recipient: statuses.get(delivery_id) for recipient, delivery_id in zip(recipients, delivery_ids)}
+
+@register_job_handler('report_email')
+def send_report_job(job_id, params, set_progress):
+    """Generate a report and email it to its recipients, in the export job pool"""
+    statuses = deliver_report(params['recipient_emails'], params['period'], set_progress=set_progress)
+    failed = [recipient for recipient, status in statuses.items() if status == 'failed']
+    if failed:
+        raise RuntimeError(f"Report email to {', '.join(failed)} was not sent")
+
+def send_scheduled_reports(schedule_ids, run_at):
+    """Send the reports of claimed schedules sharing period, scope and local run time; returns an error per failed schedule"""
+    schedules = ReportSchedule.query.filter(ReportSchedule.id.in_(schedule_ids)).all()
+    if not schedules:
+        return {}
     
-    return redirect(url_for('reports.schedule_reports'))
+    first = schedules[0]
+    statuses = deliver_report([schedule.recipient_email for schedule in schedules],
+                              FREQUENCY_PERIODS[first.frequency],
+                              store_ids=json.loads(first.store_ids or '[]'),
+                              include_alerts=first.include_alerts,
+                              run_at=run_at)
+    errors = {}
+    for schedule in schedules:
+        status = statuses.get(schedule.recipient_email)
+        if status == 'pending':
+            errors[schedule.id] = 'Письмо не доставлено, запланирована повторная отправка'
+        elif status != 'sent':
+            errors[schedule.id] = 'Отчет не отправлен'
+    return errors
+
+def prerender_scheduled_reports():
+    """Render the reports of schedules due within REPORT_PRERENDER_HORIZON and store them for their run"""
+    now = utcnow()
+    purge_prerendered(local_time(now).date())
+    
+    schedules = ReportSchedule.query.filter(
+        ReportSchedule.active.is_(True),
+        ReportSchedule.next_run_at > now,
+        ReportSchedule.next_run_at <= now + timedelta(hours=REPORT_PRERENDER_HORIZON)
+    ).all()
+    runs = {}
+    for schedule in schedules:
+        # The period ends at the scheduled local run time, as it will when the run is sent
+        run_at = run_slot(schedule.send_time, schedule.next_run_at)
+        key = report_key(FREQUENCY_PERIODS[schedule.frequency], json.loads(schedule.store_ids or '[]'),
+                         schedule.include_alerts, run_at)
+        runs[key] = run_at.date()
+    
+    rendered = 0
+    for key, run_date in runs.items():
+        if not claim_prerender(key, run_date):
+            continue
+        try:
+            store_prerender(key, run_date, build_report(key))
+            rendered += 1
+        except Exception as e:
+            logger.error(f"Error pre-rendering report {key}: {e}")
+            db.session.rollback()
+            release_prerender(key, run_date)
+    
+    if rendered:
+        logger.info(f"Pre-rendered {rendered} scheduled reports")
 
-def start_scheduler():
-    """Start the report scheduler in a separate thread"""
-    # TODO: Implement scheduling when schedule module is available
-    logger.info("Report scheduler placeholder - implement when schedule module available")
\ No newline at end of file
+def start_scheduler(app):
+    """Start the report scheduler of this process"""
+    start_report_scheduler(app, send_scheduled_reports, prerender_scheduled_reports)
@@ -4,16 +4,29 @@ Main entry point for visitor counter management system
 """
 
 import os
+import json
+import time
+import hashlib
 import logging
+from functools import lru_cache
 from datetime import datetime, timedelta, timezone
-from flask import Flask, render_template_string, jsonify, request, redirect, url_for, session, send_file
+from flask import Flask, Response, jsonify, request, redirect, url_for, session, send_file, make_response, stream_with_context, g
 from database import db, Base
-from database.models import User, Store, VisitorCounter, VisitorData, Alert, AuditLog, Role
+from database.models import User, Store, VisitorCounter, Alert, AuditLog, Role, ExportJob
 from auth_routes import auth_bp, login_required, get_current_user
 from admin_interface import admin_bp
 from utils.auth import create_default_admin
-import pandas as pd
-import io
+from utils.counter_state import backfill_counter_states
+from utils.metrics import EMPTY_METRICS, EMPTY_CHART_DATA, compute_alerts_version
+from utils.http_cache import compute_etag, not_modified_response, set_cache_validators
+from utils.precompute import get_scope_aggregates, scope_key, start_precompute_worker
+from utils.mailer import start_mail_worker
+from utils.activity import start_activity_worker
+from utils.pubsub import subscribe, unsubscribe
+from utils.templates import register_template, render_inline, compile_templates
+from utils.exports import (EXPORT_BATCH_SIZE, XLSX_MIMETYPE, export_query, export_totals, write_xlsx_export,
+                           xlsx_summary, create_export_file, stream_file, remove_file, stream_csv_gzip)
+from utils.export_jobs import FILE_EXTENSIONS, submit_job, job_status, export_cache_key
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -41,13 +54,25 @@ app.register_blueprint(admin_bp)
 from api_endpoints import api_bp
 app.register_blueprint(api_bp)
 
-# Import and register email reports (temporarily disabled due to import issues)
-# from email_reports import reports_bp
-# app.register_blueprint(reports_bp)
+# Import and register email reports
+from email_reports import reports_bp, start_scheduler
+app.register_blueprint(reports_bp)
 
 # Set session timeout
 app.permanent_session_lifetime = timedelta(hours=8)
 
+# Live update stream: keepalive interval and maximum connection time (seconds)
+STREAM_KEEPALIVE = 15
+STREAM_MAX_DURATION = int(os.environ.get("STREAM_MAX_DURATION", "300"))
+
+@app.before_request
+def start_background_workers():
+    """Start per-process background workers on first request"""
+    start_precompute_worker(app)
+    start_scheduler(app)
+    start_mail_worker(app)
+    start_activity_worker(app)
+
 # Dashboard template with charts and role hierarchy
 DASHBOARD_TEMPLATE = """
 <!DOCTYPE html>
@@ -101,12 +126,20 @@ DASHBOARD_TEMPLATE = """
                         <i class="fas fa-download me-2"></i>Отчеты
                     </a>
                     <ul class="dropdown-menu">
-                        <li><a class="dropdown-item" href="/export/excel?period=week">
+                        <li><a class="dropdown-item" href="/export/excel?period=week" onclick="return startExport('xlsx', 'week');">
                             <i class="fas fa-file-excel me-2"></i>Экспорт за неделю
                         </a></li>
-                        <li><a class="dropdown-item" href="/export/excel?period=month">
+                        <li><a class="dropdown-item" href="/export/excel?period=month" onclick="return startExport('xlsx', 'month');">
                             <i class="fas fa-file-excel me-2"></i>Экспорт за месяц
                         </a></li>
+                        <li><a class="dropdown-item" href="/export/csv?period=month" onclick="return startExport('csv', 'month');">
+                            <i class="fas fa-file-csv me-2"></i>Данные за месяц (CSV)
+                        </a></li>
+                        {% if current_user.role.name in ('admin', 'rd') %}
+                        <li><a class="dropdown-item" href="#" onclick="return startExport('stores_xlsx', 'month');">
+                            <i class="fas fa-layer-group me-2"></i>По магазинам за месяц
+                        </a></li>
+                        {% endif %}
                         <li><hr class="dropdown-divider"></li>
                         <li><a class="dropdown-item" href="/reports/schedule">
                             <i class="fas fa-calendar me-2"></i>Настройка отчетов
@@ -121,13 +154,16 @@ DASHBOARD_TEMPLATE = """
     </nav>
 
     <div class="container-fluid mt-4">
+        <!-- Queued export progress -->
+        <div id="export-status" class="alert alert-info" style="display: none;"></div>
+        
         <!-- Access Level Info -->
         <div class="row mb-3">
             <div class="col-12">
                 <div class="alert alert-info">
                     <i class="fas fa-info-circle me-2"></i>
-                    Уровень доступа: {{ access_level }}. 
-                    Доступно магазинов: {{ accessible_stores|length }}, счетчиков: {{ accessible_counters|length }}
+                    Уровень доступа: <span id="accessLevel">…</span>. 
+                    Доступно магазинов: <span id="storesCount">—</span>, счетчиков: <span id="countersCount">—</span>
                 </div>
             </div>
         </div>
@@ -140,7 +176,7 @@ DASHBOARD_TEMPLATE = """
                         <div class="d-flex justify-content-between align-items-center">
                             <div>
                                 <h6 class="card-subtitle mb-2 text-muted">Посетители за сегодня</h6>
-                                <h3 class="card-title mb-0" id="totalVisitors">{{ metrics.total_visitors }}</h3>
+                                <h3 class="card-title mb-0" id="totalVisitors">—</h3>
                             </div>
                             <div class="text-primary">
                                 <i class="fas fa-users fa-2x"></i>
@@ -156,7 +192,7 @@ DASHBOARD_TEMPLATE = """
                         <div class="d-flex justify-content-between align-items-center">
                             <div>
                                 <h6 class="card-subtitle mb-2 text-muted">Текущая посещаемость</h6>
-                                <h3 class="card-title mb-0" id="currentOccupancy">{{ metrics.current_occupancy }}</h3>
+                                <h3 class="card-title mb-0" id="currentOccupancy">—</h3>
                             </div>
                             <div class="text-success">
                                 <i class="fas fa-chart-line fa-2x"></i>
@@ -172,7 +208,7 @@ DASHBOARD_TEMPLATE = """
                         <div class="d-flex justify-content-between align-items-center">
                             <div>
                                 <h6 class="card-subtitle mb-2 text-muted">Активные счетчики</h6>
-                                <h3 class="card-title mb-0" id="onlineCounters">{{ metrics.online_counters }}/{{ metrics.total_counters }}</h3>
+                                <h3 class="card-title mb-0" id="onlineCounters">—</h3>
                             </div>
                             <div class="text-info">
                                 <i class="fas fa-microchip fa-2x"></i>
@@ -188,7 +224,7 @@ DASHBOARD_TEMPLATE = """
                         <div class="d-flex justify-content-between align-items-center">
                             <div>
                                 <h6 class="card-subtitle mb-2 text-muted">Активные алерты</h6>
-                                <h3 class="card-title mb-0" id="activeAlerts">{{ metrics.active_alerts }}</h3>
+                                <h3 class="card-title mb-0" id="activeAlerts">—</h3>
                             </div>
                             <div class="text-warning">
                                 <i class="fas fa-exclamation-triangle fa-2x"></i>
@@ -257,20 +293,8 @@ DASHBOARD_TEMPLATE = """
                                         <th>Последнее обновление</th>
                                     </tr>
                                 </thead>
-                                <tbody>
-                                    {% for counter in accessible_counters %}
-                                    <tr>
-                                        <td>{{ counter.name }}</td>
-                                        <td>{{ counter.store.name }}</td>
-                                        <td>{{ counter.today_visitors }}</td>
-                                        <td>
-                                            <span class="badge bg-{{ 'success' if counter.is_online else 'danger' }}">
-                                                {{ 'Онлайн' if counter.is_online else 'Офлайн' }}
-                                            </span>
-                                        </td>
-                                        <td>{{ counter.last_update.strftime('%H:%M') if counter.last_update else 'Нет данных' }}</td>
-                                    </tr>
-                                    {% endfor %}
+                                <tbody id="countersTableBody">
+                                    <tr><td colspan="5" class="text-muted">Загрузка...</td></tr>
                                 </tbody>
                             </table>
                         </div>
@@ -283,14 +307,8 @@ DASHBOARD_TEMPLATE = """
                     <div class="card-header">
                         <h5 class="mb-0">Активные алерты</h5>
                     </div>
-                    <div class="card-body">
-                        {% for alert in recent_alerts %}
-                        <div class="alert alert-{{ 'danger' if alert.severity == 'critical' else 'warning' if alert.severity == 'high' else 'info' }} alert-sm">
-                            <strong>{{ alert.counter.store.name }}</strong><br>
-                            <small>{{ alert.message }}</small><br>
-                            <small class="text-muted">{{ alert.created_at.strftime('%d.%m.%Y %H:%M') }}</small>
-                        </div>
-                        {% endfor %}
+                    <div class="card-body" id="alertsList">
+                        <span class="text-muted">Загрузка...</span>
                     </div>
                 </div>
             </div>
@@ -299,20 +317,74 @@ DASHBOARD_TEMPLATE = """
 
     <script src="https://cdn.jsdelivr.net/npm/bootstrap@5.3.0/dist/js/bootstrap.bundle.min.js"></script>
     <script>
-        // Initialize charts
+        // Render the shell first, then load every block in parallel
         document.addEventListener('DOMContentLoaded', function() {
-            initTrafficChart();
-            initHourlyChart();
-            initStoreChart();
+            loadMetrics();
+            loadCharts();
+            loadCounters();
+            loadAlerts();
             
-            // Auto-update every 30 seconds
-            setInterval(updateMetrics, 30000);
+            // Live updates pushed by the server
+            startLiveUpdates();
         });
 
-        function initTrafficChart() {
+        const chartLayout = {
+            paper_bgcolor: 'transparent',
+            plot_bgcolor: 'transparent',
+            font: { color: '#ffffff' },
+            margin: { t: 20, r: 20, b: 50, l: 50 }
+        };
+
+        function fetchData(url) {
+            // The browser revalidates with If-None-Match and reuses the body on 304
+            return fetch(url, { credentials: 'same-origin' })
+                .then(response => response.json())
+                .then(data => {
+                    if (!data.success) throw new Error(data.error || 'Request failed');
+                    return data;
+                });
+        }
+
+        function loadMetrics() {
+            fetchData('/dashboard/data/metrics')
+                .then(data => {
+                    document.getElementById('accessLevel').textContent = data.access_level;
+                    document.getElementById('storesCount').textContent = data.stores_count;
+                    document.getElementById('countersCount').textContent = data.counters_count;
+                    applyMetrics(data.metrics);
+                })
+                .catch(error => console.error('Error loading metrics:', error));
+        }
+
+        function loadCharts() {
+            fetchData('/dashboard/data/charts')
+                .then(data => {
+                    renderTrafficChart(data.charts);
+                    renderHourlyChart(data.charts);
+                    renderStoreChart(data.charts);
+                })
+                .catch(error => console.error('Error loading charts:', error));
+        }
+
+        function loadCounters() {
+            fetchData('/dashboard/data/counters')
+                .then(data => renderCounters(data.counters))
+                .catch(error => console.error('Error loading counters:', error));
+        }
+
+        function loadAlerts() {
+            fetchData('/dashboard/data/alerts')
+                .then(data => {
+                    document.getElementById('alertsList').replaceChildren();
+                    data.alerts.slice().reverse().forEach(prependAlert);
+                })
+                .catch(error => console.error('Error loading alerts:', error));
+        }
+
+        function renderTrafficChart(charts) {
             const trace = {
-                x: {{ chart_data.daily_dates | safe }},
-                y: {{ chart_data.daily_visitors | safe }},
+                x: charts.daily_dates,
+                y: charts.daily_visitors,
                 type: 'scatter',
                 mode: 'lines+markers',
                 line: { color: '#0d6efd', width: 3 },
@@ -320,78 +392,263 @@ DASHBOARD_TEMPLATE = """
                 name: 'Посетители'
             };
 
-            const layout = {
-                paper_bgcolor: 'transparent',
-                plot_bgcolor: 'transparent',
-                font: { color: '#ffffff' },
+            const layout = Object.assign({}, chartLayout, {
                 xaxis: { gridcolor: '#444' },
-                yaxis: { gridcolor: '#444' },
-                margin: { t: 20, r: 20, b: 50, l: 50 }
-            };
+                yaxis: { gridcolor: '#444' }
+            });
 
-            Plotly.newPlot('trafficChart', [trace], layout, {responsive: true});
+            Plotly.react('trafficChart', [trace], layout, {responsive: true});
         }
 
-        function initHourlyChart() {
+        function renderHourlyChart(charts) {
             const trace = {
-                x: {{ chart_data.hourly_hours | safe }},
-                y: {{ chart_data.hourly_visitors | safe }},
+                x: charts.hourly_hours,
+                y: charts.hourly_visitors,
                 type: 'bar',
                 marker: { color: '#198754' },
                 name: 'Посетители по часам'
             };
 
-            const layout = {
-                paper_bgcolor: 'transparent',
-                plot_bgcolor: 'transparent',
-                font: { color: '#ffffff' },
+            const layout = Object.assign({}, chartLayout, {
                 xaxis: { gridcolor: '#444', title: 'Час' },
-                yaxis: { gridcolor: '#444', title: 'Посетители' },
-                margin: { t: 20, r: 20, b: 50, l: 50 }
-            };
+                yaxis: { gridcolor: '#444', title: 'Посетители' }
+            });
 
-            Plotly.newPlot('hourlyChart', [trace], layout, {responsive: true});
+            Plotly.react('hourlyChart', [trace], layout, {responsive: true});
         }
 
-        function initStoreChart() {
+        function renderStoreChart(charts) {
             const trace = {
-                x: {{ chart_data.store_names | safe }},
-                y: {{ chart_data.store_visitors | safe }},
+                x: charts.store_names,
+                y: charts.store_visitors,
                 type: 'bar',
                 marker: { color: '#0dcaf0' },
                 name: 'Посетители по магазинам'
             };
 
-            const layout = {
-                paper_bgcolor: 'transparent',
-                plot_bgcolor: 'transparent',
-                font: { color: '#ffffff' },
+            const layout = Object.assign({}, chartLayout, {
                 xaxis: { gridcolor: '#444', title: 'Магазины' },
                 yaxis: { gridcolor: '#444', title: 'Посетители' },
                 margin: { t: 20, r: 20, b: 80, l: 50 }
-            };
+            });
 
-            Plotly.newPlot('storeChart', [trace], layout, {responsive: true});
+            Plotly.react('storeChart', [trace], layout, {responsive: true});
         }
 
-        function updateMetrics() {
-            fetch('/api/metrics')
+        function renderCounters(counters) {
+            const body = document.getElementById('countersTableBody');
+            body.replaceChildren(...counters.map(counter => {
+                const row = document.createElement('tr');
+                row.dataset.counterId = counter.id;
+                const cells = [counter.name, counter.store_name, counter.today_visitors, null, counter.last_update || 'Нет данных'];
+                cells.forEach((value, index) => {
+                    const cell = document.createElement('td');
+                    if (index === 2) cell.className = 'today-visitors';
+                    if (index === 4) cell.className = 'last-update';
+                    if (index === 3) {
+                        const badge = document.createElement('span');
+                        badge.className = 'badge online-status';
+                        cell.appendChild(badge);
+                    } else {
+                        cell.textContent = value;
+                    }
+                    row.appendChild(cell);
+                });
+                return row;
+            }));
+            counters.forEach(counter => applyStatus({counter_id: counter.id, online: counter.is_online}));
+        }
+
+        function startExport(format, period) {
+            // Exports run as background jobs: queue, poll, then download
+            const status = document.getElementById('export-status');
+            status.className = 'alert alert-info';
+            status.style.display = 'block';
+            status.textContent = 'Подготовка файла...';
+            fetch('/export/jobs', {
+                method: 'POST',
+                credentials: 'same-origin',
+                headers: { 'Content-Type': 'application/json' },
+                body: JSON.stringify({ format: format, period: period })
+            })
                 .then(response => response.json())
                 .then(data => {
-                    if (data.success) {
-                        document.getElementById('totalVisitors').textContent = data.metrics.total_visitors;
-                        document.getElementById('currentOccupancy').textContent = data.metrics.current_occupancy;
-                        document.getElementById('onlineCounters').textContent = 
-                            data.metrics.online_counters + '/' + data.metrics.total_counters;
-                        document.getElementById('activeAlerts').textContent = data.metrics.active_alerts;
-                    }
+                    if (!data.success) throw new Error(data.error);
+                    pollExport(data.job);
                 })
-                .catch(error => console.error('Error updating metrics:', error));
+                .catch(error => showExportError(error));
+            return false;
+        }
+
+        function pollExport(job) {
+            const status = document.getElementById('export-status');
+            if (job.status === 'done') {
+                status.className = 'alert alert-success';
+                status.innerHTML = 'Файл готов: <a href="' + job.download_url + '">скачать</a>';
+                window.location = job.download_url;
+                return;
+            }
+            if (job.status === 'failed') {
+                showExportError(new Error(job.error));
+                return;
+            }
+            status.textContent = 'Подготовка файла' + (job.progress !== null ? ': ' + job.progress + '%' : '...');
+            setTimeout(() => fetchData(job.status_url).then(data => pollExport(data.job)).catch(showExportError), 1000);
+        }
+
+        function showExportError(error) {
+            const status = document.getElementById('export-status');
+            status.className = 'alert alert-danger';
+            status.textContent = 'Ошибка при экспорте данных' + (error && error.message ? ': ' + error.message : '');
+        }
+
+        function formatNumber(num) {
+            return Number(num).toLocaleString('ru-RU');
+        }
+
+        function startLiveUpdates() {
+            if (!window.EventSource) {
+                // Fall back to polling every 30 seconds
+                setInterval(function() {
+                    loadMetrics();
+                    loadCounters();
+                    loadAlerts();
+                }, 30000);
+                return;
+            }
+
+            const source = new EventSource('/api/stream');
+            source.addEventListener('metrics', e => {
+                applyMetrics(JSON.parse(e.data));
+                loadCharts();
+            });
+            source.addEventListener('entries', e => applyEntries(JSON.parse(e.data)));
+            source.addEventListener('status', e => applyStatus(JSON.parse(e.data)));
+            source.addEventListener('alert', e => prependAlert(JSON.parse(e.data)));
+            source.addEventListener('resync', () => window.location.reload());
+        }
+
+        function applyMetrics(metrics) {
+            document.getElementById('totalVisitors').textContent = formatNumber(metrics.total_visitors);
+            document.getElementById('currentOccupancy').textContent = formatNumber(metrics.current_occupancy);
+            document.getElementById('onlineCounters').textContent =
+                metrics.online_counters + '/' + metrics.total_counters;
+            document.getElementById('activeAlerts').textContent = metrics.active_alerts;
+        }
+
+        function applyEntries(event) {
+            const row = document.querySelector(`tr[data-counter-id="${event.counter_id}"]`);
+            if (!row) return;
+            const today = row.querySelector('.today-visitors');
+            today.textContent = (parseInt(today.textContent, 10) || 0) + event.entries;
+            const time = new Date(event.timestamp);
+            row.querySelector('.last-update').textContent =
+                String(time.getHours()).padStart(2, '0') + ':' + String(time.getMinutes()).padStart(2, '0');
+            applyStatus({counter_id: event.counter_id, online: true});
+        }
+
+        function applyStatus(event) {
+            const row = document.querySelector(`tr[data-counter-id="${event.counter_id}"]`);
+            if (!row) return;
+            const badge = row.querySelector('.online-status');
+            badge.classList.toggle('bg-success', event.online);
+            badge.classList.toggle('bg-danger', !event.online);
+            badge.textContent = event.online ? 'Онлайн' : 'Офлайн';
+        }
+
+        function prependAlert(alert) {
+            const level = alert.severity === 'critical' ? 'danger' : alert.severity === 'high' ? 'warning' : 'info';
+            const item = document.createElement('div');
+            item.className = `alert alert-${level} alert-sm`;
+            const store = document.createElement('strong');
+            store.textContent = alert.store_name;
+            const message = document.createElement('small');
+            message.textContent = alert.message;
+            const created = document.createElement('small');
+            created.className = 'text-muted';
+            created.textContent = new Date(alert.created_at).toLocaleString('ru-RU');
+            item.append(store, document.createElement('br'), message, document.createElement('br'), created);
+            document.getElementById('alertsList').prepend(item);
         }
     </script>
 </body>
 </html>
 """
+register_template('dashboard', DASHBOARD_TEMPLATE)
+
+# Changes whenever the shell template changes, so cached shells are revalidated
+DASHBOARD_SHELL_VERSION = hashlib.sha1(DASHBOARD_TEMPLATE.encode('utf-8')).hexdigest()[:12]
+
+def get_user_scope(current_user):
+    """Resolve access level, stores and counters visible to the user"""
+    # Implement full role hierarchy
+    if current_user and hasattr(current_user, 'role') and current_user.role:
+        if current_user.role.name == 'admin':
+            # Admin sees everything
+            access_level = "Администратор - полный доступ"
+            accessible_stores = Store.query.filter_by(active=True).all()
+            accessible_counters = VisitorCounter.query.filter_by(active=True).all()
+            
+        elif current_user.role.name == 'rd':
+            # Regional Director sees stores and counters of subordinate TUs
+            access_level = "Региональный директор - доступ к подчиненным"
+            # Get subordinate TU users
+            subordinate_users = User.query.filter_by(supervisor_id=current_user.id, active=True).all()
+            subordinate_user_ids = [user.id for user in subordinate_users] + [current_user.id]
+            
+            # Get counters assigned to subordinates
+            accessible_counters = VisitorCounter.query.filter(
+                VisitorCounter.assigned_user_id.in_(subordinate_user_ids),
+                VisitorCounter.active == True
+            ).all()
+            
+            # Get stores that have these counters
+            store_ids_with_counters = {counter.store_id for counter in accessible_counters}
+            accessible_stores = Store.query.filter(
+                Store.id.in_(store_ids_with_counters),
+                Store.active == True
+            ).all() if store_ids_with_counters else []
+            
+        elif current_user.role.name == 'tu':
+            # Technical User sees only assigned counters
+            access_level = "Технический пользователь - назначенные счетчики"
+            accessible_counters = VisitorCounter.query.filter_by(
+                assigned_user_id=current_user.id,
+                active=True
+            ).all()
+            
+            # Get stores that have these counters
+            store_ids_with_counters = {counter.store_id for counter in accessible_counters}
+            accessible_stores = Store.query.filter(
+                Store.id.in_(store_ids_with_counters),
+                Store.active == True
+            ).all() if store_ids_with_counters else []
+            
+        else:
+            # Basic user - very limited access
+            access_level = "Базовый пользователь - ограниченный доступ"
+            accessible_counters = VisitorCounter.query.filter_by(
+                assigned_user_id=current_user.id,
+                active=True
+            ).limit(2).all()
+            
+            store_ids_with_counters = {counter.store_id for counter in accessible_counters}
+            accessible_stores = Store.query.filter(
+                Store.id.in_(store_ids_with_counters),
+                Store.active == True
+            ).all() if store_ids_with_counters else []
+    else:
+        access_level = "Гость - базовый доступ"
+        accessible_stores = []
+        accessible_counters = []
+    
+    return access_level, accessible_stores, accessible_counters
+
+def get_current_scope():
+    """Scope of the current user, resolved once per request"""
+    if 'user_scope' not in g:
+        g.user_scope = get_user_scope(get_current_user())
+    return g.user_scope
 
 @app.route('/')
 @login_required
@@ -402,332 +659,292 @@ def index():
 @app.route('/dashboard')
 @login_required
 def dashboard():
-    """Dashboard with role hierarchy and charts"""
+    """Dashboard shell; metrics, charts, counters and alerts load as JSON"""
     try:
         current_user = get_current_user()
+        role_name = current_user.role.name if current_user and current_user.role else None
+        role_description = current_user.role.description if current_user and current_user.role else None
+        username = current_user.username if current_user else None
         
-        # Implement full role hierarchy
-        if current_user and hasattr(current_user, 'role') and current_user.role:
-            if current_user.role.name == 'admin':
-                # Admin sees everything
-                access_level = "Администратор - полный доступ"
-                accessible_stores = Store.query.filter_by(active=True).all()
-                accessible_counters = VisitorCounter.query.filter_by(active=True).all()
-                
-            elif current_user.role.name == 'rd':
-                # Regional Director sees stores and counters of subordinate TUs
-                access_level = "Региональный директор - доступ к подчиненным"
-                # Get subordinate TU users
-                subordinate_users = User.query.filter_by(supervisor_id=current_user.id, active=True).all()
-                subordinate_user_ids = [user.id for user in subordinate_users] + [current_user.id]
-                
-                # Get counters assigned to subordinates
-                accessible_counters = VisitorCounter.query.filter(
-                    VisitorCounter.assigned_user_id.in_(subordinate_user_ids),
-                    VisitorCounter.active == True
-                ).all()
-                
-                # Get stores that have these counters
-                store_ids_with_counters = {counter.store_id for counter in accessible_counters}
-                accessible_stores = Store.query.filter(
-                    Store.id.in_(store_ids_with_counters),
-                    Store.active == True
-                ).all() if store_ids_with_counters else []
-                
-            elif current_user.role.name == 'tu':
-                # Technical User sees only assigned counters
-                access_level = "Технический пользователь - назначенные счетчики"
-                accessible_counters = VisitorCounter.query.filter_by(
-                    assigned_user_id=current_user.id,
-                    active=True
-                ).all()
-                
-                # Get stores that have these counters
-                store_ids_with_counters = {counter.store_id for counter in accessible_counters}
-                accessible_stores = Store.query.filter(
-                    Store.id.in_(store_ids_with_counters),
-                    Store.active == True
-                ).all() if store_ids_with_counters else []
-                
-            else:
-                # Basic user - very limited access
-                access_level = "Базовый пользователь - ограниченный доступ"
-                accessible_counters = VisitorCounter.query.filter_by(
-                    assigned_user_id=current_user.id,
-                    active=True
-                ).limit(2).all()
-                
-                store_ids_with_counters = {counter.store_id for counter in accessible_counters}
-                accessible_stores = Store.query.filter(
-                    Store.id.in_(store_ids_with_counters),
-                    Store.active == True
-                ).all() if store_ids_with_counters else []
-        else:
-            access_level = "Гость - базовый доступ"
-            accessible_stores = []
-            accessible_counters = []
-        
-        store_ids = [store.id for store in accessible_stores]
-        counter_ids = [counter.id for counter in accessible_counters]
+        etag = compute_etag('shell', DASHBOARD_SHELL_VERSION, username, role_name, role_description)
+        cached = not_modified_response(etag)
+        if cached is not None:
+            return cached
         
-        # Get metrics for accessible data
-        today = datetime.now(timezone.utc).date()
-        yesterday = datetime.now(timezone.utc) - timedelta(days=1)
+        response = make_response(render_dashboard_shell(username, role_name, role_description))
+        return set_cache_validators(response, etag)
+    
+    except Exception as e:
+        logger.error(f"Error in dashboard: {e}")
+        return jsonify({'error': str(e)}), 500
+
+@lru_cache(maxsize=1024)
+def render_dashboard_shell(username, role_name, role_description):
+    """Render the static dashboard shell once per user identity"""
+    current_user = {'username': username, 'role': {'name': role_name, 'description': role_description}}
+    return render_inline('dashboard', current_user=current_user)
+
+def load_dashboard_scope():
+    """Resolve the current user's scope and read its precomputed aggregates"""
+    access_level, accessible_stores, accessible_counters = get_current_scope()
+    counter_ids = [counter.id for counter in accessible_counters]
+    aggregates = get_scope_aggregates(counter_ids) if counter_ids else None
+    
+    return {
+        'access_level': access_level,
+        'stores': accessible_stores,
+        'counters': accessible_counters,
+        'counter_ids': counter_ids,
+        'scope_key': scope_key(counter_ids),
+        'aggregates': aggregates,
+        'version': aggregates['version'] if aggregates else 'warming',
+        'last_modified': aggregates['last_modified'] if aggregates else None
+    }
+
+@app.route('/dashboard/data/metrics')
+@login_required
+def dashboard_metrics_data():
+    """Headline metrics and access level for the dashboard"""
+    try:
+        scope = load_dashboard_scope()
+        etag = compute_etag('metrics', scope['access_level'], len(scope['stores']), scope['scope_key'], scope['version'])
+        cached = not_modified_response(etag, scope['last_modified'])
+        if cached is not None:
+            return cached
         
-        # Visitor data for accessible counters
-        recent_data = VisitorData.query.filter(
-            VisitorData.counter_id.in_(counter_ids),
-            VisitorData.timestamp >= yesterday
-        ).all()
+        aggregates = scope['aggregates']
+        metrics = aggregates['metrics'] if aggregates else dict(EMPTY_METRICS, total_counters=len(scope['counter_ids']))
         
-        total_visitors = sum(data.entries for data in recent_data)
-        current_occupancy = sum(data.current_occupancy for data in recent_data)
-        active_alerts = Alert.query.filter(
-            Alert.counter_id.in_(counter_ids),
-            Alert.is_resolved == False
-        ).count()
+        response = jsonify({
+            'success': True,
+            'access_level': scope['access_level'],
+            'stores_count': len(scope['stores']),
+            'counters_count': len(scope['counters']),
+            'metrics': metrics
+        })
+        return set_cache_validators(response, etag, scope['last_modified'])
+    
+    except Exception as e:
+        logger.error(f"Error getting dashboard metrics: {e}")
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+@app.route('/dashboard/data/charts')
+@login_required
+def dashboard_charts_data():
+    """Daily trend, hourly curve and store performance chart data"""
+    try:
+        scope = load_dashboard_scope()
+        etag = compute_etag('charts', scope['scope_key'], scope['version'])
+        cached = not_modified_response(etag, scope['last_modified'])
+        if cached is not None:
+            return cached
         
-        # Format numbers
-        def format_number(num):
-            return f"{num:,}".replace(',', ' ')
+        aggregates = scope['aggregates']
+        response = jsonify({
+            'success': True,
+            'charts': aggregates['chart_data'] if aggregates else EMPTY_CHART_DATA
+        })
+        return set_cache_validators(response, etag, scope['last_modified'])
+    
+    except Exception as e:
+        logger.error(f"Error getting dashboard charts: {e}")
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+@app.route('/dashboard/data/counters')
+@login_required
+def dashboard_counters_data():
+    """Per-counter status table for the dashboard"""
+    try:
+        scope = load_dashboard_scope()
+        counter_stats = scope['aggregates']['counter_stats'] if scope['aggregates'] else {}
         
-        metrics = {
-            'total_visitors': format_number(total_visitors),
-            'current_occupancy': format_number(current_occupancy),
-            'total_counters': len(counter_ids),
-            'online_counters': len([c for c in accessible_counters if getattr(c, 'is_online', False)]),
-            'active_alerts': active_alerts
-        }
+        counters = []
+        for counter in scope['counters']:
+            stats = counter_stats.get(counter.id, {})
+            last_update = stats.get('last_update')
+            counters.append({
+                'id': counter.id,
+                'name': counter.name,
+                'store_name': counter.store.name,
+                'today_visitors': stats.get('today_visitors', 0),
+                'is_online': stats.get('is_online', False),
+                'last_update': last_update.strftime('%H:%M') if last_update else None
+            })
         
-        # Generate chart data with error handling
-        try:
-            chart_data = generate_chart_data(counter_ids) if counter_ids else {
-                'daily_dates': [],
-                'daily_visitors': [],
-                'hourly_hours': [],
-                'hourly_visitors': [],
-                'store_names': [],
-                'store_visitors': []
-            }
-        except Exception as e:
-            logger.error(f"Error generating chart data: {e}")
-            chart_data = {
-                'daily_dates': [],
-                'daily_visitors': [],
-                'hourly_hours': [],
-                'hourly_visitors': [],
-                'store_names': [],
-                'store_visitors': []
-            }
+        etag = compute_etag('counters', scope['version'], counters)
+        cached = not_modified_response(etag, scope['last_modified'])
+        if cached is not None:
+            return cached
         
-        # Enhance counter data with real-time info
-        for counter in accessible_counters:
-            try:
-                today_data = VisitorData.query.filter(
-                    VisitorData.counter_id == counter.id,
-                    VisitorData.timestamp >= datetime.combine(today, datetime.min.time().replace(tzinfo=timezone.utc))
-                ).all()
-                
-                counter.today_visitors = sum(data.entries for data in today_data)
-                counter.is_online = len(today_data) > 0
-                counter.last_update = max([data.timestamp for data in today_data]) if today_data else None
-            except Exception as e:
-                logger.error(f"Error processing counter {counter.id}: {e}")
-                counter.today_visitors = 0
-                counter.is_online = False
-                counter.last_update = None
+        response = jsonify({
+            'success': True,
+            'counters': counters
+        })
+        return set_cache_validators(response, etag, scope['last_modified'])
+    
+    except Exception as e:
+        logger.error(f"Error getting dashboard counters: {e}")
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+@app.route('/dashboard/data/alerts')
+@login_required
+def dashboard_alerts_data():
+    """Latest unresolved alerts for the dashboard"""
+    try:
+        scope = load_dashboard_scope()
+        alerts_version = compute_alerts_version(scope['counter_ids'])
+        etag = compute_etag('alerts', scope['scope_key'], alerts_version)
+        cached = not_modified_response(etag, alerts_version[2])
+        if cached is not None:
+            return cached
         
-        # Get recent alerts for accessible counters
         recent_alerts = Alert.query.filter(
-            Alert.counter_id.in_(counter_ids),
+            Alert.counter_id.in_(scope['counter_ids']),
             Alert.is_resolved == False
-        ).order_by(Alert.created_at.desc()).limit(10).all()
+        ).order_by(Alert.created_at.desc()).limit(10).all() if scope['counter_ids'] else []
         
-        return render_template_string(DASHBOARD_TEMPLATE,
-                                    current_user=current_user,
-                                    access_level=access_level,
-                                    accessible_stores=accessible_stores,
-                                    accessible_counters=accessible_counters,
-                                    metrics=metrics,
-                                    chart_data=chart_data,
-                                    recent_alerts=recent_alerts)
+        response = jsonify({
+            'success': True,
+            'alerts': [{
+                'id': alert.id,
+                'counter_id': alert.counter_id,
+                'store_name': alert.counter.store.name,
+                'severity': alert.severity,
+                'message': alert.message,
+                'created_at': alert.created_at.isoformat() if alert.created_at else None
+            } for alert in recent_alerts]
+        })
+        return set_cache_validators(response, etag, alerts_version[2])
     
     except Exception as e:
-        logger.error(f"Error in dashboard: {e}")
-        return jsonify({'error': str(e)}), 500
+        logger.error(f"Error getting dashboard alerts: {e}")
+        return jsonify({'success': False, 'error': str(e)}), 500
 
-def generate_chart_data(counter_ids):
-    """Generate chart data for accessible counters"""
-    if not counter_ids:
-        return {
-            'daily_dates': [],
-            'daily_visitors': [],
-            'hourly_hours': [],
-            'hourly_visitors': [],
-            'store_names': [],
-            'store_visitors': []
-        }
-    
-    # Daily data for last 7 days
-    week_ago = datetime.now(timezone.utc) - timedelta(days=7)
-    daily_data = db.session.query(
-        db.func.date(VisitorData.timestamp).label('date'),
-        db.func.sum(VisitorData.entries).label('total_entries')
-    ).filter(
-        VisitorData.counter_id.in_(counter_ids),
-        VisitorData.timestamp >= week_ago
-    ).group_by(
-        db.func.date(VisitorData.timestamp)
-    ).order_by('date').all()
-    
-    # Hourly data for today
-    today = datetime.now(timezone.utc).date()
-    hourly_data = db.session.query(
-        db.func.extract('hour', VisitorData.timestamp).label('hour'),
-        db.func.sum(VisitorData.entries).label('total_entries')
-    ).filter(
-        VisitorData.counter_id.in_(counter_ids),
-        db.func.date(VisitorData.timestamp) == today
-    ).group_by(
-        db.func.extract('hour', VisitorData.timestamp)
-    ).order_by('hour').all()
-    
-    # Store performance data with explicit joins
-    store_data = db.session.query(
-        Store.name,
-        db.func.sum(VisitorData.entries).label('total_entries')
-    ).select_from(
-        VisitorData.query.join(VisitorCounter).join(Store).subquery()
-    ).filter(
-        VisitorData.counter_id.in_(counter_ids),
-        VisitorData.timestamp >= week_ago
-    ).group_by(Store.name).all()
-    
-    return {
-        'daily_dates': [row.date.strftime('%Y-%m-%d') for row in daily_data],
-        'daily_visitors': [int(row.total_entries) for row in daily_data],
-        'hourly_hours': [f"{int(row.hour):02d}:00" for row in hourly_data],
-        'hourly_visitors': [int(row.total_entries) for row in hourly_data],
-        'store_names': [row.name for row in store_data] if store_data else [],
-        'store_visitors': [int(row.total_entries) for row in store_data] if store_data else []
-    }
+def export_period(period):
+    """Start date and file name (without extension) of an export period"""
+    if period == 'week':
+        start_date = datetime.now(timezone.utc) - timedelta(days=7)
+        filename = f"visitor_report_week_{datetime.now().strftime('%Y%m%d')}"
+    elif period == 'month':
+        start_date = datetime.now(timezone.utc) - timedelta(days=30)
+        filename = f"visitor_report_month_{datetime.now().strftime('%Y%m%d')}"
+    else:
+        start_date = datetime.now(timezone.utc) - timedelta(days=7)
+        filename = f"visitor_report_{datetime.now().strftime('%Y%m%d')}"
+    return start_date, filename
 
 @app.route('/export/excel')
 @login_required
 def export_excel():
     """Export data to Excel based on user permissions"""
+    path = None
     try:
         current_user = get_current_user()
         period = request.args.get('period', 'week')
         
         # Get user's accessible counters based on role
-        if current_user.role.name == 'admin':
-            accessible_counters = VisitorCounter.query.filter_by(active=True).all()
-        elif current_user.role.name == 'rd':
-            subordinate_users = User.query.filter_by(supervisor_id=current_user.id, active=True).all()
-            subordinate_user_ids = [user.id for user in subordinate_users] + [current_user.id]
-            accessible_counters = VisitorCounter.query.filter(
-                VisitorCounter.assigned_user_id.in_(subordinate_user_ids),
-                VisitorCounter.active == True
-            ).all()
-        elif current_user.role.name == 'tu':
-            accessible_counters = VisitorCounter.query.filter_by(
-                assigned_user_id=current_user.id, active=True
-            ).all()
-        else:
-            accessible_counters = VisitorCounter.query.filter_by(
-                assigned_user_id=current_user.id, active=True
-            ).limit(2).all()
-        
+        accessible_counters = get_current_scope()[2]
         counter_ids = [counter.id for counter in accessible_counters]
         
-        # Date range
-        if period == 'week':
-            start_date = datetime.now(timezone.utc) - timedelta(days=7)
-            filename = f"visitor_report_week_{datetime.now().strftime('%Y%m%d')}.xlsx"
-        elif period == 'month':
-            start_date = datetime.now(timezone.utc) - timedelta(days=30)
-            filename = f"visitor_report_month_{datetime.now().strftime('%Y%m%d')}.xlsx"
-        else:
-            start_date = datetime.now(timezone.utc) - timedelta(days=7)
-            filename = f"visitor_report_{datetime.now().strftime('%Y%m%d')}.xlsx"
-        
-        # Get data for accessible counters only
-        data = db.session.query(
-            VisitorData.timestamp,
-            Store.name.label('store_name'),
-            VisitorCounter.name.label('counter_name'),
-            VisitorData.entries,
-            VisitorData.exits,
-            VisitorData.current_occupancy
-        ).join(VisitorCounter).join(Store).filter(
-            VisitorData.counter_id.in_(counter_ids) if counter_ids else False,
-            VisitorData.timestamp >= start_date
-        ).order_by(VisitorData.timestamp.desc()).all()
-        
-        # Create DataFrame
-        df = pd.DataFrame([{
-            'Дата и время': row.timestamp.strftime('%Y-%m-%d %H:%M:%S'),
-            'Магазин': row.store_name,
-            'Счетчик': row.counter_name,
-            'Вход': row.entries,
-            'Выход': row.exits,
-            'Текущая посещаемость': row.current_occupancy
-        } for row in data])
+        start_date, filename = export_period(period)
+        filename = f"{filename}.xlsx"
         
-        # Create Excel file
-        output = io.BytesIO()
+        # Summary totals come from SQL, rows are streamed through a server-side cursor
+        total_rows, total_visitors = export_totals(counter_ids, start_date)
+        summary_data = xlsx_summary(period, len(accessible_counters), total_rows, total_visitors, current_user)
+        rows = export_query(counter_ids, start_date).yield_per(EXPORT_BATCH_SIZE)
         
-        # Use xlsxwriter engine directly
-        import xlsxwriter
-        workbook = xlsxwriter.Workbook(output, {'in_memory': True})
+        path = create_export_file('.xlsx')
+        write_xlsx_export(path, rows, summary_data)
         
-        # Main data worksheet
-        worksheet1 = workbook.add_worksheet('Данные посетителей')
+        response = Response(stream_file(path), mimetype=XLSX_MIMETYPE)
+        response.headers['Content-Disposition'] = f'attachment; filename="{filename}"'
+        response.headers['Content-Length'] = str(os.path.getsize(path))
+        return response
         
-        # Write headers
-        headers = ['Дата и время', 'Магазин', 'Счетчик', 'Вход', 'Выход', 'Текущая посещаемость']
-        for col, header in enumerate(headers):
-            worksheet1.write(0, col, header)
+    except Exception as e:
+        logger.error(f"Error exporting to Excel: {e}")
+        if path:
+            remove_file(path)
+        return jsonify({'error': 'Ошибка при экспорте данных'}), 500
+
+@app.route('/export/csv')
+@login_required
+def export_csv():
+    """Stream raw visitor data as gzip-compressed CSV based on user permissions"""
+    try:
+        period = request.args.get('period', 'week')
         
-        # Write data
-        for row_num, row in enumerate(data, 1):
-            worksheet1.write(row_num, 0, row.timestamp.strftime('%Y-%m-%d %H:%M:%S'))
-            worksheet1.write(row_num, 1, row.store_name)
-            worksheet1.write(row_num, 2, row.counter_name)
-            worksheet1.write(row_num, 3, row.entries)
-            worksheet1.write(row_num, 4, row.exits)
-            worksheet1.write(row_num, 5, row.current_occupancy)
+        # Same role scope as the Excel export
+        counter_ids = [counter.id for counter in get_current_scope()[2]]
+        start_date, filename = export_period(period)
         
-        # Summary worksheet
-        worksheet2 = workbook.add_worksheet('Сводка')
-        summary_data = [
-            ['Период', period],
-            ['Дата экспорта', datetime.now().strftime('%Y-%m-%d %H:%M:%S')],
-            ['Пользователь', current_user.username],
-            ['Роль', current_user.role.description],
-            ['Всего записей', len(data)],
-            ['Всего посетителей', sum(row.entries for row in data)],
-            ['Доступных счетчиков', len(accessible_counters)]
-        ]
+        response = Response(stream_with_context(stream_csv_gzip(counter_ids, start_date)), mimetype='application/gzip')
+        response.headers['Content-Disposition'] = f'attachment; filename="{filename}.csv.gz"'
+        return response
         
-        for row_num, (label, value) in enumerate(summary_data):
-            worksheet2.write(row_num, 0, label)
-            worksheet2.write(row_num, 1, str(value))
+    except Exception as e:
+        logger.error(f"Error exporting to CSV: {e}")
+        return jsonify({'error': 'Ошибка при экспорте данных'}), 500
+
+@app.route('/export/jobs', methods=['POST'])
+@login_required
+def create_export_job():
+    """Queue a file export and return its job for polling"""
+    try:
+        current_user = get_current_user()
+        data = request.get_json(silent=True) or request.form
+        export_format = data.get('format', 'xlsx')
+        period = data.get('period', 'week')
+        if export_format not in FILE_EXTENSIONS:
+            return jsonify({'success': False, 'error': 'Неизвестный формат'}), 400
         
-        workbook.close()
-        output.seek(0)
+        counter_ids = sorted(counter.id for counter in get_current_scope()[2])
+        start_date, filename = export_period(period)
+        job = submit_job(current_user.id, export_format, {
+            'counter_ids': counter_ids,
+            'start_date': start_date.isoformat(),
+            'period': period,
+            'filename': filename
+        }, cache_key=export_cache_key(counter_ids, period, export_format))
         
-        return send_file(
-            output,
-            as_attachment=True,
-            download_name=filename,
-            mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
-        )
+        return jsonify({'success': True, 'job': export_job_payload(job)}), 202
         
     except Exception as e:
-        logger.error(f"Error exporting to Excel: {e}")
-        return jsonify({'error': 'Ошибка при экспорте данных'}), 500
+        logger.error(f"Error creating export job: {e}")
+        return jsonify({'success': False, 'error': 'Ошибка при создании задания'}), 500
+
+def export_job_payload(job):
+    """Job status with polling and download URLs"""
+    payload = job_status(job)
+    payload['status_url'] = url_for('export_job_status', job_id=job.id)
+    if job.status == 'done' and job.file_path:
+        payload['download_url'] = url_for('download_export_job', job_id=job.id)
+    return payload
+
+# Job ids are random 128-bit tokens handed out by /export/jobs; a cached
+# export is shared by every user with the same scope, so access is by id
+@app.route('/export/jobs/<job_id>')
+@login_required
+def export_job_status(job_id):
+    """Progress of an export job"""
+    job = db.session.get(ExportJob, job_id)
+    if job is None:
+        return jsonify({'success': False, 'error': 'Задание не найдено'}), 404
+    
+    response = jsonify({'success': True, 'job': export_job_payload(job)})
+    response.headers['Cache-Control'] = 'no-store'
+    return response
+
+@app.route('/export/jobs/<job_id>/download')
+@login_required
+def download_export_job(job_id):
+    """Download the file of a finished export job"""
+    job = db.session.get(ExportJob, job_id)
+    if job is None or job.status != 'done' or not job.file_path or not os.path.exists(job.file_path):
+        return jsonify({'error': 'Файл не найден или еще не готов'}), 404
+    
+    return send_file(job.file_path, as_attachment=True, download_name=job.filename)
 
 @app.route('/api/metrics')
 def api_metrics():
@@ -735,33 +952,36 @@ def api_metrics():
     try:
         # Get basic counts
         total_stores = Store.query.count()
-        total_counters = VisitorCounter.query.count()
-        active_alerts = Alert.query.filter_by(is_resolved=False).count()
+        counter_ids = [row.id for row in db.session.query(VisitorCounter.id).all()]
         
-        # Get visitor data from last 24 hours
-        yesterday = datetime.now(timezone.utc) - timedelta(days=1)
-        recent_data = VisitorData.query.filter(VisitorData.timestamp >= yesterday).all()
+        # Read precomputed aggregates for the whole network
+        aggregates = get_scope_aggregates(counter_ids) if counter_ids else None
+        scope_metrics = aggregates['metrics'] if aggregates else dict(EMPTY_METRICS, total_counters=len(counter_ids))
         
-        total_visitors = sum(data.entries for data in recent_data)
-        current_occupancy = sum(data.current_occupancy for data in recent_data)
+        etag = compute_etag(total_stores, aggregates['version'] if aggregates else 'warming')
+        last_modified = aggregates['last_modified'] if aggregates else None
+        cached = not_modified_response(etag, last_modified, private=False)
+        if cached is not None:
+            return cached
         
         # Format numbers
         def format_number(num):
             return f"{num:,}".replace(',', ' ')
         
         metrics = {
-            'total_visitors': format_number(total_visitors),
-            'current_occupancy': format_number(current_occupancy),
+            'total_visitors': format_number(scope_metrics['total_visitors']),
+            'current_occupancy': format_number(scope_metrics['current_occupancy']),
             'total_stores': total_stores,
-            'total_counters': total_counters,
-            'online_counters': 0,  # TODO: Implement real-time status
-            'active_alerts': active_alerts
+            'total_counters': scope_metrics['total_counters'],
+            'online_counters': scope_metrics['online_counters'],
+            'active_alerts': scope_metrics['active_alerts']
         }
         
-        return jsonify({
+        response = jsonify({
             'success': True,
             'metrics': metrics
         })
+        return set_cache_validators(response, etag, last_modified, private=False)
     except Exception as e:
         logger.error(f"Error getting metrics: {e}")
         return jsonify({
@@ -769,6 +989,42 @@ def api_metrics():
             'error': str(e)
         }), 500
 
+@app.route('/api/stream')
+@login_required
+def live_stream():
+    """Server-Sent Events stream of live updates for the user's scope"""
+    _, _, accessible_counters = get_current_scope()
+    counter_ids = [counter.id for counter in accessible_counters]
+    
+    # Keep the scope registered so the worker publishes its metrics changes
+    get_scope_aggregates(counter_ids)
+    subscription = subscribe(counter_ids, scope_key(counter_ids))
+    
+    def generate():
+        deadline = time.monotonic() + STREAM_MAX_DURATION
+        try:
+            yield "retry: 5000\n\n"
+            while time.monotonic() < deadline:
+                if subscription.overflowed:
+                    # Client fell behind: tell it to reload instead of replaying
+                    yield "event: resync\ndata: {}\n\n"
+                    return
+                
+                event = subscription.get(timeout=STREAM_KEEPALIVE)
+                if event is None:
+                    yield ": keepalive\n\n"
+                    continue
+                
+                yield f"id: {event['id']}\nevent: {event['type']}\ndata: {json.dumps(event['data'], default=str)}\n\n"
+        finally:
+            unsubscribe(subscription)
+    
+    # The stream ends after STREAM_MAX_DURATION and the browser reconnects
+    return Response(generate(), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
+
 @app.route('/health')
 def health_check():
     """Health check endpoint"""
@@ -796,6 +1052,9 @@ def initialize_database():
             db.create_all()
             logger.info("Database tables created successfully")
             
+            # Latest-state rows for counters that predate the counter_states table
+            backfill_counter_states()
+            
             # Create default admin user
             create_default_admin()
             
@@ -813,5 +1072,8 @@ def initialize_database():
 # Initialize database when module is imported
 initialize_database()
 
+# Compile inline templates once at startup instead of on every render
+compile_templates(app)
+
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=5000, debug=True)
\ No newline at end of file
@@ -0,0 +1,39 @@
+"""
+Inline templates must escape values the way render_template_string did
+"""
+
+import pytest
+from flask import Flask
+from database import db
+from database.models import Store
+from admin_interface import render_stores_tab
+from utils.templates import render_inline
+
+HOSTILE_NAME = '<script>alert(1)</script>'
+
+@pytest.fixture
+def app():
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite://'
+    db.init_app(app)
+    with app.app_context():
+        db.create_all()
+        db.session.add(Store(name=HOSTILE_NAME, store_code='S1', city='Москва', region='Центр'))
+        db.session.commit()
+        yield app
+
+def test_admin_template_escapes_store_name(app):
+    with app.test_request_context('/admin/?tab=stores'):
+        html = render_inline('admin',
+                             active_tab='stores',
+                             current_user=None,
+                             stats={'users': 0, 'stores': 1, 'counters': 0, 'alerts': 1},
+                             recent_alerts=[],
+                             recent_logs=[],
+                             tab_content=render_stores_tab())
+        assert HOSTILE_NAME not in html
+        assert '&lt;script&gt;alert(1)&lt;/script&gt;' in html
+
+def test_login_template_escapes_context(app):
+    with app.test_request_context('/login'):
+        assert HOSTILE_NAME not in render_inline('login', error=HOSTILE_NAME)
@@ -0,0 +1,130 @@
+"""
+Coalesced last-activity tracking for users and sessions
+
+Authenticated requests only note the user and session in memory, with
+the time truncated to ACTIVITY_RESOLUTION. A per-process worker writes
+the buffered values every ACTIVITY_FLUSH_INTERVAL seconds: one batched
+UPDATE of users.last_login and one batched upsert of session_activity,
+instead of a write transaction per request.
+"""
+
+import os
+import time
+import atexit
+import logging
+import threading
+from datetime import datetime, timezone
+from sqlalchemy import update, bindparam
+from database import db
+from database.models import User, SessionActivity
+
+logger = logging.getLogger(__name__)
+
+# Activity times are truncated to this many seconds
+ACTIVITY_RESOLUTION = int(os.environ.get("ACTIVITY_RESOLUTION", "60"))
+# Seconds between flushes of the buffer
+ACTIVITY_FLUSH_INTERVAL = int(os.environ.get("ACTIVITY_FLUSH_INTERVAL", "60"))
+
+_lock = threading.Lock()
+_users = {}     # user id -> last activity
+_sessions = {}  # session id -> last activity
+_worker = None
+_worker_pid = None
+
+def record_activity(user_id, session_id):
+    """Note a request of a user session in the buffer"""
+    seen = int(time.time()) // ACTIVITY_RESOLUTION * ACTIVITY_RESOLUTION
+    seen = datetime.fromtimestamp(seen, timezone.utc).replace(tzinfo=None)
+    with _lock:
+        if user_id is not None:
+            _users[user_id] = seen
+        if session_id is not None:
+            _sessions[session_id] = seen
+
+def _restore(users, sessions):
+    """Put back values of a failed flush, keeping newer ones recorded meanwhile"""
+    with _lock:
+        for target, values in ((_users, users), (_sessions, sessions)):
+            for key, seen in values.items():
+                if key not in target or target[key] < seen:
+                    target[key] = seen
+
+def _upsert_statement(dialect):
+    if dialect == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert
+    elif dialect == 'sqlite':
+        from sqlalchemy.dialects.sqlite import insert
+    else:
+        return None
+    table = SessionActivity.__table__
+    stmt = insert(table)
+    return stmt.on_conflict_do_update(
+        index_elements=[table.c.session_id],
+        set_={'last_seen_at': stmt.excluded.last_seen_at},
+        where=table.c.last_seen_at < stmt.excluded.last_seen_at
+    )
+
+def flush_activity():
+    """Write the buffered activity in batches; returns the number of users and sessions written"""
+    global _users, _sessions
+    with _lock:
+        users, sessions = _users, _sessions
+        _users, _sessions = {}, {}
+    if not users and not sessions:
+        return 0, 0
+
+    try:
+        with db.engine.begin() as connection:
+            if users:
+                # Several workers flush independently: never move a value backwards
+                users_table = User.__table__
+                connection.execute(
+                    update(users_table)
+                    .where(users_table.c.id == bindparam('b_user_id'),
+                           db.or_(users_table.c.last_login.is_(None),
+                                  users_table.c.last_login < bindparam('b_seen')))
+                    .values(last_login=bindparam('b_seen')),
+                    [{'b_user_id': user_id, 'b_seen': seen} for user_id, seen in users.items()]
+                )
+
+            if sessions:
+                rows = [{'session_id': session_id, 'last_seen_at': seen} for session_id, seen in sessions.items()]
+                upsert = _upsert_statement(connection.dialect.name)
+                if upsert is not None:
+                    connection.execute(upsert, rows)
+                else:
+                    table = SessionActivity.__table__
+                    for row in rows:
+                        result = connection.execute(update(table).where(table.c.session_id == row['session_id'])
+                                                    .values(last_seen_at=row['last_seen_at']))
+                        if result.rowcount == 0:
+                            connection.execute(table.insert().values(**row))
+        return len(users), len(sessions)
+
+    except Exception as e:
+        logger.error(f"Error flushing activity: {e}")
+        _restore(users, sessions)
+        return 0, 0
+
+def _run_worker(app):
+    """Flush loop"""
+    while True:
+        time.sleep(ACTIVITY_FLUSH_INTERVAL)
+        with app.app_context():
+            flush_activity()
+
+def _flush_at_exit(app):
+    with app.app_context():
+        flush_activity()
+
+def start_activity_worker(app):
+    """Start the flush worker once per process"""
+    global _worker, _worker_pid
+    with _lock:
+        if _worker is not None and _worker_pid == os.getpid() and _worker.is_alive():
+            return
+        _worker = threading.Thread(target=_run_worker, args=(app,), name='activity-flush', daemon=True)
+        _worker_pid = os.getpid()
+        _worker.start()
+    atexit.register(_flush_at_exit, app)
+    logger.info(f"Activity flush worker started (every {ACTIVITY_FLUSH_INTERVAL}s)")
@@ -1,13 +1,25 @@
+import os
+import time
 import bcrypt
 import secrets
 import string
-from datetime import datetime, timedelta
+import threading
+from datetime import datetime, timedelta, timezone
 from database.models import User, Session, Role
 from database import db
 import logging
 
 logger = logging.getLogger(__name__)
 
+# Seconds between refreshes of the revoked session and inactive user sets;
+# a logout or deactivation reaches other worker processes within this time
+SESSION_REVOCATION_REFRESH = int(os.environ.get("SESSION_REVOCATION_REFRESH", "30"))
+
+_revocation_lock = threading.Lock()
+_revoked_session_ids = frozenset()
+_inactive_user_ids = frozenset()
+_revocations_loaded_at = 0
+
 def hash_password(password):
     """Hash password using bcrypt"""
     salt = bcrypt.gensalt()
@@ -42,42 +54,74 @@ def create_user_session(user_id, ip_address=None, user_agent=None):
         )
         
         db.session.add(new_session)
+        User.query.filter_by(id=user_id).update({'last_login': datetime.utcnow()})
         db.session.commit()
+        refresh_revocations(force=True)
         
-        return session_token
+        return new_session
         
     except Exception as e:
         logger.error(f"Error creating user session: {e}")
         db.session.rollback()
         return None
 
-def validate_session(session_token):
-    """Validate session token and return user"""
+def refresh_revocations(force=False):
+    """Reload revoked sessions and inactive users if the cached sets are older than the refresh interval"""
+    global _revoked_session_ids, _inactive_user_ids, _revocations_loaded_at
+    if not force and time.time() - _revocations_loaded_at < SESSION_REVOCATION_REFRESH:
+        return
+    
+    with _revocation_lock:
+        if not force and time.time() - _revocations_loaded_at < SESSION_REVOCATION_REFRESH:
+            return
+        try:
+            # Only sessions that have not expired yet can still be presented
+            revoked = db.session.query(Session.id).filter(
+                Session.active == False,
+                Session.expires_at > datetime.utcnow()
+            ).all()
+            inactive = db.session.query(User.id).filter(User.active == False).all()
+            
+            _revoked_session_ids = frozenset(row[0] for row in revoked)
+            _inactive_user_ids = frozenset(row[0] for row in inactive)
+        except Exception as e:
+            logger.error(f"Error refreshing session revocations: {e}")
+        finally:
+            # After a failure keep the previous sets and retry at the next interval
+            _revocations_loaded_at = time.time()
+
+def session_claims(user_session):
+    """Values stored in the signed session cookie for in-memory verification"""
+    return {
+        'session_id': user_session.id,
+        'session_expires': user_session.expires_at.replace(tzinfo=timezone.utc).timestamp()
+    }
+
+def verify_session(cookie_session):
+    """Validate the signed session cookie without a database query in the common case"""
     try:
-        session = Session.query.filter_by(
-            session_token=session_token,
-            active=True
-        ).first()
-        
-        if not session:
-            return None
+        if 'session_id' not in cookie_session:
+            # Logged in before sessions carried their id: look it up once
+            user_session = Session.query.filter_by(
+                session_token=cookie_session.get('session_token'),
+                user_id=cookie_session.get('user_id'),
+                active=True
+            ).first()
+            if not user_session:
+                return False
+            cookie_session.update(session_claims(user_session))
         
         # Check if session expired
-        if datetime.utcnow() > session.expires_at:
-            session.active = False
-            db.session.commit()
-            return None
-        
-        # Update user's last login
-        user = session.user
-        user.last_login = datetime.utcnow()
-        db.session.commit()
+        if time.time() > cookie_session['session_expires']:
+            return False
         
-        return user
+        refresh_revocations()
+        return (cookie_session['session_id'] not in _revoked_session_ids and
+                cookie_session.get('user_id') not in _inactive_user_ids)
         
     except Exception as e:
         logger.error(f"Error validating session: {e}")
-        return None
+        return False
 
 def invalidate_session(session_token):
     """Invalidate user session"""
@@ -86,6 +130,7 @@ def invalidate_session(session_token):
         if session:
             session.active = False
             db.session.commit()
+            refresh_revocations(force=True)
             return True
         return False
         
@@ -0,0 +1,93 @@
+"""
+Latest-state table for visitor counters
+
+counter_states keeps one row per counter with its most recent reading, so
+status listings read a single indexed table instead of searching
+visitor_data for the latest row of every counter.
+"""
+
+import logging
+from database import db
+from database.models import CounterState, VisitorCounter, VisitorData
+
+logger = logging.getLogger(__name__)
+
+def _insert_statement():
+    """Dialect-specific INSERT supporting ON CONFLICT, or None"""
+    dialect = db.session.get_bind().dialect.name
+    if dialect == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert
+        return insert
+    if dialect == 'sqlite':
+        from sqlalchemy.dialects.sqlite import insert
+        return insert
+    return None
+
+def update_counter_state(visitor_data):
+    """Upsert the counter's latest state from a new reading, in the current transaction"""
+    timestamp = visitor_data.timestamp.replace(tzinfo=None)
+    values = {
+        'counter_id': visitor_data.counter_id,
+        'last_seen': timestamp,
+        'total_count': visitor_data.entries,
+        'current_occupancy': visitor_data.current_occupancy,
+        'battery_level': visitor_data.battery_level,
+        'signal_strength': visitor_data.signal_strength,
+        'sensor_status': visitor_data.sensor_status
+    }
+    
+    insert = _insert_statement()
+    if insert is None:
+        state = db.session.get(CounterState, visitor_data.counter_id)
+        if state is None:
+            db.session.add(CounterState(**values))
+        elif state.last_seen is None or state.last_seen <= timestamp:
+            for key, value in values.items():
+                setattr(state, key, value)
+        return
+    
+    # Readings can arrive out of order: never overwrite a newer state
+    stmt = insert(CounterState).values(**values)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[CounterState.counter_id],
+        set_={key: stmt.excluded[key] for key in values if key != 'counter_id'},
+        where=db.or_(CounterState.last_seen.is_(None), CounterState.last_seen <= stmt.excluded.last_seen)
+    )
+    db.session.execute(stmt)
+
+def backfill_counter_states():
+    """Create missing state rows from the latest visitor_data of each counter"""
+    missing = [row.id for row in db.session.query(VisitorCounter.id).outerjoin(
+        CounterState, CounterState.counter_id == VisitorCounter.id
+    ).filter(CounterState.counter_id.is_(None)).all()]
+    if not missing:
+        return 0
+    
+    latest = db.session.query(
+        VisitorData.counter_id,
+        db.func.max(VisitorData.timestamp).label('timestamp')
+    ).filter(VisitorData.counter_id.in_(missing)).group_by(VisitorData.counter_id).subquery()
+    
+    rows = db.session.query(VisitorData).join(latest, db.and_(
+        VisitorData.counter_id == latest.c.counter_id,
+        VisitorData.timestamp == latest.c.timestamp
+    )).all()
+    
+    states = {}
+    for data in rows:
+        states[data.counter_id] = CounterState(
+            counter_id=data.counter_id,
+            last_seen=data.timestamp.replace(tzinfo=None),
+            total_count=data.entries,
+            current_occupancy=data.current_occupancy,
+            battery_level=data.battery_level,
+            signal_strength=data.signal_strength,
+            sensor_status=data.sensor_status
+        )
+    for counter_id in missing:
+        states.setdefault(counter_id, CounterState(counter_id=counter_id))
+    
+    db.session.add_all(states.values())
+    db.session.commit()
+    logger.info(f"Backfilled state for {len(states)} counters")
+    return len(states)
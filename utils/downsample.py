@@ -0,0 +1,48 @@
+"""
+Largest-Triangle-Three-Buckets downsampling for chart series
+"""
+
+import numpy as np
+
+def lttb_indices(x, y, threshold):
+    """Return indices of the points kept by LTTB, at most threshold of them
+
+    x must be numeric and ascending (convert datetimes to int64 first).
+    First and last points are always kept; in between, each bucket keeps the
+    point forming the largest triangle with the previously kept point and
+    the average of the next bucket. Work inside a bucket is vectorized, so
+    the Python loop runs once per output point, not per input point.
+    """
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    n = len(y)
+    if threshold >= n or threshold < 3:
+        return np.arange(n)
+
+    # Bucket boundaries for the n - 2 inner points
+    every = (n - 2) / (threshold - 2)
+    edges = (np.arange(threshold - 1) * every).astype(int) + 1
+    edges[-1] = n - 1
+
+    # Average of every bucket via cumulative sums; the last point is its own bucket
+    cx = np.concatenate(([0.0], np.cumsum(x)))
+    cy = np.concatenate(([0.0], np.cumsum(y)))
+    starts = edges[1:]
+    ends = np.append(edges[2:], n)
+    sizes = ends - starts
+    avg_x = (cx[ends] - cx[starts]) / sizes
+    avg_y = (cy[ends] - cy[starts]) / sizes
+
+    indices = np.empty(threshold, dtype=int)
+    indices[0] = 0
+    indices[-1] = n - 1
+    a = 0
+    for i in range(threshold - 2):
+        start, end = edges[i], edges[i + 1]
+        bx = x[start:end]
+        by = y[start:end]
+        areas = np.abs((x[a] - avg_x[i]) * (by - y[a]) - (x[a] - bx) * (avg_y[i] - y[a]))
+        a = start + int(np.argmax(areas))
+        indices[i + 1] = a
+
+    return indices
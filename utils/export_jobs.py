@@ -0,0 +1,230 @@
+"""
+Asynchronous export jobs
+
+A request enqueues a job and gets its id back; a per-process thread pool
+does the work while the job row in export_jobs tracks status and progress,
+so any worker can answer status polls and serve the finished file. File
+exports with the same scope, period and format finished within the
+freshness window are reused instead of generated again.
+"""
+
+import os
+import json
+import uuid
+import hashlib
+import logging
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from flask import current_app
+from database import db
+from database.models import ExportJob
+from utils.exports import (EXPORT_BATCH_SIZE, export_query, export_totals, write_xlsx_export, xlsx_summary,
+                           stream_csv_gzip, remove_file)
+from utils.precompute import scope_key
+from utils.store_workbook import build_store_workbook
+
+logger = logging.getLogger(__name__)
+
+EXPORT_JOB_WORKERS = int(os.environ.get("EXPORT_JOB_WORKERS", "2"))
+EXPORT_DIR = os.environ.get("EXPORT_DIR", os.path.join(tempfile.gettempdir(), "visitor_exports"))
+
+# Finished file exports are reused for identical requests within this window (seconds)
+EXPORT_CACHE_TTL = int(os.environ.get("EXPORT_CACHE_TTL", "600"))
+# Finished jobs and their files are deleted after this many seconds
+EXPORT_RETENTION = int(os.environ.get("EXPORT_RETENTION", "86400"))
+# Running jobs not finished after this many seconds are considered lost (e.g. worker restarted)
+EXPORT_JOB_TIMEOUT = int(os.environ.get("EXPORT_JOB_TIMEOUT", "3600"))
+# Queued jobs not started after this many seconds are considered lost: the queue lives
+# in the memory of the worker that accepted the job and is gone after a restart
+EXPORT_JOB_START_TIMEOUT = int(os.environ.get("EXPORT_JOB_START_TIMEOUT", "300"))
+
+FILE_EXTENSIONS = {'xlsx': '.xlsx', 'csv': '.csv.gz', 'stores_xlsx': '.xlsx'}
+
+_lock = threading.Lock()
+_executor = None
+_executor_pid = None
+_handlers = {}  # job kind -> handler(job_id, params, set_progress) returning (path, filename) or None
+
+def register_job_handler(kind):
+    """Register the function that runs jobs of the given kind"""
+    def decorator(func):
+        _handlers[kind] = func
+        return func
+    return decorator
+
+def _get_executor():
+    """Thread pool of this process, recreated after a fork"""
+    global _executor, _executor_pid
+    with _lock:
+        if _executor is None or _executor_pid != os.getpid():
+            _executor = ThreadPoolExecutor(max_workers=EXPORT_JOB_WORKERS, thread_name_prefix='export-job')
+            _executor_pid = os.getpid()
+        return _executor
+
+def export_cache_key(counter_ids, period, kind):
+    """Key identifying interchangeable file exports"""
+    raw = f"{scope_key(counter_ids)}|{period}|{kind}"
+    return hashlib.sha1(raw.encode('utf-8')).hexdigest()
+
+def _update_job(job_id, *conditions, **values):
+    """Update a job row on its own connection, outside the running session's transaction"""
+    with db.engine.begin() as connection:
+        result = connection.execute(db.update(ExportJob).where(ExportJob.id == job_id, *conditions).values(**values))
+        return result.rowcount
+
+def _run_job(app, job_id):
+    """Execute a queued job in a pool thread"""
+    with app.app_context():
+        try:
+            job = db.session.get(ExportJob, job_id)
+            if job is None or job.status != 'pending':
+                return
+            kind, params = job.kind, json.loads(job.params or '{}')
+            db.session.rollback()
+            # The row may have been failed as not started meanwhile
+            if not _update_job(job_id, ExportJob.status == 'pending',
+                               status='running', started_at=datetime.now(timezone.utc)):
+                return
+
+            reported = [None]
+            def set_progress(percent):
+                if percent != reported[0]:
+                    reported[0] = percent
+                    _update_job(job_id, progress=percent)
+
+            result = _handlers[kind](job_id, params, set_progress)
+            values = {'status': 'done', 'progress': 100, 'finished_at': datetime.now(timezone.utc)}
+            if result:
+                values['file_path'], values['filename'] = result
+            _update_job(job_id, **values)
+            logger.info(f"Export job {job_id} ({kind}) finished")
+
+        except Exception as e:
+            logger.error(f"Error running export job {job_id}: {e}")
+            db.session.rollback()
+            _update_job(job_id, status='failed', error=str(e), finished_at=datetime.now(timezone.utc))
+        finally:
+            db.session.remove()
+
+def submit_job(user_id, kind, params, cache_key=None):
+    """Enqueue a job, or return a fresh or in-flight job with the same cache key"""
+    purge_expired_jobs()
+
+    if cache_key:
+        now = datetime.now(timezone.utc)
+        existing = ExportJob.query.filter(
+            ExportJob.cache_key == cache_key,
+            db.or_(
+                db.and_(ExportJob.status == 'done',
+                        ExportJob.finished_at >= now - timedelta(seconds=EXPORT_CACHE_TTL)),
+                db.and_(ExportJob.status == 'pending',
+                        ExportJob.created_at >= now - timedelta(seconds=EXPORT_JOB_START_TIMEOUT)),
+                db.and_(ExportJob.status == 'running',
+                        ExportJob.started_at >= now - timedelta(seconds=EXPORT_JOB_TIMEOUT))
+            )
+        ).order_by(ExportJob.created_at.desc()).first()
+        if existing and (existing.status != 'done' or os.path.exists(existing.file_path or '')):
+            return existing
+
+    job = ExportJob(id=uuid.uuid4().hex, user_id=user_id, kind=kind, cache_key=cache_key,
+                    params=json.dumps(params), status='pending')
+    db.session.add(job)
+    db.session.commit()
+
+    _get_executor().submit(_run_job, current_app._get_current_object(), job.id)
+    return job
+
+def job_status(job):
+    """Public status of a job for polling clients"""
+    return {
+        'id': job.id,
+        'kind': job.kind,
+        'status': job.status,
+        'progress': job.progress,
+        'error': 'Ошибка при выполнении задания' if job.status == 'failed' else None,
+        'created_at': job.created_at.isoformat() if job.created_at else None,
+        'finished_at': job.finished_at.isoformat() if job.finished_at else None
+    }
+
+def purge_expired_jobs():
+    """Delete old jobs with their files and fail jobs that never finished"""
+    now = datetime.now(timezone.utc)
+    try:
+        expired = ExportJob.query.filter(
+            ExportJob.created_at < now - timedelta(seconds=EXPORT_RETENTION)
+        ).all()
+        for job in expired:
+            if job.file_path:
+                remove_file(job.file_path)
+            db.session.delete(job)
+
+        ExportJob.query.filter(
+            ExportJob.status == 'pending',
+            ExportJob.created_at < now - timedelta(seconds=EXPORT_JOB_START_TIMEOUT)
+        ).update({'status': 'failed', 'error': 'not started', 'finished_at': now}, synchronize_session=False)
+        ExportJob.query.filter(
+            ExportJob.status == 'running',
+            ExportJob.started_at < now - timedelta(seconds=EXPORT_JOB_TIMEOUT)
+        ).update({'status': 'failed', 'error': 'timeout', 'finished_at': now}, synchronize_session=False)
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        logger.error(f"Error purging export jobs: {e}")
+
+def _artifact_path(job_id, kind):
+    os.makedirs(EXPORT_DIR, exist_ok=True)
+    return os.path.join(EXPORT_DIR, f"{job_id}{FILE_EXTENSIONS[kind]}")
+
+def _track_progress(rows, total, set_progress):
+    """Pass rows through, reporting the share written so far"""
+    for count, row in enumerate(rows, 1):
+        if count % EXPORT_BATCH_SIZE == 0:
+            set_progress(min(99, count * 100 // total))
+        yield row
+
+@register_job_handler('xlsx')
+def run_xlsx_export(job_id, params, set_progress):
+    """Write the Excel export of a job to its artifact file"""
+    counter_ids = params['counter_ids']
+    start_date = datetime.fromisoformat(params['start_date'])
+    total_rows, total_visitors = export_totals(counter_ids, start_date)
+    summary = xlsx_summary(params['period'], len(counter_ids), total_rows, total_visitors)
+
+    path = _artifact_path(job_id, 'xlsx')
+    partial = f"{path}.part"
+    rows = export_query(counter_ids, start_date).yield_per(EXPORT_BATCH_SIZE)
+    try:
+        write_xlsx_export(partial, _track_progress(rows, max(total_rows, 1), set_progress), summary)
+        os.replace(partial, path)
+    finally:
+        remove_file(partial)
+    return path, f"{params['filename']}.xlsx"
+
+@register_job_handler('csv')
+def run_csv_export(job_id, params, set_progress):
+    """Write the gzip CSV export of a job to its artifact file"""
+    path = _artifact_path(job_id, 'csv')
+    partial = f"{path}.part"
+    try:
+        with open(partial, 'wb') as f:
+            for chunk in stream_csv_gzip(params['counter_ids'], datetime.fromisoformat(params['start_date'])):
+                f.write(chunk)
+        os.replace(partial, path)
+    finally:
+        remove_file(partial)
+    return path, f"{params['filename']}.csv.gz"
+
+@register_job_handler('stores_xlsx')
+def run_store_workbook_export(job_id, params, set_progress):
+    """Write the per-store workbook of a job to its artifact file"""
+    path = _artifact_path(job_id, 'stores_xlsx')
+    partial = f"{path}.part"
+    try:
+        build_store_workbook(partial, params['counter_ids'], datetime.fromisoformat(params['start_date']),
+                             params['period'], set_progress)
+        os.replace(partial, path)
+    finally:
+        remove_file(partial)
+    return path, f"{params['filename']}_stores.xlsx"
@@ -0,0 +1,251 @@
+"""
+Streaming data exports
+
+Rows are read through a server-side cursor in fixed-size batches and
+written straight to a temporary file, so memory use does not grow with
+the export period. The file is streamed back in chunks and removed once
+sent.
+"""
+
+import io
+import os
+import csv
+import zlib
+import queue
+import logging
+import tempfile
+import threading
+import xlsxwriter
+from datetime import datetime
+from database import db
+from database.models import Store, VisitorCounter, VisitorData
+
+logger = logging.getLogger(__name__)
+
+# Rows fetched per round trip from the server-side cursor
+EXPORT_BATCH_SIZE = 5000
+
+# Bytes per chunk when streaming a finished file to the client
+STREAM_CHUNK_SIZE = 64 * 1024
+
+EXPORT_HEADERS = ['Дата и время', 'Магазин', 'Счетчик', 'Вход', 'Выход', 'Текущая посещаемость']
+
+XLSX_MIMETYPE = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+
+# Compressed chunks buffered between the COPY thread and the response
+CSV_QUEUE_SIZE = 32
+
+def export_query(counter_ids, start_date):
+    """Rows of the visitor data export for the given counters, newest first"""
+    return db.session.query(
+        VisitorData.timestamp,
+        Store.name.label('store_name'),
+        VisitorCounter.name.label('counter_name'),
+        VisitorData.entries,
+        VisitorData.exits,
+        VisitorData.current_occupancy
+    ).select_from(VisitorData).join(VisitorCounter).join(Store).filter(
+        VisitorData.counter_id.in_(counter_ids) if counter_ids else False,
+        VisitorData.timestamp >= start_date
+    ).order_by(VisitorData.timestamp.desc())
+
+def export_totals(counter_ids, start_date):
+    """Row count and visitor total of the export, computed in the database"""
+    if not counter_ids:
+        return 0, 0
+    
+    totals = db.session.query(
+        db.func.count(VisitorData.id),
+        db.func.coalesce(db.func.sum(VisitorData.entries), 0)
+    ).filter(
+        VisitorData.counter_id.in_(counter_ids),
+        VisitorData.timestamp >= start_date
+    ).one()
+    return int(totals[0]), int(totals[1])
+
+def xlsx_summary(period, counter_count, total_rows, total_visitors, user=None):
+    """Label/value rows of the summary sheet; user details only for personal exports"""
+    summary = [
+        ['Период', period],
+        ['Дата экспорта', datetime.now().strftime('%Y-%m-%d %H:%M:%S')]
+    ]
+    if user is not None:
+        summary += [
+            ['Пользователь', user.username],
+            ['Роль', user.role.description]
+        ]
+    summary += [
+        ['Всего записей', total_rows],
+        ['Всего посетителей', total_visitors],
+        ['Доступных счетчиков', counter_count]
+    ]
+    return summary
+
+def write_xlsx_export(path, rows, summary):
+    """Write export rows and a summary sheet to an .xlsx file
+
+    constant_memory mode flushes every finished row to disk, so only the
+    current row is held in memory; rows must be written in order.
+    """
+    workbook = xlsxwriter.Workbook(path, {'constant_memory': True, 'tmpdir': os.path.dirname(path)})
+    try:
+        worksheet = workbook.add_worksheet('Данные посетителей')
+        worksheet.write_row(0, 0, EXPORT_HEADERS)
+        
+        row_num = 0
+        for row_num, row in enumerate(rows, 1):
+            worksheet.write_row(row_num, 0, (
+                row.timestamp.strftime('%Y-%m-%d %H:%M:%S'),
+                row.store_name,
+                row.counter_name,
+                row.entries,
+                row.exits,
+                row.current_occupancy
+            ))
+        
+        summary_sheet = workbook.add_worksheet('Сводка')
+        for summary_row, (label, value) in enumerate(summary):
+            summary_sheet.write(summary_row, 0, label)
+            summary_sheet.write(summary_row, 1, str(value))
+    finally:
+        workbook.close()
+    return row_num
+
+def create_export_file(suffix):
+    """Reserve a temporary file for an export and return its path"""
+    handle, path = tempfile.mkstemp(prefix='export_', suffix=suffix)
+    os.close(handle)
+    return path
+
+def stream_file(path, chunk_size=STREAM_CHUNK_SIZE):
+    """Yield a file in chunks and delete it afterwards"""
+    try:
+        with open(path, 'rb') as f:
+            while True:
+                chunk = f.read(chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+    finally:
+        remove_file(path)
+
+def remove_file(path):
+    """Delete a temporary export file, ignoring files already gone"""
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        logger.error(f"Error removing export file {path}: {e}")
+
+class ExportCancelled(Exception):
+    """The client stopped reading the export stream"""
+
+class _GzipChunks:
+    """Incremental gzip compression of CSV text"""
+    
+    def __init__(self):
+        # wbits 31: deflate with a gzip header and trailer
+        self.compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    
+    def compress(self, data):
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        return self.compressor.compress(data)
+    
+    def finish(self):
+        return self.compressor.flush()
+
+class _CopySink:
+    """File-like target for copy_expert that hands gzip chunks to the response"""
+    
+    def __init__(self, chunks, cancelled):
+        self.gzip = _GzipChunks()
+        self.chunks = chunks
+        self.cancelled = cancelled
+    
+    def put(self, item):
+        while True:
+            if self.cancelled.is_set():
+                raise ExportCancelled()
+            try:
+                self.chunks.put(item, timeout=1)
+                return
+            except queue.Full:
+                continue
+    
+    def write(self, data):
+        compressed = self.gzip.compress(data)
+        if compressed:
+            self.put(compressed)
+    
+    def close(self):
+        self.put(self.gzip.finish())
+
+def _copy_to_queue(engine, statement, sink):
+    """Run COPY (statement) TO STDOUT on a raw psycopg2 connection, feeding the sink"""
+    connection = engine.raw_connection()
+    try:
+        cursor = connection.cursor()
+        select = cursor.mogrify(str(statement), statement.params).decode('utf-8')
+        cursor.copy_expert(f"COPY ({select}) TO STDOUT WITH (FORMAT csv, HEADER true)", sink)
+        sink.close()
+        sink.put(None)
+    except ExportCancelled:
+        logger.info("CSV export cancelled by the client")
+    except Exception as e:
+        logger.error(f"Error running CSV export: {e}")
+        try:
+            sink.put(e)
+        except ExportCancelled:
+            pass
+    finally:
+        connection.rollback()
+        connection.close()
+
+def _stream_copy(query):
+    """gzip-compressed CSV from Postgres COPY, produced in a thread while the response is sent"""
+    engine = db.engine
+    statement = query.statement.compile(dialect=engine.dialect, compile_kwargs={'render_postcompile': True})
+    chunks = queue.Queue(maxsize=CSV_QUEUE_SIZE)
+    cancelled = threading.Event()
+    worker = threading.Thread(target=_copy_to_queue, args=(engine, statement, _CopySink(chunks, cancelled)),
+                              daemon=True)
+    worker.start()
+    try:
+        while True:
+            item = chunks.get()
+            if item is None:
+                return
+            if isinstance(item, Exception):
+                # A response whose headers are already sent is cut short, so the truncated
+                # gzip fails to decompress; an export job is marked failed instead of cached
+                raise item
+            yield item
+    finally:
+        cancelled.set()
+
+def _stream_rows(query):
+    """gzip-compressed CSV written row by row, for databases without COPY"""
+    gzip = _GzipChunks()
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator='\n')
+    writer.writerow([column['name'] for column in query.column_descriptions])
+    
+    for count, row in enumerate(query.yield_per(EXPORT_BATCH_SIZE), 1):
+        writer.writerow(row)
+        if count % EXPORT_BATCH_SIZE == 0:
+            compressed = gzip.compress(buffer.getvalue())
+            buffer.seek(0)
+            buffer.truncate()
+            if compressed:
+                yield compressed
+    
+    yield gzip.compress(buffer.getvalue()) + gzip.finish()
+
+def stream_csv_gzip(counter_ids, start_date):
+    """Yield the export as gzip-compressed CSV chunks, via COPY on Postgres"""
+    query = export_query(counter_ids, start_date)
+    if db.engine.dialect.name == 'postgresql':
+        return _stream_copy(query)
+    return _stream_rows(query)
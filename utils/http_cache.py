@@ -0,0 +1,32 @@
+"""
+Conditional GET helpers (ETag / Last-Modified)
+"""
+
+import hashlib
+import json
+from flask import request, make_response
+from werkzeug.http import is_resource_modified
+
+def compute_etag(*parts):
+    """Build an ETag value from data version parts"""
+    payload = json.dumps(parts, default=str, sort_keys=True)
+    return hashlib.sha1(payload.encode('utf-8')).hexdigest()
+
+def set_cache_validators(response, etag, last_modified=None, private=True):
+    """Attach ETag/Last-Modified and require revalidation on every use"""
+    response.set_etag(etag)
+    if last_modified:
+        response.last_modified = last_modified
+    response.cache_control.no_cache = True
+    if private:
+        response.cache_control.private = True
+    return response
+
+def not_modified_response(etag, last_modified=None, private=True):
+    """Return a 304 response if the client copy is current, otherwise None"""
+    if request.method not in ('GET', 'HEAD'):
+        return None
+    if is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+        return None
+    response = make_response('', 304)
+    return set_cache_validators(response, etag, last_modified, private)
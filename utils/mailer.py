@@ -0,0 +1,352 @@
+"""
+Pooled SMTP delivery with a durable retry queue
+
+A message for many recipients is built once and spooled to a file; each
+recipient gets a row in email_deliveries that tracks its status. Sends
+run concurrently on a small pool of persistent SMTP connections, so a
+batch does not pay a TLS handshake and login per email. Failed sends are
+retried with exponential backoff by a per-process worker, which claims
+due rows with a conditional update so only one worker sends each one.
+"""
+
+import os
+import uuid
+import email.policy
+import queue
+import smtplib
+import logging
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+from email import encoders
+from email.mime.base import MIMEBase
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+from sqlalchemy import select, update, delete
+from database import db
+from database.models import EmailDelivery
+
+logger = logging.getLogger(__name__)
+
+SMTP_SERVER = os.environ.get("SMTP_SERVER", "smtp.gmail.com")
+SMTP_PORT = int(os.environ.get("SMTP_PORT", "587"))
+SMTP_STARTTLS = os.environ.get("SMTP_STARTTLS", "1") == "1"
+SMTP_TIMEOUT = int(os.environ.get("SMTP_TIMEOUT", "30"))
+EMAIL_FROM = os.environ.get("EMAIL_FROM", "reports@company.com")
+EMAIL_PASSWORD = os.environ.get("EMAIL_PASSWORD", "")
+
+# Concurrent sends, and persistent SMTP connections, per process
+SMTP_CONCURRENCY = int(os.environ.get("SMTP_CONCURRENCY", "4"))
+# Messages sent over one connection before it is replaced (servers limit this)
+SMTP_MAX_MESSAGES = int(os.environ.get("SMTP_MAX_MESSAGES", "100"))
+# Idle pooled connections are checked with NOOP after this many seconds
+SMTP_IDLE_CHECK = 60
+
+# Retry policy: attempts per message and the first backoff delay (seconds), doubled per attempt
+MAIL_MAX_ATTEMPTS = int(os.environ.get("MAIL_MAX_ATTEMPTS", "5"))
+MAIL_RETRY_DELAY = int(os.environ.get("MAIL_RETRY_DELAY", "60"))
+MAIL_RETRY_MAX_DELAY = 3600
+# Seconds between retry sweeps, and after which a 'sending' row is considered abandoned
+MAIL_RETRY_INTERVAL = int(os.environ.get("MAIL_RETRY_INTERVAL", "30"))
+MAIL_SENDING_TIMEOUT = 600
+# Finished deliveries and their spooled messages are deleted after this many seconds
+MAIL_RETENTION = int(os.environ.get("MAIL_RETENTION", str(7 * 86400)))
+MAIL_SPOOL_DIR = os.environ.get("MAIL_SPOOL_DIR", os.path.join(tempfile.gettempdir(), "visitor_mail"))
+
+_lock = threading.Lock()
+_pool = None
+_pool_pid = None
+_executor = None
+_worker = None
+_worker_pid = None
+
+def _utcnow():
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+class SMTPPool:
+    """Up to size persistent SMTP connections shared by the sending threads"""
+
+    def __init__(self, size):
+        self.slots = threading.BoundedSemaphore(size)
+        self.idle = queue.LifoQueue()  # (server, messages sent, last used)
+
+    def _connect(self):
+        server = smtplib.SMTP(SMTP_SERVER, SMTP_PORT, timeout=SMTP_TIMEOUT)
+        if SMTP_STARTTLS:
+            server.starttls()
+        if EMAIL_PASSWORD:
+            server.login(EMAIL_FROM, EMAIL_PASSWORD)
+        return server
+
+    @staticmethod
+    def _close(server):
+        try:
+            server.quit()
+        except Exception:
+            server.close()
+
+    def _checkout(self):
+        """An idle connection that still answers, or a new one"""
+        while True:
+            try:
+                server, sent, last_used = self.idle.get_nowait()
+            except queue.Empty:
+                return self._connect(), 0, True
+            if time.time() - last_used < SMTP_IDLE_CHECK:
+                return server, sent, False
+            try:
+                if server.noop()[0] == 250:
+                    return server, sent, False
+            except smtplib.SMTPException:
+                pass
+            self._close(server)
+
+    @contextmanager
+    def connection(self):
+        """Borrow a connection; it is dropped if the block raises, unless the server just refused the message"""
+        with self.slots:
+            server, sent, fresh = self._checkout()
+            try:
+                yield server, fresh
+            except (smtplib.SMTPRecipientsRefused, smtplib.SMTPSenderRefused, smtplib.SMTPDataError):
+                # smtplib has reset the transaction, the session is still usable
+                self.idle.put((server, sent, time.time()))
+                raise
+            except Exception:
+                self._close(server)
+                raise
+            sent += 1
+            if sent >= SMTP_MAX_MESSAGES:
+                self._close(server)
+            else:
+                self.idle.put((server, sent, time.time()))
+
+    def send(self, recipient, message):
+        """Send one message, reconnecting once if the server closed a pooled connection"""
+        for attempt in range(2):
+            fresh = True
+            try:
+                with self.connection() as (server, fresh):
+                    server.sendmail(EMAIL_FROM, [recipient], message)
+                return
+            except smtplib.SMTPServerDisconnected:
+                if fresh or attempt:
+                    raise
+
+def _get_pool():
+    """SMTP pool and sending threads of this process, recreated after a fork"""
+    global _pool, _pool_pid, _executor
+    with _lock:
+        if _pool is None or _pool_pid != os.getpid():
+            _pool = SMTPPool(SMTP_CONCURRENCY)
+            _executor = ThreadPoolExecutor(max_workers=SMTP_CONCURRENCY, thread_name_prefix='smtp')
+            _pool_pid = os.getpid()
+        return _pool, _executor
+
+def build_message(subject, html_content, attachment=None, filename=None):
+    """MIME message without a To header, shared by all recipients of a batch"""
+    # SMTP policy: CRLF line endings, since smtplib sends bytes messages as they are
+    msg = MIMEMultipart(policy=email.policy.SMTP)
+    msg['From'] = EMAIL_FROM
+    msg['Subject'] = subject
+    msg.attach(MIMEText(html_content, 'html', policy=email.policy.SMTP))
+
+    if attachment and filename:
+        part = MIMEBase('application', 'octet-stream', policy=email.policy.SMTP)
+        part.set_payload(attachment)
+        encoders.encode_base64(part)
+        part.add_header('Content-Disposition', 'attachment', filename=filename)
+        msg.attach(part)
+    return msg.as_bytes()
+
+def _addressed(message, recipient):
+    recipient = recipient.replace('\r', '').replace('\n', '')
+    return f"To: {recipient}\r\n".encode('utf-8') + message
+
+def queue_email(recipients, subject, html_content, attachment=None, filename=None):
+    """Spool one message for several recipients and return their delivery ids, claimed for sending"""
+    recipients = list(dict.fromkeys(recipients))
+    if not recipients:
+        return []
+
+    os.makedirs(MAIL_SPOOL_DIR, exist_ok=True)
+    path = os.path.join(MAIL_SPOOL_DIR, f"{uuid.uuid4().hex}.eml")
+    with open(path, 'wb') as f:
+        f.write(build_message(subject, html_content, attachment, filename))
+
+    now = _utcnow()
+    deliveries = [EmailDelivery(recipient=recipient, subject=subject[:255], message_path=path,
+                                status='sending', next_attempt_at=now, created_at=now, updated_at=now)
+                  for recipient in recipients]
+    db.session.add_all(deliveries)
+    db.session.commit()
+    return [delivery.id for delivery in deliveries]
+
+def _backoff(attempts):
+    return timedelta(seconds=min(MAIL_RETRY_MAX_DELAY, MAIL_RETRY_DELAY * 2 ** (attempts - 1)))
+
+def _is_permanent(error):
+    """5xx answers about the recipient or message will not succeed on retry"""
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        return all(code >= 500 for code, _ in error.recipients.values())
+    if isinstance(error, (smtplib.SMTPDataError, smtplib.SMTPSenderRefused)):
+        return error.smtp_code >= 500
+    return False
+
+def _send_claimed(engine, pool, row, message, claims):
+    """Send one delivery unless another worker took it over; returns False when skipped
+
+    The time the send started under is recorded in claims, and the outcome is
+    only written while the row still carries it.
+    """
+    started = _utcnow()
+    with engine.begin() as connection:
+        # Refreshed as the send starts, so rows queued behind a long batch are not taken for abandoned ones
+        result = connection.execute(
+            update(EmailDelivery)
+            .where(EmailDelivery.id == row.id, EmailDelivery.status == 'sending',
+                   EmailDelivery.updated_at == row.updated_at)
+            .values(updated_at=started)
+        )
+    if result.rowcount != 1:
+        return False
+    claims[row.id] = started
+    pool.send(row.recipient, _addressed(message, row.recipient))
+    return True
+
+def send_deliveries(delivery_ids):
+    """Send claimed deliveries concurrently and record the outcome; returns {delivery_id: status}"""
+    if not delivery_ids:
+        return {}
+    rows = db.session.execute(
+        select(EmailDelivery.id, EmailDelivery.recipient, EmailDelivery.message_path, EmailDelivery.attempts,
+               EmailDelivery.updated_at)
+        .where(EmailDelivery.id.in_(delivery_ids), EmailDelivery.status == 'sending')
+    ).all()
+    db.session.rollback()
+
+    pool, executor = _get_pool()
+    engine = db.engine
+    claims = {}
+    messages = {}
+    futures = {}
+    for row in rows:
+        if row.message_path not in messages:
+            try:
+                with open(row.message_path, 'rb') as f:
+                    messages[row.message_path] = f.read()
+            except OSError as e:
+                logger.error(f"Error reading spooled email {row.message_path}: {e}")
+                messages[row.message_path] = None
+        message = messages[row.message_path]
+        if message is not None:
+            futures[row] = executor.submit(_send_claimed, engine, pool, row, message, claims)
+
+    statuses = {}
+    for row in rows:
+        future = futures.get(row)
+        error = future.exception() if future else FileNotFoundError(row.message_path)
+        if future and error is None and not future.result():
+            # Reset by the retry worker before its turn came: the retry sends it
+            statuses[row.id] = 'pending'
+            continue
+        claimed_at = claims.get(row.id, row.updated_at)
+        now = _utcnow()
+        attempts = row.attempts + 1
+        if error is None:
+            values = {'status': 'sent', 'sent_at': now, 'last_error': None}
+        elif future is None or _is_permanent(error) or attempts >= MAIL_MAX_ATTEMPTS:
+            logger.error(f"Email to {row.recipient} failed: {error}")
+            values = {'status': 'failed', 'last_error': str(error)}
+        else:
+            logger.warning(f"Email to {row.recipient} failed, retry {attempts}: {error}")
+            values = {'status': 'pending', 'last_error': str(error), 'next_attempt_at': now + _backoff(attempts)}
+        with db.engine.begin() as connection:
+            result = connection.execute(update(EmailDelivery)
+                                        .where(EmailDelivery.id == row.id, EmailDelivery.status == 'sending',
+                                               EmailDelivery.updated_at == claimed_at)
+                                        .values(attempts=attempts, updated_at=now, **values))
+        if result.rowcount != 1:
+            logger.warning(f"Email to {row.recipient} was taken over by another worker during the send")
+        statuses[row.id] = values['status']
+
+    sent = sum(1 for status in statuses.values() if status == 'sent')
+    logger.info(f"Emails sent: {sent} of {len(statuses)}")
+    return statuses
+
+def claim_due_deliveries(limit=100):
+    """Mark due retries as sending and return their ids"""
+    now = _utcnow()
+    claimed = []
+    with db.engine.begin() as connection:
+        # Rows left 'sending' by a worker that died are retried
+        connection.execute(
+            update(EmailDelivery)
+            .where(EmailDelivery.status == 'sending',
+                   EmailDelivery.updated_at < now - timedelta(seconds=MAIL_SENDING_TIMEOUT))
+            .values(status='pending', updated_at=now)
+        )
+        due = connection.execute(
+            select(EmailDelivery.id)
+            .where(EmailDelivery.status == 'pending', EmailDelivery.next_attempt_at <= now)
+            .order_by(EmailDelivery.next_attempt_at)
+            .limit(limit)
+        ).scalars().all()
+        for delivery_id in due:
+            result = connection.execute(
+                update(EmailDelivery)
+                .where(EmailDelivery.id == delivery_id, EmailDelivery.status == 'pending')
+                .values(status='sending', updated_at=now)
+            )
+            if result.rowcount == 1:
+                claimed.append(delivery_id)
+    return claimed
+
+def purge_deliveries():
+    """Delete old finished deliveries and spooled messages no longer referenced"""
+    cutoff = _utcnow() - timedelta(seconds=MAIL_RETENTION)
+    with db.engine.begin() as connection:
+        paths = set(connection.execute(
+            select(EmailDelivery.message_path).where(EmailDelivery.created_at < cutoff,
+                                                     EmailDelivery.status.in_(['sent', 'failed']))
+        ).scalars())
+        connection.execute(delete(EmailDelivery).where(EmailDelivery.created_at < cutoff,
+                                                       EmailDelivery.status.in_(['sent', 'failed'])))
+        in_use = set(connection.execute(
+            select(EmailDelivery.message_path).where(EmailDelivery.message_path.in_(paths))
+        ).scalars()) if paths else set()
+    for path in paths - in_use:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+def _run_worker(app):
+    """Retry loop: send due retries, purge old deliveries"""
+    next_purge = 0
+    while True:
+        try:
+            with app.app_context():
+                send_deliveries(claim_due_deliveries())
+                if time.time() >= next_purge:
+                    purge_deliveries()
+                    next_purge = time.time() + 3600
+                db.session.remove()
+        except Exception as e:
+            logger.error(f"Mail retry worker error: {e}")
+
+        time.sleep(MAIL_RETRY_INTERVAL)
+
+def start_mail_worker(app):
+    """Start the retry worker once per process"""
+    global _worker, _worker_pid
+    with _lock:
+        if _worker is not None and _worker_pid == os.getpid() and _worker.is_alive():
+            return
+        _worker = threading.Thread(target=_run_worker, args=(app,), name='mail-retry', daemon=True)
+        _worker_pid = os.getpid()
+        _worker.start()
+    logger.info(f"Mail retry worker started ({SMTP_CONCURRENCY} connections)")
@@ -0,0 +1,177 @@
+"""
+Aggregate queries for dashboard metrics and charts
+"""
+
+from datetime import datetime, timedelta, timezone
+from database import db
+from database.models import Store, VisitorCounter, VisitorData, Alert
+
+# A counter is online if it sent data within this window
+ONLINE_WINDOW = timedelta(minutes=30)
+
+EMPTY_METRICS = {
+    'total_visitors': 0,
+    'current_occupancy': 0,
+    'total_counters': 0,
+    'online_counters': 0,
+    'active_alerts': 0
+}
+
+EMPTY_CHART_DATA = {
+    'daily_dates': [],
+    'daily_visitors': [],
+    'hourly_hours': [],
+    'hourly_visitors': [],
+    'store_names': [],
+    'store_visitors': []
+}
+
+def compute_headline_metrics(counter_ids):
+    """Compute headline metrics for the given counters"""
+    if not counter_ids:
+        return dict(EMPTY_METRICS)
+
+    now = datetime.now(timezone.utc)
+    yesterday = now - timedelta(days=1)
+    today_start = datetime.combine(now.date(), datetime.min.time().replace(tzinfo=timezone.utc))
+
+    totals = db.session.query(
+        db.func.coalesce(db.func.sum(VisitorData.entries), 0).label('total_entries'),
+        db.func.coalesce(db.func.sum(VisitorData.current_occupancy), 0).label('total_occupancy')
+    ).filter(
+        VisitorData.counter_id.in_(counter_ids),
+        VisitorData.timestamp >= yesterday
+    ).one()
+
+    online_counters = db.session.query(
+        db.func.count(db.distinct(VisitorData.counter_id))
+    ).filter(
+        VisitorData.counter_id.in_(counter_ids),
+        VisitorData.timestamp >= today_start
+    ).scalar()
+
+    active_alerts = Alert.query.filter(
+        Alert.counter_id.in_(counter_ids),
+        Alert.is_resolved == False
+    ).count()
+
+    return {
+        'total_visitors': int(totals.total_entries),
+        'current_occupancy': int(totals.total_occupancy),
+        'total_counters': len(counter_ids),
+        'online_counters': int(online_counters or 0),
+        'active_alerts': active_alerts
+    }
+
+def compute_counter_stats(counter_ids):
+    """Compute today's visitors and last update per counter"""
+    if not counter_ids:
+        return {}
+
+    today = datetime.now(timezone.utc).date()
+    today_start = datetime.combine(today, datetime.min.time().replace(tzinfo=timezone.utc))
+
+    rows = db.session.query(
+        VisitorData.counter_id,
+        db.func.sum(VisitorData.entries).label('today_visitors'),
+        db.func.max(VisitorData.timestamp).label('last_update')
+    ).filter(
+        VisitorData.counter_id.in_(counter_ids),
+        VisitorData.timestamp >= today_start
+    ).group_by(VisitorData.counter_id).all()
+
+    return {
+        row.counter_id: {
+            'today_visitors': int(row.today_visitors or 0),
+            'is_online': True,
+            'last_update': row.last_update
+        }
+        for row in rows
+    }
+
+def compute_chart_data(counter_ids):
+    """Compute daily trend, today's hourly curve and per-store weekly totals"""
+    if not counter_ids:
+        return dict(EMPTY_CHART_DATA)
+
+    # Daily data for last 7 days
+    week_ago = datetime.now(timezone.utc) - timedelta(days=7)
+    daily_data = db.session.query(
+        db.func.date(VisitorData.timestamp).label('date'),
+        db.func.sum(VisitorData.entries).label('total_entries')
+    ).filter(
+        VisitorData.counter_id.in_(counter_ids),
+        VisitorData.timestamp >= week_ago
+    ).group_by(
+        db.func.date(VisitorData.timestamp)
+    ).order_by('date').all()
+
+    # Hourly data for today
+    today = datetime.now(timezone.utc).date()
+    hourly_data = db.session.query(
+        db.func.extract('hour', VisitorData.timestamp).label('hour'),
+        db.func.sum(VisitorData.entries).label('total_entries')
+    ).filter(
+        VisitorData.counter_id.in_(counter_ids),
+        db.func.date(VisitorData.timestamp) == today
+    ).group_by(
+        db.func.extract('hour', VisitorData.timestamp)
+    ).order_by('hour').all()
+
+    # Store performance data for last 7 days
+    store_data = db.session.query(
+        Store.name,
+        db.func.sum(VisitorData.entries).label('total_entries')
+    ).join(
+        VisitorCounter, VisitorCounter.store_id == Store.id
+    ).join(
+        VisitorData, VisitorData.counter_id == VisitorCounter.id
+    ).filter(
+        VisitorData.counter_id.in_(counter_ids),
+        VisitorData.timestamp >= week_ago
+    ).group_by(Store.name).all()
+
+    return {
+        'daily_dates': [str(row.date) for row in daily_data],
+        'daily_visitors': [int(row.total_entries) for row in daily_data],
+        'hourly_hours': [f"{int(row.hour):02d}:00" for row in hourly_data],
+        'hourly_visitors': [int(row.total_entries) for row in hourly_data],
+        'store_names': [row.name for row in store_data],
+        'store_visitors': [int(row.total_entries) for row in store_data]
+    }
+
+def compute_data_version(counter_ids):
+    """Return the latest ingest sequence and ingest time for the given counters"""
+    if not counter_ids:
+        return {'ingest_seq': 0, 'last_ingest': None}
+
+    row = db.session.query(
+        db.func.max(VisitorData.id).label('ingest_seq'),
+        db.func.max(VisitorData.created_at).label('last_ingest')
+    ).filter(VisitorData.counter_id.in_(counter_ids)).one()
+
+    return {'ingest_seq': row.ingest_seq or 0, 'last_ingest': row.last_ingest}
+
+def compute_alerts_version(counter_ids):
+    """Return a version tuple for unresolved alerts of the given counters"""
+    if not counter_ids:
+        return (0, 0, None)
+
+    row = db.session.query(
+        db.func.count(Alert.id),
+        db.func.max(Alert.id),
+        db.func.max(Alert.updated_at)
+    ).filter(
+        Alert.counter_id.in_(counter_ids),
+        Alert.is_resolved == False
+    ).one()
+
+    return (row[0], row[1] or 0, row[2])
+
+def compute_online_counter_ids():
+    """Return ids of counters that sent data within the online window"""
+    since = datetime.now(timezone.utc) - ONLINE_WINDOW
+    rows = db.session.query(VisitorData.counter_id).filter(
+        VisitorData.timestamp >= since
+    ).distinct().all()
+    return {row.counter_id for row in rows}
@@ -0,0 +1,143 @@
+"""
+Background precompute worker for hot dashboard aggregates
+
+Requests never run aggregate queries inline: they read the latest
+precomputed result for their scope and keep getting it while the worker
+refreshes it in the background.
+"""
+
+import os
+import hashlib
+import logging
+import threading
+import time
+from datetime import datetime, timezone
+from database import db
+from database.models import VisitorCounter
+from utils.metrics import (compute_headline_metrics, compute_counter_stats, compute_chart_data,
+                           compute_data_version, compute_online_counter_ids)
+from utils.http_cache import compute_etag
+from utils.pubsub import publish
+
+logger = logging.getLogger(__name__)
+
+# Refresh interval and how long an unrequested scope is kept warm (seconds)
+PRECOMPUTE_INTERVAL = int(os.environ.get("PRECOMPUTE_INTERVAL", "60"))
+SCOPE_IDLE_TIMEOUT = int(os.environ.get("PRECOMPUTE_SCOPE_IDLE_TIMEOUT", "3600"))
+
+_lock = threading.Lock()
+_wakeup = threading.Event()
+_scopes = {}   # scope key -> {'counter_ids': [...], 'last_requested': float}
+_results = {}  # scope key -> precomputed aggregates
+_online_counter_ids = None  # online set seen by the last status sweep
+_worker = None
+_worker_pid = None
+
+def scope_key(counter_ids):
+    """Build a stable cache key for a set of counter ids"""
+    ids = ','.join(str(cid) for cid in sorted(set(counter_ids)))
+    return hashlib.sha1(ids.encode('utf-8')).hexdigest()[:16]
+
+def get_scope_aggregates(counter_ids):
+    """Return precomputed aggregates for a scope, or None while it is warming up"""
+    key = scope_key(counter_ids)
+    with _lock:
+        scope = _scopes.get(key)
+        if scope is None:
+            scope = _scopes[key] = {'counter_ids': sorted(set(counter_ids)), 'last_requested': 0}
+        scope['last_requested'] = time.time()
+        result = _results.get(key)
+
+    if result is None:
+        # New scope: ask the worker to compute it right away
+        _wakeup.set()
+    return result
+
+def refresh_scope(key, counter_ids):
+    """Recompute aggregates for one scope and publish them to the cache"""
+    data_version = compute_data_version(counter_ids)
+    result = {
+        'metrics': compute_headline_metrics(counter_ids),
+        'counter_stats': compute_counter_stats(counter_ids),
+        'chart_data': compute_chart_data(counter_ids),
+        'computed_at': datetime.now(timezone.utc),
+        'last_modified': data_version['last_ingest']
+    }
+    # Version changes only when the ingest sequence or the aggregates change
+    result['version'] = compute_etag(data_version['ingest_seq'], result['metrics'],
+                                     result['chart_data'], result['counter_stats'])
+    with _lock:
+        previous = _results.get(key)
+        _results[key] = result
+
+    if previous is not None and previous['version'] != result['version']:
+        publish('metrics', result['metrics'], scope_key=key)
+    return result
+
+def refresh_all_scopes(only_missing=False):
+    """Refresh every active scope and drop the ones nobody requested lately"""
+    now = time.time()
+    with _lock:
+        for key in [k for k, s in _scopes.items() if now - s['last_requested'] > SCOPE_IDLE_TIMEOUT]:
+            _scopes.pop(key, None)
+            _results.pop(key, None)
+        pending = [(k, s['counter_ids']) for k, s in _scopes.items()
+                   if not only_missing or k not in _results]
+
+    for key, counter_ids in pending:
+        try:
+            refresh_scope(key, counter_ids)
+        except Exception as e:
+            logger.error(f"Error precomputing aggregates for scope {key}: {e}")
+            db.session.rollback()
+
+def detect_status_transitions():
+    """Publish online/offline transitions since the previous sweep"""
+    global _online_counter_ids
+    online = compute_online_counter_ids()
+    previous, _online_counter_ids = _online_counter_ids, online
+    if previous is None:
+        return
+
+    changed = (online - previous) | (previous - online)
+    if not changed:
+        return
+
+    counters = VisitorCounter.query.filter(VisitorCounter.id.in_(changed)).all()
+    for counter in counters:
+        publish('status', {
+            'counter_id': counter.id,
+            'store_id': counter.store_id,
+            'online': counter.id in online
+        }, counter_id=counter.id)
+
+def _run_worker(app):
+    """Worker loop: refresh on schedule, or immediately when a new scope appears"""
+    next_full_refresh = 0
+    while True:
+        _wakeup.clear()
+        try:
+            with app.app_context():
+                now = time.time()
+                if now >= next_full_refresh:
+                    refresh_all_scopes()
+                    detect_status_transitions()
+                    next_full_refresh = now + PRECOMPUTE_INTERVAL
+                else:
+                    refresh_all_scopes(only_missing=True)
+                db.session.remove()
+        except Exception as e:
+            logger.error(f"Precompute worker error: {e}")
+
+        _wakeup.wait(max(0, next_full_refresh - time.time()))
+
+def start_precompute_worker(app):
+    """Start the precompute worker once per process"""
+    global _worker, _worker_pid
+    with _lock:
+        if _worker is not None and _worker_pid == os.getpid() and _worker.is_alive():
+            return
+        _worker = threading.Thread(target=_run_worker, args=(app,), name='precompute-worker', daemon=True)
+        _worker_pid = os.getpid()
+        _worker.start()
+    logger.info(f"Precompute worker started (interval {PRECOMPUTE_INTERVAL}s)")
@@ -0,0 +1,198 @@
+"""
+Lightweight profiling of Dash callbacks
+
+instrument_callbacks(app) wraps every server-side callback registered on
+the app afterwards. Each call records wall time, the SQL statements it ran
+(count, time, rows reported by the driver) and the size of the serialized
+response, aggregated per callback into fixed-bucket histograms. Stats are
+kept in memory per worker process.
+"""
+
+import functools
+import logging
+import os
+import threading
+import time
+from flask import g, has_request_context, request
+from dash.exceptions import PreventUpdate
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds of the wall time histogram buckets (ms); the last bucket is open
+TIME_BUCKETS_MS = [10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000]
+
+_lock = threading.Lock()
+_stats = {}  # callback name -> aggregated stats
+_current = threading.local()  # profile of the callback running in this thread
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    profile = getattr(_current, 'profile', None)
+    if profile is not None:
+        profile['sql_started'] = time.perf_counter()
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    profile = getattr(_current, 'profile', None)
+    if profile is None or profile.get('sql_started') is None:
+        return
+    profile['sql_queries'] += 1
+    profile['sql_ms'] += (time.perf_counter() - profile.pop('sql_started')) * 1000
+    # psycopg2 reports fetched rows for SELECT; drivers that do not report -1
+    profile['rows'] += max(cursor.rowcount or 0, 0)
+
+def _empty_stats():
+    return {
+        'calls': 0,
+        'errors': 0,
+        'prevented': 0,
+        'wall_ms': 0.0,
+        'max_ms': 0.0,
+        'sql_queries': 0,
+        'sql_ms': 0.0,
+        'rows': 0,
+        'output_bytes': 0,
+        'max_output_bytes': 0,
+        'histogram': [0] * (len(TIME_BUCKETS_MS) + 1)
+    }
+
+def record(name, wall_ms, sql_queries=0, sql_ms=0.0, rows=0, output_bytes=0, status='ok'):
+    """Add one callback call to the aggregated stats"""
+    bucket = len(TIME_BUCKETS_MS)
+    for i, bound in enumerate(TIME_BUCKETS_MS):
+        if wall_ms <= bound:
+            bucket = i
+            break
+    
+    with _lock:
+        stats = _stats.setdefault(name, _empty_stats())
+        stats['calls'] += 1
+        if status == 'error':
+            stats['errors'] += 1
+        elif status == 'prevented':
+            stats['prevented'] += 1
+        stats['wall_ms'] += wall_ms
+        stats['max_ms'] = max(stats['max_ms'], wall_ms)
+        stats['sql_queries'] += sql_queries
+        stats['sql_ms'] += sql_ms
+        stats['rows'] += rows
+        stats['output_bytes'] += output_bytes
+        stats['max_output_bytes'] = max(stats['max_output_bytes'], output_bytes)
+        stats['histogram'][bucket] += 1
+
+def _percentile(histogram, calls, fraction):
+    """Upper bound of the bucket holding the given fraction of calls, None if open-ended"""
+    target = calls * fraction
+    seen = 0
+    for i, count in enumerate(histogram):
+        seen += count
+        if seen >= target:
+            return TIME_BUCKETS_MS[i] if i < len(TIME_BUCKETS_MS) else None
+    return None
+
+def get_callback_stats():
+    """Per-callback stats with averages and bucket percentiles, slowest total time first"""
+    with _lock:
+        snapshot = {name: dict(stats, histogram=list(stats['histogram'])) for name, stats in _stats.items()}
+    
+    result = []
+    for name, stats in snapshot.items():
+        calls = stats['calls']
+        result.append(dict(
+            stats,
+            name=name,
+            avg_ms=stats['wall_ms'] / calls,
+            p50_ms=_percentile(stats['histogram'], calls, 0.5),
+            p95_ms=_percentile(stats['histogram'], calls, 0.95),
+            avg_sql_queries=stats['sql_queries'] / calls,
+            avg_sql_ms=stats['sql_ms'] / calls,
+            avg_rows=stats['rows'] / calls,
+            avg_output_bytes=stats['output_bytes'] / calls
+        ))
+    result.sort(key=lambda s: s['wall_ms'], reverse=True)
+    return result
+
+def reset_callback_stats():
+    """Drop all collected stats"""
+    with _lock:
+        _stats.clear()
+
+def stats_process_id():
+    """Worker process the stats belong to"""
+    return os.getpid()
+
+def profile_callback(name, func):
+    """Wrap a callback function so each call is measured"""
+    
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        profile = {'sql_queries': 0, 'sql_ms': 0.0, 'rows': 0, 'sql_started': None}
+        previous = getattr(_current, 'profile', None)
+        _current.profile = profile
+        status = 'ok'
+        started = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        except PreventUpdate:
+            status = 'prevented'
+            raise
+        except Exception:
+            status = 'error'
+            raise
+        finally:
+            wall_ms = (time.perf_counter() - started) * 1000
+            _current.profile = previous
+            sample = {
+                'name': name,
+                'wall_ms': wall_ms,
+                'sql_queries': profile['sql_queries'],
+                'sql_ms': profile['sql_ms'],
+                'rows': profile['rows'],
+                'status': status
+            }
+            if has_request_context():
+                # The response size is only known once Dash has serialized it
+                g.callback_profile = sample
+            else:
+                record(**sample)
+    
+    return wrapper
+
+def _record_response(response):
+    """after_request hook: complete the callback sample with the response size"""
+    sample = g.pop('callback_profile', None)
+    if sample is not None:
+        try:
+            output_bytes = len(response.get_data()) if not response.is_streamed else 0
+            record(output_bytes=output_bytes, **sample)
+        except Exception as e:
+            logger.error(f"Error recording callback profile for {request.path}: {e}")
+    return response
+
+def instrument_callbacks(app):
+    """Profile every server-side callback registered on the Dash app from now on
+
+    Background callbacks are left alone: they run in separate worker
+    processes, not in the web workers handling requests.
+    """
+    if getattr(app, '_callbacks_instrumented', False):
+        return app
+    
+    register = app.callback
+    
+    def callback(*args, **kwargs):
+        decorator = register(*args, **kwargs)
+        if kwargs.get('background'):
+            return decorator
+        
+        def wrap(func):
+            module = func.__module__.rsplit('.', 1)[-1]
+            return decorator(profile_callback(f"{module}.{func.__name__}", func))
+        return wrap
+    
+    app.callback = callback
+    app.server.after_request(_record_response)
+    app._callbacks_instrumented = True
+    return app
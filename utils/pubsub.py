@@ -0,0 +1,76 @@
+"""
+In-process publish/subscribe for live dashboard updates
+
+The ingest path and the precompute worker publish small per-counter or
+per-scope events; every open Server-Sent Events stream holds a
+subscription that receives only the events of its own scope.
+"""
+
+import itertools
+import logging
+import queue
+import threading
+
+logger = logging.getLogger(__name__)
+
+# Events buffered per subscriber before it is considered too slow
+SUBSCRIBER_QUEUE_SIZE = 500
+
+_lock = threading.Lock()
+_subscribers = set()
+_sequence = itertools.count(1)
+
+class Subscription:
+    """Event queue for one listener, limited to a set of counters and a scope key"""
+
+    def __init__(self, counter_ids, scope_key=None):
+        self.counter_ids = set(counter_ids)
+        self.scope_key = scope_key
+        self.queue = queue.Queue(maxsize=SUBSCRIBER_QUEUE_SIZE)
+        self.overflowed = False
+
+    def matches(self, counter_id, scope_key):
+        if counter_id is not None:
+            return counter_id in self.counter_ids
+        if scope_key is not None:
+            return scope_key == self.scope_key
+        return True
+
+    def get(self, timeout):
+        """Return the next event or None on timeout"""
+        try:
+            return self.queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+def subscribe(counter_ids, scope_key=None):
+    """Register a new subscription"""
+    subscription = Subscription(counter_ids, scope_key)
+    with _lock:
+        _subscribers.add(subscription)
+    return subscription
+
+def unsubscribe(subscription):
+    """Remove a subscription"""
+    with _lock:
+        _subscribers.discard(subscription)
+
+def subscriber_count():
+    with _lock:
+        return len(_subscribers)
+
+def publish(event_type, data, counter_id=None, scope_key=None):
+    """Publish an event to every matching subscriber without blocking"""
+    event = {'id': next(_sequence), 'type': event_type, 'data': data}
+    with _lock:
+        targets = [s for s in _subscribers if s.matches(counter_id, scope_key)]
+
+    for subscription in targets:
+        try:
+            subscription.queue.put_nowait(event)
+        except queue.Full:
+            # Slow client: drop events and tell it to reload the whole state
+            if not subscription.overflowed:
+                subscription.overflowed = True
+                logger.warning("Live update subscriber queue is full, dropping events")
+    return event['id']
@@ -0,0 +1,82 @@
+"""
+Signed download links for report files
+
+Large report attachments are stored once on disk and the email carries
+a link instead: the token names the stored file and is signed with the
+application secret, and it expires after REPORT_LINK_TTL. Links need
+REPORT_BASE_URL, since reports are rendered outside of any request;
+without it reports keep being sent as attachments.
+"""
+
+import os
+import time
+import uuid
+import logging
+from flask import current_app
+from itsdangerous import URLSafeTimedSerializer, BadSignature, SignatureExpired
+from utils.export_jobs import EXPORT_DIR
+from utils.exports import remove_file
+
+logger = logging.getLogger(__name__)
+
+# Public address of the application, used to build links in emails
+REPORT_BASE_URL = os.environ.get("REPORT_BASE_URL", "").rstrip('/')
+# Attachments of at least this many bytes are sent as a link
+REPORT_LINK_THRESHOLD = int(os.environ.get("REPORT_LINK_THRESHOLD", str(1024 * 1024)))
+# Lifetime of a download link (seconds)
+REPORT_LINK_TTL = int(os.environ.get("REPORT_LINK_TTL", str(7 * 86400)))
+REPORT_LINK_DIR = os.environ.get("REPORT_LINK_DIR", os.path.join(EXPORT_DIR, "links"))
+
+_last_purge = 0
+
+def _serializer():
+    return URLSafeTimedSerializer(current_app.secret_key, salt='report-download')
+
+def use_link(size):
+    """Whether an attachment of this size is sent as a link"""
+    return bool(REPORT_BASE_URL) and size >= REPORT_LINK_THRESHOLD
+
+def store_report_file(data, filename):
+    """Store a report file once and return its signed download URL"""
+    purge_report_files()
+    os.makedirs(REPORT_LINK_DIR, exist_ok=True)
+    file_id = uuid.uuid4().hex
+    path = os.path.join(REPORT_LINK_DIR, file_id)
+    partial = f"{path}.part"
+    try:
+        with open(partial, 'wb') as f:
+            f.write(data)
+        os.replace(partial, path)
+    finally:
+        remove_file(partial)
+
+    token = _serializer().dumps({'id': file_id, 'filename': filename})
+    return f"{REPORT_BASE_URL}/reports/download/{token}"
+
+def resolve_report_token(token):
+    """Path and filename of a valid token, 'expired', or None for an invalid one"""
+    try:
+        payload = _serializer().loads(token, max_age=REPORT_LINK_TTL)
+    except SignatureExpired:
+        return 'expired'
+    except BadSignature:
+        return None
+
+    path = os.path.join(REPORT_LINK_DIR, payload['id'])
+    if not os.path.exists(path):
+        return 'expired'
+    return path, payload['filename']
+
+def purge_report_files():
+    """Delete stored files whose links have expired, at most once an hour"""
+    global _last_purge
+    if time.time() - _last_purge < 3600 or not os.path.isdir(REPORT_LINK_DIR):
+        return
+    _last_purge = time.time()
+    cutoff = time.time() - REPORT_LINK_TTL
+    for entry in os.scandir(REPORT_LINK_DIR):
+        try:
+            if entry.stat().st_mtime < cutoff:
+                remove_file(entry.path)
+        except OSError as e:
+            logger.error(f"Error checking report file {entry.path}: {e}")
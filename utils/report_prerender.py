@@ -0,0 +1,100 @@
+"""
+Reports rendered ahead of their delivery run
+
+Scheduled reports due in the morning are rendered during the quiet
+window at night: the HTML body is kept in prerendered_reports and the
+attachment as a file in REPORT_PRERENDER_DIR, which must be shared by
+all workers. Inserting the row claims the render for one worker; the
+delivery run then loads the stored report instead of querying.
+"""
+
+import os
+import hashlib
+import logging
+from datetime import datetime, timedelta, timezone
+from sqlalchemy.exc import IntegrityError
+from database import db
+from database.models import PrerenderedReport
+from utils.export_jobs import EXPORT_DIR
+from utils.exports import remove_file
+
+logger = logging.getLogger(__name__)
+
+REPORT_PRERENDER_DIR = os.environ.get("REPORT_PRERENDER_DIR", os.path.join(EXPORT_DIR, "reports"))
+
+# Claims of renders that never finished are dropped after this many seconds
+PRERENDER_CLAIM_TIMEOUT = 3600
+
+def prerender_key(key):
+    """Stable hash of a report key"""
+    return hashlib.sha1(repr(key).encode('utf-8')).hexdigest()
+
+def claim_prerender(key, run_date):
+    """Reserve the render of a report for a run date; False if another worker has it"""
+    try:
+        db.session.add(PrerenderedReport(report_key=prerender_key(key), run_date=run_date, status='rendering'))
+        db.session.commit()
+        return True
+    except IntegrityError:
+        db.session.rollback()
+        return False
+
+def store_prerender(key, run_date, report):
+    """Save a rendered report for its run date"""
+    path = None
+    if report['attachment'] is not None:
+        os.makedirs(REPORT_PRERENDER_DIR, exist_ok=True)
+        path = os.path.join(REPORT_PRERENDER_DIR, f"{prerender_key(key)}_{run_date.isoformat()}.xlsx")
+        partial = f"{path}.part"
+        try:
+            with open(partial, 'wb') as f:
+                f.write(report['attachment'])
+            os.replace(partial, path)
+        finally:
+            remove_file(partial)
+
+    row = db.session.get(PrerenderedReport, (prerender_key(key), run_date))
+    row.status = 'ready'
+    row.subject = report['subject']
+    row.html = report['html']
+    row.filename = report['filename']
+    row.attachment_path = path
+    db.session.commit()
+
+def release_prerender(key, run_date):
+    """Drop the claim of a failed render so a later pass retries it"""
+    db.session.query(PrerenderedReport).filter_by(report_key=prerender_key(key), run_date=run_date).delete()
+    db.session.commit()
+
+def load_prerendered(key, run_date):
+    """The stored report for a run date, or None"""
+    row = db.session.get(PrerenderedReport, (prerender_key(key), run_date))
+    if row is None or row.status != 'ready':
+        return None
+    attachment = None
+    if row.attachment_path:
+        # Reports sent as a link have no attachment file
+        try:
+            with open(row.attachment_path, 'rb') as f:
+                attachment = f.read()
+        except OSError as e:
+            logger.error(f"Error reading pre-rendered report {row.attachment_path}: {e}")
+            return None
+    return {'subject': row.subject, 'html': row.html, 'attachment': attachment, 'filename': row.filename}
+
+def purge_prerendered(today):
+    """Delete reports of past run dates and stale claims"""
+    stale = datetime.now(timezone.utc) - timedelta(seconds=PRERENDER_CLAIM_TIMEOUT)
+    try:
+        rows = PrerenderedReport.query.filter(db.or_(
+            PrerenderedReport.run_date < today,
+            db.and_(PrerenderedReport.status == 'rendering', PrerenderedReport.created_at < stale)
+        )).all()
+        for row in rows:
+            if row.attachment_path:
+                remove_file(row.attachment_path)
+            db.session.delete(row)
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        logger.error(f"Error purging pre-rendered reports: {e}")
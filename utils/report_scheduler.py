@@ -0,0 +1,251 @@
+"""
+Persistent report scheduler
+
+Schedules are rows in report_schedules carrying their next run time, so
+they survive restarts and every worker sees the same state. Each process
+runs a small loop that claims due schedules with one indexed query and
+hands them to a bounded thread pool, one task per group of schedules
+with the same report, so each report is rendered once for all of its
+recipients. Claiming moves next_run_at forward
+in the same transaction, under a Postgres advisory lock, so every run is
+picked up by exactly one worker. During the quiet window at night the
+loop also pre-renders the reports due in the morning.
+"""
+
+import os
+import random
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from zoneinfo import ZoneInfo
+from sqlalchemy import select, update, text
+from database import db
+from database.models import ReportSchedule
+
+logger = logging.getLogger(__name__)
+
+FREQUENCIES = ('daily', 'weekly', 'monthly')
+
+# Time zone of the send_time of schedules
+REPORT_TIMEZONE = os.environ.get("REPORT_TIMEZONE", "UTC")
+# Seconds between checks for due schedules
+REPORT_SCHEDULER_INTERVAL = int(os.environ.get("REPORT_SCHEDULER_INTERVAL", "30"))
+# Reports generated concurrently per process
+REPORT_WORKERS = int(os.environ.get("REPORT_WORKERS", "2"))
+# Due schedules read per claim, grouped into one task per distinct report
+REPORT_CLAIM_BATCH = int(os.environ.get("REPORT_CLAIM_BATCH", "200"))
+# Upper bound of the random offset added to send_time of new schedules (seconds)
+REPORT_JITTER_SECONDS = int(os.environ.get("REPORT_JITTER_SECONDS", "900"))
+# Local time window for pre-rendering upcoming reports (HH:MM-HH:MM), empty to disable
+REPORT_PRERENDER_WINDOW = os.environ.get("REPORT_PRERENDER_WINDOW", "01:00-05:00")
+# Schedules due within this many hours are pre-rendered
+REPORT_PRERENDER_HORIZON = int(os.environ.get("REPORT_PRERENDER_HORIZON", "12"))
+# Set to 0 in request-serving processes to leave reports to a dedicated worker
+REPORT_SCHEDULER_ENABLED = os.environ.get("REPORT_SCHEDULER_ENABLED", "1") == "1"
+
+# Application-wide key of the Postgres advisory lock taken while claiming
+REPORT_SCHEDULER_LOCK_KEY = 704201
+
+_lock = threading.Lock()
+_worker = None
+_worker_pid = None
+_executor = None
+_executor_pid = None
+_in_flight = 0
+_runner = None  # callable(schedule_ids, run_at) sending one report to a group, returning {schedule_id: error}
+_prerender = None  # callable() pre-rendering upcoming reports
+_prerendering = False
+
+def utcnow():
+    """Current time as naive UTC, the way schedule times are stored"""
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+def random_jitter():
+    """Offset for a new schedule, spreading reports set for the same time"""
+    return random.randint(0, REPORT_JITTER_SECONDS)
+
+def local_time(value):
+    """Stored naive UTC time in REPORT_TIMEZONE, for display"""
+    if value is None:
+        return None
+    return value.replace(tzinfo=timezone.utc).astimezone(ZoneInfo(REPORT_TIMEZONE))
+
+def run_slot(send_time, run_at):
+    """Local send time of a run due at a naive UTC moment, without its jitter"""
+    hour, minute = (int(part) for part in send_time.split(':'))
+    local = local_time(run_at)
+    slot = local.replace(hour=hour, minute=minute, second=0, microsecond=0)
+    if slot > local:
+        slot -= timedelta(days=1)
+    return slot
+
+def in_prerender_window(now=None):
+    """Whether the local time is inside REPORT_PRERENDER_WINDOW"""
+    if not REPORT_PRERENDER_WINDOW:
+        return False
+    start, end = (tuple(int(part) for part in bound.split(':')) for bound in REPORT_PRERENDER_WINDOW.split('-'))
+    local = local_time(now or utcnow())
+    current = (local.hour, local.minute)
+    if start <= end:
+        return start <= current < end
+    return current >= start or current < end
+
+def next_run_time(frequency, send_time, after, jitter_seconds=0):
+    """First run strictly after a naive UTC moment: daily, on Mondays or on the 1st of the month"""
+    hour, minute = (int(part) for part in send_time.split(':'))
+    local = local_time(after)
+    slot = local.replace(hour=hour, minute=minute, second=0, microsecond=0)
+    if frequency == 'weekly':
+        slot -= timedelta(days=slot.weekday())
+    elif frequency == 'monthly':
+        slot = slot.replace(day=1)
+
+    jitter = timedelta(seconds=jitter_seconds)
+    while slot + jitter <= local:
+        if frequency == 'monthly':
+            slot = (slot.replace(day=28) + timedelta(days=4)).replace(day=1)
+        elif frequency == 'weekly':
+            slot += timedelta(days=7)
+        else:
+            slot += timedelta(days=1)
+    return (slot + jitter).astimezone(timezone.utc).replace(tzinfo=None)
+
+def claim_due_schedules(limit, max_groups=None):
+    """Move due schedules to their next run and return the claimed rows
+
+    Reads up to limit due rows and claims those of the first max_groups
+    distinct reports, so a process never takes more than its pool has room for.
+    """
+    now = utcnow()
+    claimed = []
+    with db.engine.begin() as connection:
+        if connection.dialect.name == 'postgresql':
+            # Claims are serialized across workers; a busy lock means another worker is on it
+            locked = connection.execute(text("SELECT pg_try_advisory_xact_lock(:key)"),
+                                        {'key': REPORT_SCHEDULER_LOCK_KEY}).scalar()
+            if not locked:
+                return claimed
+
+        due = connection.execute(
+            select(ReportSchedule.id, ReportSchedule.frequency, ReportSchedule.send_time,
+                   ReportSchedule.jitter_seconds, ReportSchedule.next_run_at,
+                   ReportSchedule.store_ids, ReportSchedule.include_alerts)
+            .where(ReportSchedule.active.is_(True), ReportSchedule.next_run_at <= now)
+            .order_by(ReportSchedule.next_run_at)
+            .limit(limit)
+        ).all()
+        groups = set()
+        for row in due:
+            key = group_key(row)
+            if max_groups is not None and key not in groups and len(groups) >= max_groups:
+                continue
+            # Conditional on the old run time, so a concurrent claim can never succeed twice
+            result = connection.execute(
+                update(ReportSchedule)
+                .where(ReportSchedule.id == row.id, ReportSchedule.next_run_at == row.next_run_at)
+                .values(next_run_at=next_run_time(row.frequency, row.send_time, now, row.jitter_seconds),
+                        last_run_at=now, last_status='queued', last_error=None)
+            )
+            if result.rowcount == 1:
+                claimed.append(row)
+                groups.add(key)
+    return claimed
+
+def _get_executor():
+    """Report thread pool of this process, recreated after a fork"""
+    global _executor, _executor_pid
+    if _executor is None or _executor_pid != os.getpid():
+        _executor = ThreadPoolExecutor(max_workers=REPORT_WORKERS, thread_name_prefix='report')
+        _executor_pid = os.getpid()
+    return _executor
+
+def group_key(row):
+    """Schedules with the same key receive the same report; the last item is the local run time"""
+    return row.frequency, row.store_ids or '[]', bool(row.include_alerts), run_slot(row.send_time, row.next_run_at)
+
+def _set_status(schedule_ids, **values):
+    if not schedule_ids:
+        return
+    with db.engine.begin() as connection:
+        connection.execute(update(ReportSchedule).where(ReportSchedule.id.in_(schedule_ids)).values(**values))
+
+def _run_schedules(app, schedule_ids, run_at):
+    """Generate one report and send it for a group of claimed schedules, in a pool thread"""
+    global _in_flight
+    with app.app_context():
+        try:
+            errors = _runner(schedule_ids, run_at)
+            _set_status([sid for sid in schedule_ids if sid not in errors], last_status='sent')
+            for schedule_id, error in errors.items():
+                _set_status([schedule_id], last_status='failed', last_error=error)
+            logger.info(f"Scheduled report sent for {len(schedule_ids) - len(errors)} of {len(schedule_ids)} schedules")
+        except Exception as e:
+            logger.error(f"Error sending scheduled reports {schedule_ids}: {e}")
+            db.session.rollback()
+            _set_status(schedule_ids, last_status='failed', last_error=str(e))
+        finally:
+            db.session.remove()
+            with _lock:
+                _in_flight -= 1
+
+def _run_prerender(app):
+    """Pre-render upcoming reports in a pool thread"""
+    global _prerendering, _in_flight
+    with app.app_context():
+        try:
+            _prerender()
+        except Exception as e:
+            logger.error(f"Error pre-rendering reports: {e}")
+        finally:
+            db.session.remove()
+            with _lock:
+                _in_flight -= 1
+            _prerendering = False
+
+def _run_scheduler(app):
+    """Scheduler loop: claim due reports while the pool has free threads"""
+    global _in_flight, _prerendering
+    while True:
+        try:
+            with app.app_context():
+                with _lock:
+                    capacity = REPORT_WORKERS - _in_flight
+                if capacity > 0:
+                    groups = {}
+                    for row in claim_due_schedules(REPORT_CLAIM_BATCH, max_groups=capacity):
+                        groups.setdefault(group_key(row), []).append(row.id)
+                    for key, schedule_ids in groups.items():
+                        with _lock:
+                            _in_flight += 1
+                        _get_executor().submit(_run_schedules, app, schedule_ids, key[-1])
+                if _prerender and not _prerendering and in_prerender_window():
+                    with _lock:
+                        free = _in_flight < REPORT_WORKERS
+                        if free:
+                            _in_flight += 1
+                    if free:
+                        _prerendering = True
+                        _get_executor().submit(_run_prerender, app)
+                db.session.remove()
+        except Exception as e:
+            logger.error(f"Report scheduler error: {e}")
+
+        time.sleep(REPORT_SCHEDULER_INTERVAL)
+
+def start_report_scheduler(app, runner, prerender=None):
+    """Start the scheduler loop once per process"""
+    global _worker, _worker_pid, _runner, _prerender, _in_flight
+    if not REPORT_SCHEDULER_ENABLED:
+        return
+    with _lock:
+        if _worker is not None and _worker_pid == os.getpid() and _worker.is_alive():
+            return
+        _runner = runner
+        _prerender = prerender
+        _in_flight = 0
+        _worker_pid = os.getpid()
+        _worker = threading.Thread(target=_run_scheduler, args=(app,), name='report-scheduler', daemon=True)
+        _worker.start()
+    logger.info(f"Report scheduler started ({REPORT_WORKERS} workers, check every {REPORT_SCHEDULER_INTERVAL}s)")
@@ -0,0 +1,205 @@
+"""
+Chain-wide workbook with one sheet per store
+
+Each store's sheet is fetched and rendered in its own process: the task
+writes a single-sheet constant_memory workbook (inline strings, default
+style only), so its sheet XML can be dropped into the final workbook as
+is. The parent writes the summary and region pivot sheets plus an empty
+placeholder per store, then swaps the placeholders for the rendered
+sheets.
+"""
+
+import os
+import re
+import shutil
+import logging
+import tempfile
+import zipfile
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime
+import xlsxwriter
+from sqlalchemy import create_engine, select
+from database import db
+from database.models import Store, VisitorCounter, VisitorData
+from utils.exports import EXPORT_BATCH_SIZE
+
+logger = logging.getLogger(__name__)
+
+STORE_WORKBOOK_PROCESSES = int(os.environ.get("STORE_WORKBOOK_PROCESSES", str(min(os.cpu_count() or 2, 8))))
+
+STORE_SHEET_HEADERS = ['Дата и время', 'Счетчик', 'Вход', 'Выход', 'Текущая посещаемость']
+
+# Sheets written by the parent before the store sheets
+LEADING_SHEETS = ['Сводка', 'По регионам']
+
+_engine = None  # per worker process
+
+def _init_worker(database_url):
+    """Process pool initializer: one engine per worker process"""
+    global _engine
+    _engine = create_engine(database_url, pool_size=1, max_overflow=0)
+
+def _render_store_sheet(store_id, counter_ids, start_date, directory):
+    """Fetch one store's rows and render them as a single-sheet workbook, returning its totals"""
+    query = select(
+        VisitorData.timestamp,
+        VisitorCounter.name,
+        VisitorData.entries,
+        VisitorData.exits,
+        VisitorData.current_occupancy
+    ).select_from(VisitorData).join(VisitorCounter).where(
+        VisitorCounter.store_id == store_id,
+        VisitorData.counter_id.in_(counter_ids),
+        VisitorData.timestamp >= start_date
+    ).order_by(VisitorData.timestamp, VisitorCounter.name)
+    
+    path = os.path.join(directory, f"store_{store_id}.xlsx")
+    workbook = xlsxwriter.Workbook(path, {'constant_memory': True, 'tmpdir': directory})
+    totals = {'store_id': store_id, 'path': path, 'rows': 0, 'entries': 0, 'exits': 0, 'occupancy': 0}
+    try:
+        worksheet = workbook.add_worksheet()
+        worksheet.set_column(0, 0, 20)
+        worksheet.set_column(1, 1, 25)
+        worksheet.freeze_panes(1, 0)
+        worksheet.write_row(0, 0, STORE_SHEET_HEADERS)
+        
+        with _engine.connect() as connection:
+            result = connection.execution_options(stream_results=True, yield_per=EXPORT_BATCH_SIZE).execute(query)
+            for row_num, row in enumerate(result, 1):
+                worksheet.write_row(row_num, 0, (
+                    row.timestamp.strftime('%Y-%m-%d %H:%M:%S'),
+                    row.name,
+                    row.entries,
+                    row.exits,
+                    row.current_occupancy
+                ))
+                totals['rows'] = row_num
+                totals['entries'] += row.entries or 0
+                totals['exits'] += row.exits or 0
+                totals['occupancy'] += row.current_occupancy or 0
+    finally:
+        workbook.close()
+    return totals
+
+def _sheet_name(store, used):
+    """Unique Excel sheet name (max 31 chars, no []:*?/\\) for a store"""
+    base = re.sub(r'[\[\]:*?/\\]', ' ', f"{store.store_code} {store.name}").strip()[:31]
+    name, suffix = base, 2
+    while name.lower() in used:
+        tail = f" ({suffix})"
+        name = base[:31 - len(tail)] + tail
+        suffix += 1
+    used.add(name.lower())
+    return name
+
+def _region_pivot(counter_ids, start_date):
+    """Daily entries per region"""
+    day = db.func.date(VisitorData.timestamp)
+    rows = db.session.query(
+        db.func.coalesce(Store.region, 'Без региона').label('region'),
+        day.label('day'),
+        db.func.sum(VisitorData.entries).label('entries')
+    ).select_from(VisitorData).join(VisitorCounter).join(Store).filter(
+        VisitorData.counter_id.in_(counter_ids),
+        VisitorData.timestamp >= start_date
+    ).group_by('region', day).all()
+    
+    days = sorted({str(row.day) for row in rows})
+    pivot = {}
+    for row in rows:
+        pivot.setdefault(row.region, {})[str(row.day)] = int(row.entries or 0)
+    return days, pivot
+
+def _write_parent_workbook(path, stores, sheet_names, results, pivot, period):
+    """Summary, region pivot and one empty placeholder sheet per store"""
+    workbook = xlsxwriter.Workbook(path)
+    try:
+        bold = workbook.add_format({'bold': True})
+        
+        summary = workbook.add_worksheet(LEADING_SHEETS[0])
+        summary.write_row(0, 0, ['Период', period])
+        summary.write_row(1, 0, ['Дата экспорта', datetime.now().strftime('%Y-%m-%d %H:%M:%S')])
+        headers = ['Магазин', 'Код', 'Регион', 'Город', 'Записей', 'Вход', 'Выход', 'Средняя посещаемость']
+        summary.write_row(3, 0, headers, bold)
+        summary.set_column(0, 0, 30)
+        summary.set_column(1, 7, 14)
+        row_num = 4
+        for store in stores:
+            totals = results[store.id]
+            average = round(totals['occupancy'] / totals['rows'], 1) if totals['rows'] else 0
+            summary.write_row(row_num, 0, [store.name, store.store_code, store.region or '', store.city or '',
+                                           totals['rows'], totals['entries'], totals['exits'], average])
+            row_num += 1
+        summary.write_row(row_num, 0, ['Итого', '', '', '',
+                                       sum(r['rows'] for r in results.values()),
+                                       sum(r['entries'] for r in results.values()),
+                                       sum(r['exits'] for r in results.values())], bold)
+        
+        days, regions = pivot
+        region_sheet = workbook.add_worksheet(LEADING_SHEETS[1])
+        region_sheet.write_row(0, 0, ['Регион'] + days + ['Итого'], bold)
+        region_sheet.set_column(0, 0, 25)
+        for row_num, region in enumerate(sorted(regions), 1):
+            values = [regions[region].get(d, 0) for d in days]
+            region_sheet.write_row(row_num, 0, [region] + values + [sum(values)])
+        
+        for store in stores:
+            workbook.add_worksheet(sheet_names[store.id])
+    finally:
+        workbook.close()
+
+def _merge_store_sheets(parent_path, output_path, sheet_paths):
+    """Copy the parent workbook, replacing placeholder sheets with the rendered ones"""
+    with zipfile.ZipFile(parent_path) as parent, \
+            zipfile.ZipFile(output_path, 'w', zipfile.ZIP_DEFLATED) as output:
+        for item in parent.infolist():
+            rendered = sheet_paths.get(item.filename)
+            if rendered is None:
+                output.writestr(item, parent.read(item.filename))
+                continue
+            with zipfile.ZipFile(rendered) as store_book:
+                xml = store_book.read('xl/worksheets/sheet1.xml')
+            # Only the first sheet of the final workbook is selected
+            output.writestr(item, xml.replace(b' tabSelected="1"', b''))
+
+def build_store_workbook(output_path, counter_ids, start_date, period, set_progress=None):
+    """Write a workbook with summary, region pivot and one sheet per store of the counters"""
+    stores = db.session.query(Store).join(VisitorCounter).filter(
+        VisitorCounter.id.in_(counter_ids)
+    ).distinct().order_by(Store.region, Store.name).all()
+    store_counters = {}
+    for counter_id, store_id in db.session.query(VisitorCounter.id, VisitorCounter.store_id).filter(
+            VisitorCounter.id.in_(counter_ids)).all():
+        store_counters.setdefault(store_id, []).append(counter_id)
+    
+    used = set(name.lower() for name in LEADING_SHEETS)
+    sheet_names = {store.id: _sheet_name(store, used) for store in stores}
+    database_url = db.engine.url.render_as_string(hide_password=False)
+    directory = tempfile.mkdtemp(prefix='store_workbook_')
+    try:
+        # spawn: forking a threaded web worker is unsafe
+        results = {}
+        context = multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(max_workers=max(1, min(STORE_WORKBOOK_PROCESSES, len(stores))),
+                                 mp_context=context, initializer=_init_worker,
+                                 initargs=(database_url,)) as pool:
+            futures = [pool.submit(_render_store_sheet, store.id, store_counters[store.id], start_date, directory)
+                       for store in stores]
+            for done, future in enumerate(as_completed(futures), 1):
+                totals = future.result()
+                results[totals['store_id']] = totals
+                if set_progress:
+                    set_progress(min(95, done * 95 // len(futures)))
+        
+        parent_path = os.path.join(directory, 'parent.xlsx')
+        _write_parent_workbook(parent_path, stores, sheet_names, results,
+                               _region_pivot(counter_ids, start_date), period)
+        sheet_paths = {
+            f"xl/worksheets/sheet{len(LEADING_SHEETS) + i + 1}.xml": results[store.id]['path']
+            for i, store in enumerate(stores)
+        }
+        _merge_store_sheets(parent_path, output_path, sheet_paths)
+        logger.info(f"Store workbook written: {len(stores)} stores")
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
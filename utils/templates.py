@@ -0,0 +1,68 @@
+"""
+Registry of precompiled inline Jinja templates
+
+Modules register their inline template strings by name at import time.
+Each template is compiled once per application and the compiled object
+is reused for every render, instead of render_template_string parsing
+and compiling the source on every request. Setting TEMPLATE_CACHE_DIR
+also stores the compiled bytecode on disk so new workers start faster.
+"""
+
+import os
+import logging
+from flask import current_app, render_template
+from jinja2 import BaseLoader, TemplateNotFound, FileSystemBytecodeCache
+
+logger = logging.getLogger(__name__)
+
+# Optional directory for the on-disk bytecode cache
+TEMPLATE_CACHE_DIR = os.environ.get("TEMPLATE_CACHE_DIR")
+
+_sources = {}
+
+class InlineTemplateLoader(BaseLoader):
+    """Jinja loader serving registered inline template sources"""
+
+    def get_source(self, environment, template):
+        if template not in _sources:
+            raise TemplateNotFound(template)
+        source = _sources[template]
+        return source, None, lambda: _sources.get(template) is source
+
+def register_template(name, source):
+    """Register an inline template source under a name"""
+    _sources[name] = source
+    return name
+
+def _registry(app):
+    """Return the per-application environment and compiled template map"""
+    registry = app.extensions.get('inline_templates')
+    if registry is None:
+        options = {'loader': InlineTemplateLoader()}
+        if TEMPLATE_CACHE_DIR:
+            os.makedirs(TEMPLATE_CACHE_DIR, exist_ok=True)
+            # Autoescape is compiled into the bytecode: the prefix keeps unescaped caches out
+            options['bytecode_cache'] = FileSystemBytecodeCache(TEMPLATE_CACHE_DIR, '__jinja2_escaped_%s.cache')
+        # Overlay keeps the app's globals and filters. Registered names have no .html
+        # suffix, so autoescape is forced on as render_template_string did
+        registry = {'env': app.jinja_env.overlay(autoescape=True, **options), 'templates': {}}
+        app.extensions['inline_templates'] = registry
+    return registry
+
+def get_template(name, app=None):
+    """Return the compiled template, compiling it on first use"""
+    registry = _registry(app or current_app)
+    template = registry['templates'].get(name)
+    if template is None:
+        template = registry['templates'][name] = registry['env'].get_template(name)
+    return template
+
+def compile_templates(app):
+    """Compile every registered template up front"""
+    for name in list(_sources):
+        get_template(name, app)
+    logger.info(f"Compiled {len(_sources)} inline templates")
+
+def render_inline(name, **context):
+    """Render a registered template with the regular Flask template context"""
+    return render_template(get_template(name), **context)